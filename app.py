@@ -1,9 +1,17 @@
 import streamlit as st
 import time
+import uuid
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import base64
-from story_generator import generate_story_and_image
+import media
+import metrics
+from artifact_store import get_artifact_store, hold_result
+from jobs import QueueFull, get_job, submit_story
+from quota import estimate_cost, get_quota_service
+from story_generator import STORY_LENGTHS, STORY_TONES, STORY_TOPICS, build_story_topic, warm_up
+
+# Load the OpenAI client, PIL and reportlab in the background while the home page renders
+warm_up()
 
 # Custom CSS for styling
 def local_css():
@@ -50,89 +58,99 @@ st.set_page_config(
 # Apply custom CSS
 local_css()
 
-# Token system configuration (hidden from user but still functional)
-TOKEN_RESET_TIME = 8 * 60 * 60  # 8 hours in seconds
-MAX_TOKENS = 4  # Number of allowed story generations
-
 # Initialize session state variables
-if "tokens" not in st.session_state:
-    st.session_state.tokens = MAX_TOKENS
-    st.session_state.token_timestamp = time.time()
-    st.session_state.story_cache = {}  # Cache to store generated stories
+if "page" not in st.session_state:
     st.session_state.page = "home"  # Track which page we're on
     st.session_state.current_story = None  # Store the current story
+    st.session_state.display_image = None  # The current story's illustration, sized for the page
     st.session_state.final_story_topic = None  # Store the combined topic and tone
+    st.session_state.job_id = None  # Story generation job being waited on
+    st.session_state.quota_ticket = None  # Admission to give back if the story costs nothing
+    st.session_state.session_id = uuid.uuid4().hex  # Owner of the story files this session shows
+
+# Usage limits live in the shared quota service (see quota.py), so they hold across page
+# reloads and Streamlit workers. Users are told apart by IP address where Streamlit knows it.
+def quota_subject():
+    ip_address = getattr(getattr(st, "context", None), "ip_address", None)
+    return f"ip:{ip_address}" if ip_address else f"session:{st.session_state.session_id}"
 
-# Function to reset tokens after the set time period
-def reset_tokens():
-    elapsed_time = time.time() - st.session_state.token_timestamp
-    if elapsed_time > TOKEN_RESET_TIME:
-        st.session_state.tokens = MAX_TOKENS
-        st.session_state.token_timestamp = time.time()
+def quota_message(decision):
+    hours = decision.retry_after / 3600
+    if decision.reason == "user_limit":
+        wait = f"{hours:.0f} hours" if hours >= 1.5 else f"{max(decision.retry_after / 60, 1):.0f} minutes"
+        return f"🚫 You have reached the maximum limit of stories. Please try again in about {wait}."
+    return "🌙 Lots of stories are being written right now. Please try again in a minute."
 
-# Reset tokens if the time has passed
-reset_tokens()
+# How often the progress page refreshes while a story is being generated
+JOB_POLL_INTERVAL = 0.5  # seconds
 
-# Function to generate story and redirect to story page
+STAGE_LABELS = {"story": "📝 Story", "image": "🎨 Illustration", "audio": "🎵 Narration", "pdf": "📄 PDF"}
+STAGE_ICONS = {"pending": "⏳", "running": "🪄", "done": "✅", "failed": "⚠️", "skipped": "➖"}
+
+# Function to queue story generation and redirect to the progress page
 def generate_and_redirect():
-    # Check if we have enough tokens
-    if st.session_state.tokens <= 0:
-        st.error("🚫 You have reached the maximum limit of stories. Please try again later.")
+    # Admission control happens before anything is queued, so shed requests cost nothing
+    quota = get_quota_service()
+    decision = quota.admit(quota_subject(), estimate_cost(story_length.lower()))
+    if not decision.allowed:
+        st.error(quota_message(decision))
         return
     
-    # Create a unique cache key that includes both the topic and child's name
-    cache_key = f"{final_story_topic}_{child_name}"
-    
-    # Check cache to avoid redundant processing
-    if cache_key in st.session_state.story_cache:
-        result = st.session_state.story_cache[cache_key]
-        # Add a flag to indicate this was from cache
-        if "timings" in result:
-            result["timings"]["from_cache"] = True
-            # Print cached timing data to console for PPT
-            print("="*60)
-            print("📊 TIMING DATA FOR PPT (CACHED RESULT)")
-            print("="*60)
-            print(f"Story Topic: {final_story_topic}")
-            print(f"Child Name: {child_name}")
-            print(f"📝 Story Generation: {result['timings'].get('story_generation', 'N/A')}s")
-            print(f"🎨 Image Generation: {result['timings'].get('image_generation', 'N/A')}s")
-            print(f"🎵 Audio Generation: {result['timings'].get('audio_generation', 'N/A')}s")
-            print(f"📄 PDF Generation: {result['timings'].get('pdf_generation', 'N/A')}s")
-            print(f"🚀 Total Generation Time: {result['timings'].get('total_time', 'N/A')}s")
-            print(f"Status: ⚡ CACHED (Instant delivery)")
-            print("="*60)
-    else:
-        with st.spinner('Crafting your magical story... 🪄'):
-            # Create the thread pool executor
-            executor = ThreadPoolExecutor(max_workers=1)
-            # Submit the task
-            future = executor.submit(generate_story_and_image, final_story_topic, story_length.lower(), child_name)
-            result = future.result()
-            # Add a flag to indicate this was fresh generation
-            if "timings" in result:
-                result["timings"]["from_cache"] = False
-                # Print fresh timing data to console for PPT
-                print("="*60)
-                print("📊 TIMING DATA FOR PPT (FRESH GENERATION)")
-                print("="*60)
-                print(f"Story Topic: {final_story_topic}")
-                print(f"Child Name: {child_name}")
-                print(f"📝 Story Generation: {result['timings'].get('story_generation', 'N/A')}s")
-                print(f"🎨 Image Generation: {result['timings'].get('image_generation', 'N/A')}s")
-                print(f"🎵 Audio Generation: {result['timings'].get('audio_generation', 'N/A')}s")
-                print(f"📄 PDF Generation: {result['timings'].get('pdf_generation', 'N/A')}s")
-                print(f"🚀 Total Generation Time: {result['timings'].get('total_time', 'N/A')}s")
-                print(f"Status: ✨ FRESH GENERATION")
-                print("="*60)
-            # Cache the result
-            st.session_state.story_cache[cache_key] = result  # Store in cache
-        
-        st.session_state.tokens -= 1  # Deduct a token only for fresh generation
+    # Generation runs on the shared job queue, so this script run returns right away.
+    # Identical requests already in progress are joined instead of started again.
+    try:
+        job = submit_story(final_story_topic, story_length.lower(), child_name, ticket=decision.ticket)
+    except QueueFull:
+        quota.refund(decision.ticket)
+        st.warning("🌙 Lots of stories are being written right now. Please try again in a moment.")
+        return
+    if job.ticket != decision.ticket:
+        # Joined an identical request that is already paid for
+        quota.refund(decision.ticket)
+        decision = decision._replace(ticket=None)
+
+    st.session_state.quota_ticket = decision.ticket
+    st.session_state.job_id = job.id
+    st.session_state.final_story_topic = final_story_topic  # Store the topic for the story page
+    st.session_state.page = "generating"
+    st.rerun()
+
+# Function to pick up a finished job and show the story page
+def finish_job(job):
+    # The job's result is shared with every session that joined it; this session rewrites
+    # its own copy (timings, paths of the files it holds)
+    result = dict(job.result, timings=dict(job.result["timings"]))
+    from_cache = result["timings"].get("from_cache", False)
+    result["timings"]["from_cache"] = from_cache
+
+    # Per-stage spans are recorded inside story_generator; this records the request as a whole
+    metrics.record_request(result["timings"], topic=job.story_topic, length=job.story_length)
+
+    if from_cache or result["timings"].get("prescreened"):
+        get_quota_service().refund(st.session_state.quota_ticket)  # Only fresh stories count
+    st.session_state.quota_ticket = None
     
+    # Hold on to this story's files (and let go of the previous story's)
+    owner = f"session:{st.session_state.session_id}"
+    get_artifact_store().release_owner(owner)
+    hold_result(result, owner)
+
+    # The illustration is shown from a column-sized WebP rendition, not the 1024 px original
+    st.session_state.display_image = None
+    if result["image"]:
+        try:
+            st.session_state.display_image = media.image_rendition(result["image"], media.DISPLAY_WIDTH)
+        except Exception as e:
+            print(f"Error making the illustration rendition: {e}")
+            try:
+                st.session_state.display_image = media.read_bytes(result["image"])
+            except OSError:
+                pass  # Shown as unavailable
+    media.record_served(result, media.byte_size(st.session_state.display_image))
+
     # Store the result and change page
     st.session_state.current_story = result
-    st.session_state.final_story_topic = final_story_topic  # Store the topic for the story page
+    st.session_state.job_id = None
     st.session_state.page = "story"
 
 # Render the appropriate page based on state
@@ -157,11 +175,7 @@ if st.session_state.page == "home":
         st.markdown("### Story Topic")
 
         # All topic options in a single radio button group
-        all_topics = [
-            "Animals", "Dinosaurs", "Superheroes", "Sports",
-            "Space", "Robots", "Ocean", "Music",
-            "Magic", "Fairies", "Forest"
-        ]
+        all_topics = STORY_TOPICS
         
         # Default to first topic if none selected
         if "selected_topic" not in st.session_state:
@@ -179,7 +193,7 @@ if st.session_state.page == "home":
         st.markdown("### Story Tone")
         
         # All tone options in a single radio button group
-        all_tones = ["Calm & Peaceful", "Silly & Funny", "Adventurous & Exciting"]
+        all_tones = STORY_TONES
         
         # Default to first tone if none selected
         if "selected_tone" not in st.session_state:
@@ -197,22 +211,24 @@ if st.session_state.page == "home":
         st.session_state.selected_topic = selected_topic
         st.session_state.selected_tone = selected_tone
         
-        # Create a story idea based on selection
-        story_base = f"A {selected_tone.lower()} story about {selected_topic.lower()}"
         story_topic = st.text_input("Custom Story Details (Optional)", 
                                   placeholder="Add any specific details to your story", 
                                   help="You can leave this empty or add specific details")
         
-        # Combine the topic and any custom details
-        if story_topic:
-            final_story_topic = f"{story_base} - {story_topic}"
-        else:
-            final_story_topic = story_base
+        # Combine the selected topic, tone and any custom details into the story idea
+        final_story_topic = build_story_topic(selected_topic, selected_tone, story_topic)
         
-        story_length = st.select_slider("Story Length", options=["Short", "Medium"], value="Short", help="Short: 2-3 minutes | Medium: 5-7 minutes")
+        story_length = st.select_slider("Story Length", options=[length.title() for length in STORY_LENGTHS], value="Short", help="Short: 2-3 minutes | Medium: 5-7 minutes")
         
+        # Checked on every rerun: from the quota service's memory within a second of the
+        # last check, otherwise two indexed SQLite reads
+        availability = get_quota_service().check(quota_subject())
+        if not availability.allowed and availability.reason == "user_limit":
+            st.info(quota_message(availability))
+
         # Create story button
-        if st.button("✨ Create My Story", use_container_width=True):
+        if st.button("✨ Create My Story", use_container_width=True,
+                     disabled=not availability.allowed and availability.reason == "user_limit"):
             generate_and_redirect()
     
     with col2:
@@ -230,9 +246,39 @@ if st.session_state.page == "home":
     # Footer
     st.markdown("<div class='footer'>Created for LLM project by Dhanush and Charan</div>", unsafe_allow_html=True)
 
+elif st.session_state.page == "generating":
+    # Progress page: polls the background job until the story is ready
+    job = get_job(st.session_state.job_id)
+    
+    if job is None or job.status == "failed":
+        st.error("😴 Something went wrong while writing your story. Please try again.")
+        get_quota_service().refund(st.session_state.quota_ticket)  # Failed stories don't count
+        st.session_state.quota_ticket = None
+        if st.button("← Back to Story Creator"):
+            st.session_state.job_id = None
+            st.session_state.page = "home"
+            st.rerun()
+    elif job.status == "done":
+        finish_job(job)
+        st.rerun()
+    else:
+        st.markdown("<h2 style='text-align: center;'>Crafting your magical story... 🪄</h2>", unsafe_allow_html=True)
+        st.progress(job.progress())
+        st.markdown(" &nbsp; ".join(f"{STAGE_ICONS[job.stages[stage]]} {label}" for stage, label in STAGE_LABELS.items()))
+        if job.status == "queued":
+            st.caption("Waiting for a free storyteller...")
+        
+        # Show the story text as it streams in
+        if job.story_text:
+            st.markdown(f"<div class='story-text'>{job.story_text}</div>", unsafe_allow_html=True)
+        
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
+
 elif st.session_state.page == "story":
     # Story display page
     result = st.session_state.current_story
+    hold_result(result, f"session:{st.session_state.session_id}")  # Renew the lease while it's shown
     
     # Handle AI refusal
     if result["story"].startswith("Sorry, I cannot create a story on this topic."):
@@ -264,28 +310,36 @@ elif st.session_state.page == "story":
             st.markdown(f"<div class='story-text'>{result['story']}</div>", unsafe_allow_html=True)
         
         with col2:
-            # Illustration
-            if result["image"]:
+            # Illustration: bytes kept in the session, so it still shows if the original has expired
+            if st.session_state.display_image:
                 st.markdown("### Story Illustration")
-                st.image(result["image"], use_column_width=True)
+                st.image(st.session_state.display_image, use_column_width=True)
+            else:
+                st.info("🎨 The illustration couldn't be painted this time, but the story is all yours.")
             
             # Audio player
             if result["audio"]:
                 st.markdown("### Listen to the Story")
-                with open(result["audio"], "rb") as audio_file:
-                    st.audio(audio_file, format="audio/mp3")
+                # Streamlit reads the file into its in-memory media storage; the encode keeps it small
+                st.audio(result["audio"], format=media.audio_mime(result["audio"]))
+            else:
+                st.info("🎵 The narration isn't available for this story right now.")
             
             # Download button
             if result["pdf"]:
                 st.markdown("### Keep the Magic")
-                with open(result["pdf"], "rb") as pdf_file:
-                    st.download_button(
-                        label="📥 Download as PDF",
-                        data=pdf_file,
-                        file_name=f"{st.session_state.final_story_topic}.pdf",
-                        mime="application/pdf",
-                        use_container_width=True
-                    )
+                # Fresh PDFs are rendered in memory; cached ones are files in the story cache
+                pdf_data = result["pdf"]
+                if not isinstance(pdf_data, bytes):
+                    with open(pdf_data, "rb") as pdf_file:
+                        pdf_data = pdf_file.read()
+                st.download_button(
+                    label="📥 Download as PDF",
+                    data=pdf_data,
+                    file_name=f"{st.session_state.final_story_topic}.pdf",
+                    mime="application/pdf",
+                    use_container_width=True
+                )
         
         st.markdown("</div>", unsafe_allow_html=True)
         
@@ -0,0 +1,292 @@
+"""
+Disk store for generated media (narration MP3s, PDFs and images).
+
+Blobs are content-addressed, so identical narration is stored once. Whoever writes, shows
+or serves a blob holds a reference to it: put() leases the file to its writer until the
+writer releases it (or hands it on with hold_result), a job holds its result's files until
+the job is pruned, and a Streamlit session holds the story it is displaying. References are
+leases that expire, so a crashed writer or a closed browser tab can't pin files forever.
+
+Results served from the story cache point into cache entry directories, which the cache's
+own LRU/TTL eviction may delete at any time. hold_result() copies those files into the
+store, so a story that is being shown keeps its media.
+
+Unreferenced blobs are kept for a short grace period (a page rerun may still read them),
+then evicted by a background thread, and sooner if the store goes over its disk quota.
+Each process writes into its own subdirectory, named after its host and pid; at startup,
+directories left behind by processes on this host that are no longer running are swept
+away. Directories of other hosts sharing the cache directory are left alone, since their
+processes can't be checked from here.
+"""
+import hashlib
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+import metrics
+from story_cache import CACHE_DIR
+
+ARTIFACT_DIR = os.getenv("STORY_ARTIFACT_DIR", os.path.join(CACHE_DIR, "artifacts"))
+ARTIFACT_MAX_BYTES = int(os.getenv("STORY_ARTIFACT_MAX_BYTES", str(200 * 1024 * 1024)))  # 200 MB
+ARTIFACT_GRACE_SECONDS = int(os.getenv("STORY_ARTIFACT_GRACE", "300"))  # keep unreferenced blobs 5 min
+ARTIFACT_SWEEP_INTERVAL = int(os.getenv("STORY_ARTIFACT_SWEEP_INTERVAL", "60"))
+DEFAULT_LEASE_SECONDS = 2 * 60 * 60  # 2 hours
+WRITE_LEASE_SECONDS = 15 * 60  # how long a writer that never releases keeps its file
+HOSTNAME = socket.gethostname()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, owned by someone else
+    return True
+
+
+class _Blob:
+    def __init__(self, size):
+        self.size = size
+        self.last_used = time.time()
+        self.leases = {}  # owner -> lease expiry
+
+
+class ArtifactStore:
+    """Reference-counted, size-bounded blob files under root/<host>-<pid>/."""
+
+    def __init__(self, root=ARTIFACT_DIR, max_bytes=ARTIFACT_MAX_BYTES, grace=ARTIFACT_GRACE_SECONDS):
+        self.root = root
+        self.directory = os.path.join(root, f"{HOSTNAME}-{os.getpid()}")
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._blobs = {}  # path -> _Blob
+        self._bytes = 0
+        self._sweeper = None
+        self._stop = threading.Event()
+        os.makedirs(self.directory, exist_ok=True)
+        self.sweep_orphans()
+
+    def put(self, data, suffix, owner=None, lease=WRITE_LEASE_SECONDS):
+        """
+        Stores data and returns the path of its file, leased to owner until released.
+        Identical data shares one file. Without an owner the lease simply runs out.
+        """
+        owner = owner or f"write:{uuid.uuid4().hex}"
+        name = hashlib.sha256(data).hexdigest()[:32] + suffix
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            blob = self._blobs.get(path)
+            if blob is not None and os.path.exists(path):
+                blob.leases[owner] = time.time() + lease
+                blob.last_used = time.time()
+                return path
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            # Under the lock, so eviction can't remove the file between its rename and its lease
+            os.replace(temp_path, path)
+            if path not in self._blobs:
+                self._blobs[path] = _Blob(len(data))
+                self._bytes += len(data)
+            blob = self._blobs[path]
+            blob.leases[owner] = time.time() + lease
+            blob.last_used = time.time()
+            self._publish()
+        if self._bytes > self.max_bytes:
+            self.evict()
+        return path
+
+    def adopt(self, path, owner, lease=DEFAULT_LEASE_SECONDS):
+        """
+        Leases path to owner. A file outside the store (e.g. in a story cache entry) is first
+        copied in. Returns the store path, or None if the file is gone.
+        """
+        if self.acquire(path, owner, lease):
+            return path
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        return self.put(data, os.path.splitext(path)[1], owner, lease)
+
+    def acquire(self, path, owner, lease=DEFAULT_LEASE_SECONDS):
+        """
+        Records that owner (e.g. "job:<id>" or "session:<id>") is using path, for up to
+        lease seconds. Acquiring again renews the lease. Paths outside the store are ignored.
+        """
+        with self._lock:
+            blob = self._blobs.get(path) if isinstance(path, str) else None
+            if blob is None:
+                return False
+            blob.leases[owner] = time.time() + lease
+            blob.last_used = time.time()
+            return True
+
+    def release(self, path, owner):
+        with self._lock:
+            blob = self._blobs.get(path)
+            if blob is not None:
+                blob.leases.pop(owner, None)
+                blob.last_used = time.time()
+
+    def release_owner(self, owner):
+        """Drops every reference held by owner."""
+        now = time.time()
+        with self._lock:
+            for blob in self._blobs.values():
+                if blob.leases.pop(owner, None) is not None:
+                    blob.last_used = now
+
+    def discard(self, path, owner):
+        """
+        Releases owner's lease on path and deletes the file right away if nobody else holds
+        it. Returns whether it was deleted.
+        """
+        with self._lock:
+            blob = self._blobs.get(path)
+            if blob is None:
+                return False
+            blob.leases.pop(owner, None)
+            blob.last_used = time.time()
+            if self._referenced(blob, time.time()):
+                return False  # Another writer (or a reader) has the same content
+            self._remove(path, blob, "discarded")
+            self._publish()
+        return True
+
+    def _referenced(self, blob, now):
+        # Caller holds the lock; expired leases are dropped here
+        for owner, expires in list(blob.leases.items()):
+            if expires < now:
+                del blob.leases[owner]
+        return bool(blob.leases)
+
+    def _remove(self, path, blob, reason):
+        # Caller holds the lock
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        del self._blobs[path]
+        self._bytes -= blob.size
+        metrics.increment("story_artifact_evictions_total", reason=reason)
+        metrics.increment("story_artifact_evicted_bytes_total", blob.size, reason=reason)
+
+    def _publish(self):
+        # Caller holds the lock
+        metrics.set_gauge("story_artifact_bytes", self._bytes)
+        metrics.set_gauge("story_artifact_files", len(self._blobs))
+
+    def evict(self):
+        """
+        Removes unreferenced blobs past their grace period, then (oldest first) unreferenced
+        blobs still in it while the store is over quota. Returns the number removed.
+        """
+        now = time.time()
+        evicted = 0
+        with self._lock:
+            idle = sorted(
+                ((blob.last_used, path) for path, blob in self._blobs.items()
+                 if not self._referenced(blob, now)),
+            )
+            for last_used, path in idle:
+                if last_used < now - self.grace:
+                    self._remove(path, self._blobs[path], "idle")
+                elif self._bytes > self.max_bytes:
+                    self._remove(path, self._blobs[path], "quota")
+                else:
+                    continue
+                evicted += 1
+            self._publish()
+        return evicted
+
+    def sweep_orphans(self):
+        """Deletes directories left behind by processes on this host that are no longer running."""
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            host, _, pid = name.rpartition("-")
+            if host != HOSTNAME or not pid.isdigit() or int(pid) == os.getpid() or _process_alive(int(pid)):
+                continue
+            removed += sum(len(files) for _, _, files in os.walk(path))
+            shutil.rmtree(path, ignore_errors=True)
+        if removed:
+            metrics.increment("story_artifact_evictions_total", removed, reason="orphaned")
+        return removed
+
+    def start_sweeper(self, interval=ARTIFACT_SWEEP_INTERVAL):
+        """Runs evict() every interval seconds from a daemon thread (once per store)."""
+        if self._sweeper is not None or interval <= 0:
+            return
+
+        def sweep():
+            while not self._stop.wait(interval):
+                try:
+                    self.evict()
+                except Exception as e:
+                    print(f"Artifact eviction failed: {e}")
+
+        self._sweeper = threading.Thread(target=sweep, name="story-artifacts", daemon=True)
+        self._sweeper.start()
+
+    def close(self):
+        """Stops the sweeper and deletes this process's files."""
+        self._stop.set()
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._blobs.clear()
+            self._bytes = 0
+            self._publish()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            referenced = sum(1 for blob in self._blobs.values() if self._referenced(blob, now))
+            return {"files": len(self._blobs), "bytes": self._bytes, "referenced": referenced}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_artifact_store():
+    """Returns the process-wide ArtifactStore, creating it (and its sweeper) on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ArtifactStore()
+                _store.start_sweeper()
+    return _store
+
+
+def set_artifact_store(store):
+    """Replaces the process-wide ArtifactStore (e.g. with a temporary one for benchmarks)."""
+    global _store
+    _store = store
+
+
+def hold_result(result, owner, lease=DEFAULT_LEASE_SECONDS):
+    """
+    Acquires every file referenced by a story result for owner, copying files that live in
+    the story cache into the store (the result is updated to point at the copies), and
+    releases the writer's lease (result["artifact_owner"]) now that owner holds them. A file
+    that is already gone (its lease ran out and it was evicted) is set to None in the result,
+    so pages show it as unavailable instead of failing to open it.
+    """
+    store = get_artifact_store()
+    writer = result.pop("artifact_owner", None)
+    for field in ("image", "audio", "pdf"):
+        path = result.get(field)
+        if not isinstance(path, str) or "://" in path:
+            continue  # Bytes are held by the result itself; URLs aren't ours
+        result[field] = store.adopt(path, owner, lease)
+        if writer:
+            store.release(path, writer)
@@ -0,0 +1,378 @@
+"""
+Model backends used by the story pipeline.
+
+A backend covers everything the pipeline asks of the outside world: chat completions
+(plain and streamed), image generation, text-to-speech and fetching generated images.
+OpenAIBackend talks to the real API; FakeBackend is an offline, deterministic stand-in with
+configurable latency and error rate, for benchmarks and load tests.
+
+Both backends also have async versions of the model calls (achat, agenerate_image,
+aspeech), used by the async pipeline and the HTTP service; OpenAIBackend makes them with
+the async OpenAI client.
+
+Select the backend with the STORY_BACKEND environment variable ("openai" or "fake") or
+call set_backend() directly. Either way, get_backend() hands out the backend wrapped in the
+call governor.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import random
+import re
+import threading
+import time
+
+# openai, requests and PIL are imported where they are first needed: they dominate import
+# time, and the home page of the app never touches a backend.
+
+
+class BackendError(Exception):
+    """Base class for errors raised by a backend."""
+
+
+class BackendRateLimited(BackendError):
+    """The backend asked us to slow down; the call may be retried later."""
+
+
+class OpenAIBackend:
+    """Backend that calls the OpenAI API."""
+
+    name = "openai"
+
+    def __init__(self, api_key=None):
+        import openai
+        import requests
+
+        self.client = openai.OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"))
+        self.session = requests.Session()
+        self._async = None
+
+    def _client(self, timeout):
+        return self.client.with_options(timeout=timeout) if timeout else self.client
+
+    def _async_client(self, timeout):
+        # Created on first use, so it binds to the event loop that actually makes the calls
+        if self._async is None:
+            import openai
+
+            self._async = openai.AsyncOpenAI(api_key=self.client.api_key)
+        return self._async.with_options(timeout=timeout) if timeout else self._async
+
+    @staticmethod
+    def _store_usage(usage, reported):
+        usage["prompt_tokens"] = reported.prompt_tokens
+        usage["completion_tokens"] = reported.completion_tokens
+        details = getattr(reported, "prompt_tokens_details", None)
+        usage["cached_tokens"] = getattr(details, "cached_tokens", None) or 0
+
+    def chat(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        """
+        Returns the completion text. If usage is a dict, token counts (prompt, completion and
+        cached prompt tokens) are stored in it.
+        """
+        response = self._client(timeout).chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **({"max_tokens": max_tokens} if max_tokens else {})
+        )
+        if usage is not None and response.usage:
+            self._store_usage(usage, response.usage)
+        return response.choices[0].message.content
+
+    def chat_stream(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        """
+        Yields completion text pieces as they arrive. If usage is a dict, token counts are
+        stored in it once the stream is finished.
+        """
+        response = self._client(timeout).chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            **({"max_tokens": max_tokens} if max_tokens else {})
+        )
+        for event in response:
+            if event.usage and usage is not None:
+                self._store_usage(usage, event.usage)
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+
+    def generate_image(self, model, prompt, size="1024x1024", timeout=None):
+        """
+        Returns the generated image as PNG bytes. The image comes back inline (b64_json), which
+        saves a second round-trip to a URL that would expire anyway.
+        """
+        response = self._client(timeout).images.generate(
+            model=model,
+            prompt=prompt,
+            size=size,
+            n=1,
+            response_format="b64_json"
+        )
+        return base64.b64decode(response.data[0].b64_json)
+
+    def speech(self, model, voice, text, timeout=None):
+        """Returns the narration audio as MP3 bytes."""
+        response = self._client(timeout).audio.speech.create(
+            model=model,
+            voice=voice,
+            input=text
+        )
+        return response.content
+
+    def fetch(self, url, timeout=30):
+        """Downloads a generated asset and returns its bytes."""
+        response = self.session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    async def achat(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        """Async chat(), on the async OpenAI client."""
+        response = await self._async_client(timeout).chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **({"max_tokens": max_tokens} if max_tokens else {})
+        )
+        if usage is not None and response.usage:
+            self._store_usage(usage, response.usage)
+        return response.choices[0].message.content
+
+    async def agenerate_image(self, model, prompt, size="1024x1024", timeout=None):
+        """Async generate_image(), on the async OpenAI client."""
+        response = await self._async_client(timeout).images.generate(
+            model=model,
+            prompt=prompt,
+            size=size,
+            n=1,
+            response_format="b64_json"
+        )
+        return base64.b64decode(response.data[0].b64_json)
+
+    async def aspeech(self, model, voice, text, timeout=None):
+        """Async speech(), on the async OpenAI client."""
+        response = await self._async_client(timeout).audio.speech.create(
+            model=model,
+            voice=voice,
+            input=text
+        )
+        return response.content
+
+
+# One silent MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, mono. An all-zero side info block
+# decodes to silence, and frames can simply be repeated to make longer audio.
+_MP3_FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0xC4])
+_MP3_FRAME_BYTES = 417
+_MP3_FRAME_SECONDS = 1152 / 44100
+SILENT_MP3_FRAME = _MP3_FRAME_HEADER + bytes(_MP3_FRAME_BYTES - len(_MP3_FRAME_HEADER))
+
+FAKE_STORY = (
+    "Once upon a time, {name} lay snug in a cozy bed. "
+    "Outside the window, the stars went twinkle, twinkle. "
+    "[Can you twinkle your fingers like the stars?]\n\n"
+    "A soft breeze went whoosh through the garden. "
+    "{name} gave a big, slow yawn. Can you yawn too? "
+    "Mama tucked the warm blanket in, nice and snug.\n\n"
+    "{name} counted the sleepy sheep. One, two, three. "
+    "The moon smiled down, soft and bright. "
+    "Soon, {name} was fast asleep. Goodnight, {name}. Sweet dreams."
+)
+
+
+def _parse_latency(spec):
+    """Parses "chat=1.5,image=2" into {"chat": 1.5, "image": 2.0}."""
+    latency = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            operation, seconds = part.split("=", 1)
+            latency[operation.strip()] = float(seconds)
+    return latency
+
+
+class FakeBackend:
+    """
+    Offline backend returning canned stories, generated PNGs and silent MP3s.
+
+    latency maps an operation ("chat", "image", "speech", "fetch") to seconds of simulated
+    delay; a streamed chat spreads its delay over the pieces. error_rate is the probability
+    that a call raises BackendRateLimited. Output is deterministic for a given input, and
+    seed makes latency jitter and injected errors reproducible too.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency=None, error_rate=0.0, jitter=0.1, seed=None):
+        self.latency = dict(latency or {})
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._seen_prefixes = set()
+
+    def _roll(self):
+        with self._random_lock:
+            return self._random.random()
+
+    def _seconds(self, operation, fraction=1.0):
+        seconds = self.latency.get(operation, 0.0) * fraction
+        return seconds * (1 + self.jitter * (2 * self._roll() - 1)) if seconds > 0 else 0.0
+
+    def _delay(self, operation, fraction=1.0):
+        seconds = self._seconds(operation, fraction)
+        if seconds:
+            time.sleep(seconds)
+
+    async def _adelay(self, operation):
+        seconds = self._seconds(operation)
+        if seconds:
+            await asyncio.sleep(seconds)
+
+    def _maybe_fail(self, operation):
+        if self.error_rate and self._roll() < self.error_rate:
+            raise BackendRateLimited(f"Injected {operation} failure")
+
+    def _story_text(self, messages, max_tokens=None):
+        prompt = messages[-1]["content"]
+        topic = re.search(r"years old about (.*)\.", prompt)
+        if topic and re.search(r"\b(battles?|wars?|monsters?|evil|scary)\b", topic.group(1), re.I):
+            return "Sorry, I cannot create a story on this topic."
+        # Use the requested main character (or template placeholder) when the prompt names one
+        match = re.search(r"Make (.+?) the main character of the story\.", prompt)
+        story = FAKE_STORY.format(name=match.group(1) if match else "Little Bear")
+        # Medium stories are roughly twice as long as short ones
+        if "Story length: MEDIUM" in prompt:
+            story = story + "\n\n" + story
+        if max_tokens and len(story.split()) * 4 // 3 > max_tokens:
+            story = " ".join(story.split(" ")[:max_tokens * 3 // 4])  # Cut off, like a real length limit
+        return story
+
+    def _fill_usage(self, usage, messages, text):
+        # Rough token estimate (about 3/4 of a word per token), good enough for load tests.
+        # Like the real API, a system message seen before counts as a cached prompt prefix.
+        if usage is not None:
+            counts = [len(message["content"].split()) * 4 // 3 for message in messages]
+            usage["prompt_tokens"] = sum(counts)
+            usage["completion_tokens"] = len(text.split()) * 4 // 3
+            prefix = messages[0]["content"] if len(messages) > 1 and messages[0]["role"] == "system" else None
+            usage["cached_tokens"] = counts[0] if prefix in self._seen_prefixes else 0
+            if prefix is not None:
+                self._seen_prefixes.add(prefix)
+
+    def chat(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        self._maybe_fail("chat")
+        self._delay("chat")
+        text = self._story_text(messages, max_tokens)
+        self._fill_usage(usage, messages, text)
+        return text
+
+    def chat_stream(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        self._maybe_fail("chat")
+        text = self._story_text(messages, max_tokens)
+        pieces = re.findall(r"\S+\s*", text)
+        for piece in pieces:
+            self._delay("chat", 1 / len(pieces))
+            yield piece
+        self._fill_usage(usage, messages, text)
+
+    def generate_image(self, model, prompt, size="1024x1024", timeout=None):
+        self._maybe_fail("image")
+        self._delay("image")
+        return self._render_image(prompt, size)
+
+    def _render_image(self, prompt, size):
+        from PIL import Image, ImageDraw
+
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        width, height = (int(value) for value in size.split("x"))
+        # A night-sky gradient with a moon, coloured by the prompt hash
+        image = Image.new("RGB", (width, height))
+        draw = ImageDraw.Draw(image)
+        tint = int(digest[:2], 16)
+        for y in range(height):
+            shade = y * 120 // height
+            draw.line([(0, y), (width, y)], fill=(20 + shade // 3, 20 + shade // 2, 60 + shade + tint // 4))
+        radius = width // 8
+        draw.ellipse([width - 3 * radius, radius, width - radius, 3 * radius], fill=(250, 240, 200))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def speech(self, model, voice, text, timeout=None):
+        self._maybe_fail("speech")
+        self._delay("speech")
+        return self._silence(text)
+
+    def _silence(self, text):
+        # Roughly the length a narrator would take: ~15 characters per second
+        frames = max(1, int(len(text) / 15 / _MP3_FRAME_SECONDS))
+        return SILENT_MP3_FRAME * frames
+
+    def fetch(self, url, timeout=30):
+        self._maybe_fail("fetch")
+        self._delay("fetch")
+        # Any URL "downloads" as a placeholder illustration derived from the URL
+        return self.generate_image("fake", url, size="256x256")
+
+    async def achat(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        self._maybe_fail("chat")
+        await self._adelay("chat")
+        text = self._story_text(messages, max_tokens)
+        self._fill_usage(usage, messages, text)
+        return text
+
+    async def agenerate_image(self, model, prompt, size="1024x1024", timeout=None):
+        self._maybe_fail("image")
+        await self._adelay("image")
+        # Drawing the placeholder stands in for work done on the provider's side, so keep
+        # it off the event loop
+        return await asyncio.to_thread(self._render_image, prompt, size)
+
+    async def aspeech(self, model, voice, text, timeout=None):
+        self._maybe_fail("speech")
+        await self._adelay("speech")
+        return self._silence(text)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name=None):
+    """Builds the backend named by name or the STORY_BACKEND environment variable."""
+    name = (name or os.getenv("STORY_BACKEND", "openai")).lower()
+    if name == "openai":
+        return OpenAIBackend()
+    if name == "fake":
+        return FakeBackend(
+            latency=_parse_latency(os.getenv("STORY_FAKE_LATENCY")),
+            error_rate=float(os.getenv("STORY_FAKE_ERROR_RATE", "0")),
+            seed=os.getenv("STORY_FAKE_SEED"),
+        )
+    raise ValueError(f"Unknown story backend: {name}")
+
+
+def get_backend():
+    """
+    Returns the process-wide backend, creating it on first use. Calls go through the call
+    governor (rate limits, retries, deadlines; see governor.py).
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                from governor import govern
+                _backend = govern(create_backend())
+    return _backend
+
+
+def set_backend(backend, governed=True):
+    """Replaces the process-wide backend (e.g. with a FakeBackend for benchmarks)."""
+    global _backend
+    if governed:
+        from governor import govern
+        backend = govern(backend)
+    _backend = backend
@@ -0,0 +1,289 @@
+"""
+Offline batch generation for pre-warming the story cache.
+
+Usage:
+    python -m story_generator batch                     # every topic x tone x length on the home page
+    python -m story_generator batch --input reqs.jsonl  # one request per line
+
+Each JSONL line is an object with either "topic" (the full story idea) or "topic" + "tone"
+(+ optional "details"), plus optional "length" and "child_name", or "template": true to fill
+the name-free template tier that personalized requests are served from. The matrix warms
+both the unnamed story and the template for every combination. Results go into the shared
+story cache that the app serves from. Progress is appended to a JSONL file so an interrupted
+run picks up where it left off. With --storybook, every story is also rendered into a single
+storybook PDF, from the cache only: a story missing from it is left out, not regenerated.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import governor
+import pdf_renderer
+import story_generator
+from story_cache import CACHE_DIR, make_cache_key
+
+DEFAULT_PROGRESS_FILE = os.path.join(CACHE_DIR, "batch_progress.jsonl")
+
+
+def retryable_errors():
+    """
+    Errors worth retrying at the batch level. The call governor already retries each model
+    call; these are what is left once it gives up.
+    """
+    return governor.retryable_errors() + (governor.CircuitOpen, governor.DeadlineExceeded)
+
+# Timing keys reported per stage
+REPORT_STAGES = ["story_generation", "image_generation", "audio_generation", "pdf_generation", "total_time"]
+
+
+class IncompleteResult(Exception):
+    """Raised when a story came back without its image, audio or PDF (a stage failed), or a template without its image."""
+
+
+def matrix_requests():
+    """
+    Enumerates every topic x tone x length combination offered in the app, each as an
+    unnamed story and as the template that requests with a child's name are served from.
+    """
+    requests = []
+    for topic in story_generator.STORY_TOPICS:
+        for tone in story_generator.STORY_TONES:
+            for length in story_generator.STORY_LENGTHS:
+                for template in (False, True):
+                    requests.append({
+                        "topic": story_generator.build_story_topic(topic, tone),
+                        "length": length,
+                        "child_name": "",
+                        "template": template,
+                    })
+    return requests
+
+
+def load_requests(path):
+    """Reads batch requests from a JSONL file."""
+    requests = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "topic" not in entry:
+                raise ValueError(f"{path}:{line_number}: missing 'topic'")
+            topic = entry["topic"]
+            if entry.get("tone"):
+                topic = story_generator.build_story_topic(topic, entry["tone"], entry.get("details", ""))
+            requests.append({
+                "topic": topic,
+                "length": entry.get("length", "short").lower(),
+                "child_name": entry.get("child_name", ""),
+                "template": bool(entry.get("template")),
+            })
+    return requests
+
+
+def request_id(request):
+    if request.get("template"):
+        return story_generator._template_key(request["topic"], request["length"])
+    return make_cache_key(request["topic"], story_generator.STORY_MODEL, request["length"], request["child_name"])
+
+
+def load_progress(path):
+    """Returns the ids of requests already completed by an earlier run."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Partially written line from an interrupted run
+            if entry.get("status") == "done":
+                done.add(entry["id"])
+    return done
+
+
+def run_request(request, retries=5, base_delay=2.0):
+    """
+    Generates one story (or template), retrying rate-limited or incomplete attempts.
+    Returns (result, attempts).
+    """
+    attempt = 0
+    while True:
+        try:
+            if request.get("template"):
+                result = story_generator.generate_story_template(request["topic"], request["length"])
+                fields, failure = ("image",), "image generation failed, or the story didn't use the name placeholder"
+            else:
+                result = story_generator.generate_story_and_image(
+                    request["topic"], request["length"], request["child_name"]
+                )
+                fields, failure = ("image", "audio", "pdf"), "image, audio or PDF generation failed"
+            refused = story_generator.REFUSAL_MESSAGE in result["story"]
+            if not refused and not all(result.get(field) for field in fields):
+                raise IncompleteResult(failure)
+            return result, attempt + 1
+        except retryable_errors() + (IncompleteResult,) as e:
+            if attempt >= retries:
+                raise
+            delay = governor.retry_delay(e, attempt, base_delay)
+            print(f"Retrying {request['topic']!r} in {delay:.1f}s after: {e}")
+            time.sleep(delay)
+            attempt += 1
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def build_report(records, elapsed, skipped):
+    """Summarizes throughput and per-stage latency for a batch run."""
+    done = [record for record in records if record["status"] == "done"]
+    report = {
+        "requests": len(records) + skipped,
+        "completed": len(done),
+        "failed": len(records) - len(done),
+        "skipped": skipped,
+        "from_cache": sum(1 for record in done if record["timings"].get("from_cache")),
+        "retries": sum(record["attempts"] - 1 for record in records),
+        "elapsed_seconds": round(elapsed, 2),
+        "requests_per_minute": round(len(done) / elapsed * 60, 2) if elapsed else 0.0,
+        "tokens": {kind: sum(record["timings"].get(f"{kind}_tokens") or 0 for record in done)
+                   for kind in ("prompt", "completion", "cached")},
+        "stages": {},
+    }
+    stage_values = {stage: [] for stage in REPORT_STAGES + ["request"]}
+    for record in done:
+        for stage in REPORT_STAGES:
+            if stage in record["timings"]:
+                stage_values[stage].append(record["timings"][stage])
+        stage_values["request"].append(record["wall_time"])
+    for stage, values in stage_values.items():
+        if values:
+            report["stages"][stage] = {
+                "count": len(values),
+                "p50": round(percentile(values, 50), 3),
+                "p95": round(percentile(values, 95), 3),
+            }
+    return report
+
+
+def print_report(report):
+    print("=" * 60)
+    print("📦 BATCH GENERATION REPORT")
+    print("=" * 60)
+    print(f"Requests: {report['requests']} (completed {report['completed']}, failed {report['failed']}, "
+          f"skipped {report['skipped']}, from cache {report['from_cache']})")
+    print(f"Retries: {report['retries']}")
+    print(f"Elapsed: {report['elapsed_seconds']}s")
+    print(f"Throughput: {report['requests_per_minute']} requests/min")
+    tokens = report["tokens"]
+    print(f"Tokens: {tokens['prompt']} prompt ({tokens['cached']} cached), {tokens['completion']} completion")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<18} p50 {stats['p50']:>8}s   p95 {stats['p95']:>8}s   (n={stats['count']})")
+    print("=" * 60)
+
+
+def run_batch(requests, concurrency=4, progress_file=DEFAULT_PROGRESS_FILE, resume=True, retries=5):
+    """Generates every request with bounded concurrency and returns the report dictionary."""
+    done_ids = load_progress(progress_file) if resume else set()
+    pending = [request for request in requests if request_id(request) not in done_ids]
+    skipped = len(requests) - len(pending)
+
+    os.makedirs(os.path.dirname(progress_file) or ".", exist_ok=True)
+    progress_lock = threading.Lock()
+    records = []
+
+    def work(request):
+        start = time.perf_counter()
+        record = {"id": request_id(request), "topic": request["topic"], "length": request["length"],
+                  "child_name": request["child_name"], "attempts": 1, "timings": {}}
+        try:
+            result, record["attempts"] = run_request(request, retries=retries)
+            record["status"] = "done"
+            record["timings"] = result["timings"]
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = str(e)
+            record["attempts"] = retries + 1
+        record["wall_time"] = time.perf_counter() - start
+        with progress_lock:
+            with open(progress_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(work, request) for request in pending]
+        for count, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            records.append(record)
+            print(f"[{count}/{len(pending)}] {record['status']}: {record['topic']} ({record['length']})")
+    return build_report(records, time.perf_counter() - start, skipped)
+
+
+def write_storybook(requests, path):
+    """
+    Renders every cached story among requests into one storybook PDF. Stories are only read
+    from the cache (a failed or evicted one is skipped, never regenerated). Returns the page count.
+    """
+    stories = []
+    missing = 0
+    for request in requests:
+        if request.get("template"):
+            continue
+        result = story_generator.get_cached_story(request["topic"], request["length"], request["child_name"])
+        if result is None:
+            missing += 1
+            continue
+        if story_generator.REFUSAL_MESSAGE in result["story"]:
+            continue
+        image_bytes = None
+        if result.get("image"):
+            image_bytes = story_generator._read_image_bytes(result["image"])
+        stories.append((request["topic"], result["story"], image_bytes))
+    pdf_bytes, pages = pdf_renderer.render_storybook(stories)
+    with open(path, "wb") as f:
+        f.write(pdf_bytes)
+    print(f"Wrote {len(stories)} stories ({pages} pages) to {path}"
+          + (f"; {missing} not in the cache were left out" if missing else ""))
+    return pages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m story_generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    batch = commands.add_parser("batch", help="Pre-generate stories into the shared cache")
+    batch.add_argument("--input", help="JSONL file of requests (default: the full topic x tone x length matrix)")
+    batch.add_argument("--concurrency", type=int, default=4, help="Requests generated at the same time")
+    batch.add_argument("--retries", type=int, default=5, help="Retries per request on rate limits or failed stages")
+    batch.add_argument("--progress", default=DEFAULT_PROGRESS_FILE, help="Progress file used to resume runs")
+    batch.add_argument("--restart", action="store_true", help="Ignore earlier progress and redo every request")
+    batch.add_argument("--report", help="Also write the throughput report to this JSON file")
+    batch.add_argument("--storybook", help="Also render every generated story into this one PDF")
+    args = parser.parse_args(argv)
+
+    requests = load_requests(args.input) if args.input else matrix_requests()
+    report = run_batch(requests, concurrency=args.concurrency, progress_file=args.progress,
+                       resume=not args.restart, retries=args.retries)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.storybook:
+        write_storybook(requests, args.storybook)
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
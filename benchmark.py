@@ -0,0 +1,526 @@
+"""
+Benchmarks for the story pipeline, PDF rendering (single stories and storybooks) and the
+story cache.
+
+Everything runs against the offline FakeBackend, so results are reproducible and only
+measure our own overhead plus whatever latency is injected with --latency.
+
+Usage:
+    python benchmark.py                                   # full suite, summary on stdout
+    python benchmark.py --output bench.json               # also write machine-readable results
+    python benchmark.py --compare old.json --output new.json
+    python benchmark.py --latency chat=2,image=8,speech=4 --concurrency 1,16,64
+
+Reported per scenario: throughput, p50/p95/p99 latency, peak RSS and traced allocation
+bytes per request (measured in a separate sequential pass so tracing doesn't skew latency).
+Storybook scenarios also report pages/sec and allocated bytes per page. The similarity
+scenario fills the near-duplicate index with --similarity-entries requests and reports the hit
+rate on reworded requests and the false-hit rate on unrelated ones. The media scenario times
+illustration renditions and reports the bytes a story page sends per story (illustration,
+narration and PDF) as generated originally and as served now (see media.py).
+
+Startup cost is measured too: the median -X importtime cost of importing the modules the app
+loads at startup, in a fresh interpreter. The run fails (exit 1) when it exceeds
+--import-budget, so it can gate CI:
+
+    python benchmark.py --imports-only --import-budget 250
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import media
+import narration
+import pdf_renderer
+import screening
+import similarity
+import story_cache
+import story_generator
+from artifact_store import ArtifactStore, set_artifact_store
+from backends import FakeBackend, _parse_latency, set_backend
+
+TRACED_REQUESTS = 5
+
+# Modules app.py imports when a Streamlit process starts, and the budget for importing them
+STARTUP_MODULES = ["metrics", "artifact_store", "jobs", "story_generator"]
+IMPORT_BUDGET_MS = 250
+IMPORT_RUNS = 5
+
+SIMILARITY_TOPICS = ["A calm story about Space", "A funny story about Animals", "An adventurous story about Pirates"]
+SIMILARITY_WORDS = ("bunny moon rocket star dragon castle garden teddy bear kitten puppy ocean forest "
+                    "princess robot train balloon rainbow cloud owl fox lighthouse boat island snow "
+                    "picnic friend grandma cookie blanket lantern firefly meadow river bridge").split()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def allocated_bytes_per_request(func, calls):
+    """Average peak traced allocation of func over the given calls (a list of argument tuples)."""
+    tracemalloc.start()
+    try:
+        total = 0
+        for args in calls:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func(*args)
+            total += tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return int(total / len(calls))
+
+
+def measure(name, params, func, calls, concurrency):
+    """Runs func over calls with the given concurrency and returns a scenario result."""
+    latencies = []
+
+    def timed(args):
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        for args in calls:
+            timed(args)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, calls))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "name": name,
+        "params": dict(params, concurrency=concurrency, requests=len(calls)),
+        "throughput_rps": round(len(calls) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _pipeline_calls(count, length, unique):
+    # Unique topics force cache misses; repeated topics hit once warmed
+    prefix = uuid.uuid4().hex[:8] if unique else "warm"
+    return [(f"A calm story about space {prefix}-{i}", length, "") for i in range(count)]
+
+
+def bench_pipeline(lengths, concurrency_levels, requests):
+    """generate_story_and_image with a cold and a warm cache."""
+    results = []
+    for length in lengths:
+        for concurrency in concurrency_levels:
+            cold_calls = _pipeline_calls(requests, length, unique=True)
+            result = measure("pipeline", {"length": length, "cache": "cold"},
+                             story_generator.generate_story_and_image, cold_calls, concurrency)
+            result["alloc_bytes_per_request"] = allocated_bytes_per_request(
+                story_generator.generate_story_and_image, _pipeline_calls(TRACED_REQUESTS, length, unique=True))
+            results.append(result)
+
+            # Warm: the same requests again, now served from the cache
+            result = measure("pipeline", {"length": length, "cache": "warm"},
+                             story_generator.generate_story_and_image, cold_calls, concurrency)
+            result["alloc_bytes_per_request"] = allocated_bytes_per_request(
+                story_generator.generate_story_and_image, cold_calls[:TRACED_REQUESTS])
+            results.append(result)
+    return results
+
+
+def bench_pdf(lengths, requests, image_path):
+    """generate_pdf on its own, with and without an illustration."""
+    backend = FakeBackend()
+    results = []
+    for length in lengths:
+        story = backend.chat("bench", [{"role": "user", "content": f"Story length: {length.upper()}"}])
+        for with_image in (True, False):
+            calls = [("Space", story, image_path if with_image else None)] * requests
+            result = measure("pdf", {"length": length, "image": with_image},
+                             story_generator.generate_pdf, calls, 1)
+            result["alloc_bytes_per_request"] = allocated_bytes_per_request(
+                story_generator.generate_pdf, calls[:TRACED_REQUESTS])
+            results.append(result)
+    return results
+
+
+def _render_storybook_cold(stories):
+    pdf_renderer.layout_text.cache_clear()
+    return pdf_renderer.render_storybook(stories)
+
+
+def bench_storybook(lengths, stories_per_book, image_bytes):
+    """render_storybook with a cold and a warm layout cache, reported per page."""
+    backend = FakeBackend()
+    results = []
+    for length in lengths:
+        story = backend.chat("bench", [{"role": "user", "content": f"Story length: {length.upper()}"}])
+        stories = [(f"Space {i}", f"{story}\n\nChapter {i}.", image_bytes) for i in range(stories_per_book)]
+        _, pages = pdf_renderer.render_storybook(stories)
+        for layout, func in (("cold", _render_storybook_cold), ("warm", pdf_renderer.render_storybook)):
+            calls = [(stories,)] * TRACED_REQUESTS
+            result = measure("storybook", {"length": length, "stories": stories_per_book, "layout": layout},
+                             func, calls, 1)
+            result["alloc_bytes_per_request"] = allocated_bytes_per_request(func, calls[:2])
+            result["pages"] = pages
+            result["pages_per_sec"] = round(pages * result["throughput_rps"], 1)
+            result["alloc_bytes_per_page"] = result["alloc_bytes_per_request"] // pages
+            results.append(result)
+    return results
+
+
+def bench_cache(requests):
+    """Raw story cache lookups: hits and misses."""
+    cache = story_cache.get_cache()
+    keys = [story_cache.make_cache_key(f"cache bench {i}", "bench", "short", "") for i in range(requests)]
+    for key in keys:
+        cache.put(key, {"story": "Once upon a time.", "timings": {}})
+    missing = [story_cache.make_cache_key(f"missing {i}", "bench", "short", "") for i in range(requests)]
+
+    results = []
+    for label, lookup_keys in (("hit", keys), ("miss", missing)):
+        calls = [(key,) for key in lookup_keys]
+        result = measure("cache_lookup", {"outcome": label}, cache.get, calls, 1)
+        result["alloc_bytes_per_request"] = allocated_bytes_per_request(cache.get, calls[:TRACED_REQUESTS])
+        results.append(result)
+    return results
+
+
+def bench_prescreen(requests):
+    """The local refused-topic pre-screen: keyword matches, refusal cache hits and topics passed on."""
+    refused = story_generator.build_story_topic("Space", "calm", "a monster party")
+    screening.remember_refusal(refused)
+    topics = {
+        "keyword": [story_generator.build_story_topic("Space", "calm", f"a gory robot number {i}") for i in range(requests)],
+        "refusal_cache": [refused] * requests,
+        "passed": [story_generator.build_story_topic("Space", "calm", f"a bunny number {i}") for i in range(requests)],
+    }
+    results = []
+    for outcome, outcome_topics in topics.items():
+        calls = [(topic,) for topic in outcome_topics]
+        result = measure("prescreen", {"outcome": outcome}, screening.screen, calls, 1)
+        result["alloc_bytes_per_request"] = allocated_bytes_per_request(screening.screen, calls[:TRACED_REQUESTS])
+        results.append(result)
+    return results
+
+
+def _similarity_details(rng):
+    return " ".join(rng.sample(SIMILARITY_WORDS, rng.randint(3, 6)))
+
+
+def _reword(details, rng):
+    # The kind of variation people type: case, articles, plurals and punctuation
+    words = details.split()
+    words[0] = words[0].capitalize()
+    i = rng.randrange(len(words))
+    words[i] = words[i] + "s"
+    return "the " + " ".join(f"{word}," if rng.random() < 0.2 else word for word in words) + "!"
+
+
+def bench_similarity(entries, lookups):
+    """Near-duplicate lookups against an index of `entries` requests."""
+    import random
+
+    rng = random.Random(0)
+    index = similarity.get_similarity_index()
+    requests = []
+    for i in range(entries):
+        topic = f"{SIMILARITY_TOPICS[i % len(SIMILARITY_TOPICS)]} - {_similarity_details(rng)}"
+        key = story_cache.make_cache_key(topic, "bench", "short", "")
+        index.add(key, "story", topic, "short", "")
+        requests.append((key, topic))
+
+    results = []
+    reworded = []
+    for key, topic in rng.sample(requests, lookups):
+        base, details = topic.split(" - ", 1)
+        reworded.append((key, f"{base} - {_reword(details, rng)}"))
+    unrelated = [(None, f"{SIMILARITY_TOPICS[0]} - {_similarity_details(rng)} {rng.randrange(10 ** 6)}")
+                 for _ in range(lookups)]
+    for label, queries in (("reworded", reworded), ("unrelated", unrelated)):
+        found = []
+
+        def lookup(query):
+            found.append(index.nearest("story", query, "short", "")[0])
+
+        result = measure("similarity_lookup", {"entries": entries, "queries": label}, lookup,
+                         [(topic,) for _, topic in queries], 1)
+        result["alloc_bytes_per_request"] = allocated_bytes_per_request(
+            lambda query: index.nearest("story", query, "short", ""), [(topic,) for _, topic in queries[:TRACED_REQUESTS]])
+        if label == "reworded":
+            result["hit_rate"] = round(sum(hit == key for hit, (key, _) in zip(found, queries)) / len(queries), 3)
+        else:
+            result["false_hit_rate"] = round(sum(hit is not None for hit in found) / len(queries), 3)
+        results.append(result)
+    return results
+
+
+def _photo_like_png(size=1024):
+    # The fake backend's flat gradients compress far better than a real illustration; noise
+    # brings the PNG up to the 1-3 MB DALL·E returns
+    import numpy
+    from PIL import Image
+
+    rng = numpy.random.default_rng(0)
+    gradient = numpy.linspace(0, 255, size)[None, :, None] * numpy.ones((size, 1, 3))
+    pixels = numpy.clip(gradient + rng.normal(0, 20, (size, size, 3)), 0, 255).astype("uint8")
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _pdf_with_raw_image(title, story, image_bytes):
+    # The PDF as it was rendered before illustrations were embedded as JPEG: seed the
+    # thumbnail memo with a PNG, which reportlab embeds as raw pixels
+    from PIL import Image
+
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    img.thumbnail((pdf_renderer.IMAGE_PIXELS, pdf_renderer.IMAGE_PIXELS), Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    with pdf_renderer._thumbnails_lock:
+        pdf_renderer._thumbnails[digest] = buffer.getvalue()
+    try:
+        return pdf_renderer.render_story_pdf(title, story, image_bytes)
+    finally:
+        with pdf_renderer._thumbnails_lock:
+            pdf_renderer._thumbnails.pop(digest, None)
+
+
+def bench_media(lengths, requests):
+    """Illustration renditions (cold and cached), and bytes sent per story before and after."""
+    backend = FakeBackend()
+    image_bytes = _photo_like_png()
+    results = []
+    for fmt in media.IMAGE_FORMATS:
+        sources = [(image_bytes + uuid.uuid4().bytes, media.DISPLAY_WIDTH, fmt) for _ in range(TRACED_REQUESTS)]
+        for cache, calls in (("cold", sources), ("warm", [sources[0]] * requests)):
+            result = measure("rendition", {"format": fmt, "cache": cache}, media.image_rendition, calls, 1)
+            result["alloc_bytes_per_request"] = allocated_bytes_per_request(media.image_rendition, calls[:2])
+            results.append(result)
+
+    encoded = narration._can_decode()
+    for length in lengths:
+        story = backend.chat("bench", [{"role": "user", "content": f"Story length: {length.upper()}"}])
+        api_audio = narration.synthesize(story, encode=False)
+        if encoded:
+            served_audio = len(narration.join_audio([api_audio]))
+        else:
+            # No ffmpeg here: estimate the encode from the narration's duration
+            seconds = len(api_audio) * 8 / 128000
+            served_audio = int(seconds * int(media.AUDIO_BITRATE.rstrip("k")) * 1000 / 8)
+        display = media.image_rendition(image_bytes, media.DISPLAY_WIDTH)
+        result = measure("story_media", {"length": length}, media.image_rendition,
+                         [(image_bytes, media.DISPLAY_WIDTH)] * requests, 1)
+        result["alloc_bytes_per_request"] = allocated_bytes_per_request(
+            media.image_rendition, [(image_bytes, media.DISPLAY_WIDTH)] * 2)
+        result["media_bytes"] = {
+            "image": {"before": len(image_bytes), "after": len(display)},
+            "audio": {"before": len(api_audio), "after": served_audio, "estimated": not encoded,
+                      "format": media.AUDIO_FORMAT, "bitrate": media.AUDIO_BITRATE},
+            "pdf": {"before": len(_pdf_with_raw_image("Space", story, image_bytes)),
+                    "after": len(pdf_renderer.render_story_pdf("Space", story, image_bytes))},
+        }
+        results.append(result)
+    return results
+
+
+def _parse_importtime(stderr):
+    """Parses -X importtime output into (module, depth, cumulative microseconds) tuples."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # The header line
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), depth, int(fields[1])))
+    return entries
+
+
+def bench_imports(modules=STARTUP_MODULES, runs=IMPORT_RUNS):
+    """Import cost of the app's startup modules in a fresh interpreter, via -X importtime."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = {key: value for key, value in os.environ.items() if key != "STORY_METRICS_PORT"}
+    totals = []
+    heaviest = {}
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+                                 capture_output=True, text=True, cwd=root, env=env)
+        if process.returncode:
+            raise RuntimeError(f"Importing {modules} failed:\n{process.stderr[-2000:]}")
+        entries = _parse_importtime(process.stderr)
+        totals.append(sum(cumulative for name, depth, cumulative in entries if depth == 0 and name in modules))
+        # Direct dependencies of our modules, to show what to make lazy next
+        for name, depth, cumulative in entries:
+            if depth == 1:
+                heaviest[name] = max(heaviest.get(name, 0), cumulative)
+    return {
+        "modules": modules,
+        "runs": runs,
+        "import_ms": round(percentile(totals, 50) / 1000, 1),
+        "heaviest_ms": {name: round(us / 1000, 1) for name, us in
+                        sorted(heaviest.items(), key=lambda item: -item[1])[:5]},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline_by_key = {}
+    for entry in (baseline or {}).get("scenarios", []):
+        baseline_by_key[json.dumps([entry["name"], entry["params"]], sort_keys=True)] = entry
+
+    print("=" * 110)
+    print(f"{'scenario':<68} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'alloc KB':>9}")
+    print("=" * 110)
+    for entry in results["scenarios"]:
+        params = ", ".join(f"{key}={value}" for key, value in entry["params"].items())
+        label = f"{entry['name']} ({params})"
+        line = (f"{label:<68} {entry['throughput_rps']:>9} {entry['latency_ms']['p50']:>9} "
+                f"{entry['latency_ms']['p95']:>9} {entry['latency_ms']['p99']:>9} "
+                f"{entry['alloc_bytes_per_request'] // 1024:>9}")
+        previous = baseline_by_key.get(json.dumps([entry["name"], entry["params"]], sort_keys=True))
+        if previous and previous["latency_ms"]["p95"]:
+            change = (entry["latency_ms"]["p95"] - previous["latency_ms"]["p95"]) / previous["latency_ms"]["p95"]
+            line += f"   p95 {change:+.0%} vs {baseline.get('commit') or 'baseline'}"
+        print(line)
+    print("=" * 110)
+    startup = results.get("startup")
+    if startup:
+        line = f"Startup imports ({', '.join(startup['modules'])}): {startup['import_ms']} ms"
+        previous = (baseline or {}).get("startup")
+        if previous and previous.get("import_ms"):
+            line += f" ({(startup['import_ms'] - previous['import_ms']) / previous['import_ms']:+.0%} vs " \
+                    f"{baseline.get('commit') or 'baseline'})"
+        print(line)
+        print("  heaviest: " + ", ".join(f"{name} {ms} ms" for name, ms in startup["heaviest_ms"].items()))
+    for entry in results["scenarios"]:
+        if "hit_rate" in entry or "false_hit_rate" in entry:
+            params = ", ".join(f"{key}={value}" for key, value in entry["params"].items())
+            rate = f"hit rate {entry['hit_rate']:.1%}" if "hit_rate" in entry else \
+                f"false hit rate {entry['false_hit_rate']:.1%}"
+            print(f"{entry['name']} ({params}): {rate}")
+        if "media_bytes" in entry:
+            params = ", ".join(f"{key}={value}" for key, value in entry["params"].items())
+            sizes = entry["media_bytes"]
+            parts = []
+            for kind in ("image", "audio", "pdf"):
+                before, after = sizes[kind]["before"], sizes[kind]["after"]
+                note = " est." if sizes[kind].get("estimated") else ""
+                parts.append(f"{kind} {before // 1024} -> {after // 1024} KB{note}")
+            total_before = sum(size["before"] for size in sizes.values())
+            total_after = sum(size["after"] for size in sizes.values())
+            print(f"{entry['name']} ({params}): {', '.join(parts)}; "
+                  f"{total_before // 1024} -> {total_after // 1024} KB per story ({total_after / total_before - 1:+.0%})")
+        if "pages_per_sec" in entry:
+            params = ", ".join(f"{key}={value}" for key, value in entry["params"].items())
+            print(f"{entry['name']} ({params}): {entry['pages']} pages, {entry['pages_per_sec']} pages/s, "
+                  f"{entry['alloc_bytes_per_page'] // 1024} KB allocated per page")
+    print(f"Peak RSS: {peak_rss_mb()} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=64, help="Requests per scenario")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="Comma-separated concurrency levels")
+    parser.add_argument("--lengths", default="short,medium", help="Comma-separated story lengths")
+    parser.add_argument("--latency", default="", help='Injected backend latency, e.g. "chat=2,image=8,speech=4"')
+    parser.add_argument("--storybook-stories", type=int, default=20, help="Stories per storybook PDF")
+    parser.add_argument("--similarity-entries", type=int, default=20000,
+                        help="Requests in the near-duplicate index for the similarity scenario")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_MS,
+                        help="Fail (exit 1) if importing the app's startup modules takes longer (ms)")
+    parser.add_argument("--imports-only", action="store_true", help="Only measure startup import time")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Earlier JSON results to compare p95 latency against")
+    args = parser.parse_args(argv)
+
+    lengths = [length.strip() for length in args.lengths.split(",") if length.strip()]
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+
+    startup = bench_imports()
+    work_dir = tempfile.mkdtemp(prefix="story_bench_")
+    try:
+        backend = FakeBackend(latency=_parse_latency(args.latency), seed=0)
+        set_backend(backend)
+        story_cache.set_cache(story_cache.StoryCache(os.path.join(work_dir, "cache")))
+        set_artifact_store(ArtifactStore(os.path.join(work_dir, "artifacts")))
+        narration.set_chunk_cache(story_cache.StoryCache(os.path.join(work_dir, "tts")))
+        screening.set_refusal_cache(screening.RefusalCache(os.path.join(work_dir, "refusals.sqlite3")))
+        similarity.set_similarity_index(similarity.SimilarityIndex(os.path.join(work_dir, "similarity.sqlite3")))
+        media.set_rendition_cache(story_cache.StoryCache(os.path.join(work_dir, "renditions")))
+
+        image_bytes = backend.generate_image("bench", "benchmark illustration")
+        image_path = os.path.join(work_dir, "image.png")
+        with open(image_path, "wb") as f:
+            f.write(image_bytes)
+
+        scenarios = []
+        if not args.imports_only:
+            scenarios += bench_pipeline(lengths, concurrency_levels, args.requests)
+            scenarios += bench_pdf(lengths, args.requests, image_path)
+            scenarios += bench_storybook(lengths, args.storybook_stories, image_bytes)
+            scenarios += bench_cache(args.requests)
+            scenarios += bench_prescreen(args.requests)
+            scenarios += bench_similarity(args.similarity_entries, args.requests)
+            scenarios += bench_media(lengths, args.requests)
+        results = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend_latency": backend.latency,
+            "startup": startup,
+            "scenarios": scenarios,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if startup["import_ms"] > args.import_budget:
+        print(f"Startup imports take {startup['import_ms']} ms, over the {args.import_budget:g} ms budget")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,551 @@
+"""
+Call governor for model backend calls.
+
+GovernedBackend wraps a backend (see backends.py) and puts every call through:
+
+- per-endpoint token buckets for requests per minute and, for chat, tokens per minute.
+  Chat token use is estimated up front and corrected from the reported usage afterwards;
+  the tokens reserved for an attempt that fails are given back.
+- a per-endpoint cap on concurrent upstream calls;
+- retries of rate-limit, timeout and server errors, with jittered exponential backoff that
+  honours Retry-After;
+- a deadline per call, covering queueing, retries and the upstream timeout;
+- a circuit breaker that fails fast while an endpoint keeps erroring. It counts logical
+  calls, not attempts: a call that fails after all its retries is one failure;
+- coalescing, so identical concurrent calls (same model and input) share one upstream
+  call. Streamed chat is never coalesced.
+
+The async methods (achat, agenerate_image, aspeech) get the same treatment on the event
+loop. Rate limits and breakers are shared with the sync calls; the concurrency cap is
+counted separately for each.
+
+Limits come from DEFAULT_LIMITS and can be overridden with STORY_RATE_LIMITS, e.g.
+"chat.rpm=500,chat.tpm=30000,image.rpm=5". A limit of 0 disables it. The fake backend
+gets no rate limits unless they are set explicitly.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import sys
+import time
+from concurrent.futures import Future
+
+import metrics
+from backends import BackendError, BackendRateLimited
+
+
+def retryable_errors():
+    """
+    Errors worth retrying: rate limits, timeouts and transient server/network failures.
+    OpenAI's errors are only included once openai has been imported (by OpenAIBackend),
+    so the fake backend never pays for importing it.
+    """
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return (BackendRateLimited,)
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+        BackendRateLimited,
+    )
+
+# rpm/tpm: requests and tokens per minute; concurrency: upstream calls at once;
+# deadline: seconds a call may take in total, including waiting and retries
+DEFAULT_LIMITS = {
+    "chat": {"rpm": 500, "tpm": 30000, "concurrency": 16, "deadline": 120},
+    "image": {"rpm": 5, "concurrency": 4, "deadline": 180},
+    "speech": {"rpm": 50, "concurrency": 8, "deadline": 120},
+    "fetch": {"concurrency": 8, "deadline": 60},
+}
+RATE_LIMITS = ("rpm", "tpm")
+
+GOVERNOR_RETRIES = int(os.getenv("STORY_GOVERNOR_RETRIES", "4"))
+GOVERNOR_BASE_DELAY = float(os.getenv("STORY_GOVERNOR_BASE_DELAY", "1.0"))
+BREAKER_FAILURES = int(os.getenv("STORY_BREAKER_FAILURES", "5"))  # consecutive failed calls that open it
+BREAKER_COOLDOWN = float(os.getenv("STORY_BREAKER_COOLDOWN", "30"))  # seconds before a trial call
+
+# Completion tokens reserved for a chat call until the real usage is known
+CHAT_COMPLETION_ESTIMATE = 1000
+
+
+class DeadlineExceeded(BackendError):
+    """The call could not finish (or even start) before its deadline."""
+
+
+class CircuitOpen(BackendError):
+    """The endpoint has been failing; calls are rejected until the cooldown passes."""
+
+
+def retry_delay(error, attempt, base_delay):
+    """Honours the server's Retry-After header when present, otherwise jittered exponential backoff."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return base_delay * (2 ** attempt) * (0.5 + random.random())
+
+
+def parse_limits(spec, base):
+    """Applies "chat.rpm=500,image.rpm=5" style overrides to a copy of base."""
+    limits = {endpoint: dict(values) for endpoint, values in base.items()}
+    for part in (spec or "").split(","):
+        if "=" in part and "." in part.split("=", 1)[0]:
+            name, value = part.split("=", 1)
+            endpoint, limit = name.strip().split(".", 1)
+            limits.setdefault(endpoint, {})[limit] = float(value)
+    return limits
+
+
+def default_limits(backend_name):
+    """Limits for a backend: DEFAULT_LIMITS for real APIs, no rate limits for the fake one."""
+    base = DEFAULT_LIMITS
+    if backend_name == "fake":
+        base = {endpoint: {key: value for key, value in values.items() if key not in RATE_LIMITS}
+                for endpoint, values in DEFAULT_LIMITS.items()}
+    return parse_limits(os.getenv("STORY_RATE_LIMITS"), base)
+
+
+class TokenBucket:
+    """
+    Token bucket refilling at per_minute / 60 tokens a second, holding at most per_minute.
+    reserve() takes tokens immediately, going into debt if needed, and says how long to wait,
+    so callers are served in the order they arrive.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Takes amount tokens and returns the seconds to wait before using them."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount):
+        """Takes extra tokens (or gives some back, when amount is negative)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failed calls, then lets one trial call through per cooldown."""
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self._trial else "open"
+
+    def allow(self):
+        """Returns "closed" or "half_open" (the caller is the trial call) to let a call through, else None."""
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if not self._trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self._trial = True
+                return "half_open"
+            return None
+
+    def end_trial(self):
+        """Ends a trial call that recorded no outcome (e.g. it timed out waiting or was cancelled)."""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            self.consecutive += 1
+            if self._trial or (self.opened_at is None and self.consecutive >= self.failures):
+                self.opened_at = time.monotonic()
+                self._trial = False
+                metrics.increment("story_governor_circuit_opens_total", endpoint=endpoint)
+
+
+class _Endpoint:
+    def __init__(self, name, limits):
+        self.name = name
+        self.rpm = TokenBucket(limits["rpm"]) if limits.get("rpm") else None
+        self.tpm = TokenBucket(limits["tpm"]) if limits.get("tpm") else None
+        concurrency = int(limits.get("concurrency") or 0)
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        # Async calls have their own slots: an event loop can't wait on a thread semaphore
+        self.async_slots = asyncio.Semaphore(concurrency) if concurrency else None
+        self.deadline = limits.get("deadline") or None
+        self.breaker = CircuitBreaker()
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+
+def _call_timeout(deadline):
+    # Upstream timeout for the next attempt: whatever is left of the deadline, at least 1s
+    remaining = _remaining(deadline)
+    return None if remaining is None else max(remaining, 1.0)
+
+
+class GovernedBackend:
+    """A backend whose calls are rate limited, retried, bounded by deadlines and coalesced."""
+
+    def __init__(self, backend, limits=None, retries=GOVERNOR_RETRIES, base_delay=GOVERNOR_BASE_DELAY):
+        self.backend = backend
+        self.name = backend.name
+        self.retries = retries
+        self.base_delay = base_delay
+        limits = limits if limits is not None else default_limits(backend.name)
+        self.endpoints = {name: _Endpoint(name, values) for name, values in limits.items()}
+        self._lock = threading.Lock()
+        self._in_flight = {}  # call key -> Future shared by identical concurrent calls
+        self._async_in_flight = {}  # the same for async calls: call key -> Task
+
+    def __getattr__(self, name):
+        # Anything not governed (e.g. a fake backend's latency settings) comes from the backend
+        return getattr(self.backend, name)
+
+    def _endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = _Endpoint(name, {})
+        return self.endpoints[name]
+
+    def _open_call(self, endpoint):
+        """
+        Checks the circuit once per call (its retries were already let through). Returns
+        whether the call is the half-open trial, which must end with end_trial().
+        """
+        state = endpoint.breaker.allow()
+        if state is None:
+            metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="circuit_open")
+            raise CircuitOpen(f"{endpoint.name} calls are failing; retry in {endpoint.breaker.cooldown:.0f}s")
+        return state == "half_open"
+
+    def _reserve(self, endpoint, tokens, deadline):
+        """Takes rate limit tokens. Returns the seconds to wait before calling."""
+        wait = 0.0
+        if endpoint.rpm:
+            wait = max(wait, endpoint.rpm.reserve(1))
+        if endpoint.tpm and tokens:
+            wait = max(wait, endpoint.tpm.reserve(tokens))
+        remaining = _remaining(deadline)
+        if remaining is not None and wait > remaining:
+            self._refund(endpoint, tokens, requests=1)
+            metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="deadline")
+            raise DeadlineExceeded(f"{endpoint.name} rate limit wait of {wait:.1f}s exceeds the deadline")
+        return wait
+
+    def _no_slot(self, endpoint, tokens):
+        # The call never ran, so it uses none of the rate budget it reserved
+        self._refund(endpoint, tokens, requests=1)
+        metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="deadline")
+        return DeadlineExceeded(f"No free {endpoint.name} slot before the deadline")
+
+    def _admit(self, endpoint, tokens, deadline):
+        """Waits for rate limits and a free slot. Returns the seconds spent queued."""
+        start = time.monotonic()
+        wait = self._reserve(endpoint, tokens, deadline)
+        if wait:
+            time.sleep(wait)
+        if endpoint.slots and not endpoint.slots.acquire(timeout=_remaining(deadline)):
+            raise self._no_slot(endpoint, tokens)
+        queued = time.monotonic() - start
+        metrics.observe("story_governor_queued_seconds", queued, endpoint=endpoint.name)
+        return queued
+
+    async def _aadmit(self, endpoint, tokens, deadline):
+        """_admit() for the event loop: waits without blocking it."""
+        start = time.monotonic()
+        wait = self._reserve(endpoint, tokens, deadline)
+        if wait:
+            await asyncio.sleep(wait)
+        if endpoint.async_slots:
+            try:
+                await asyncio.wait_for(endpoint.async_slots.acquire(), _remaining(deadline))
+            except asyncio.TimeoutError:
+                raise self._no_slot(endpoint, tokens) from None
+        queued = time.monotonic() - start
+        metrics.observe("story_governor_queued_seconds", queued, endpoint=endpoint.name)
+        return queued
+
+    @staticmethod
+    def _refund(endpoint, tokens, requests=0):
+        # A failed attempt used no tokens (or none that will be reported); give them back
+        if endpoint.rpm and requests:
+            endpoint.rpm.adjust(-requests)
+        if endpoint.tpm and tokens:
+            endpoint.tpm.adjust(-tokens)
+
+    def _retry_delay(self, endpoint, error, attempt, deadline, tokens=0):
+        """
+        Handles a failed attempt: returns how long to back off, or, when out of retries or
+        time, records the call's failure with the breaker and raises.
+        """
+        self._refund(endpoint, tokens)
+        if attempt >= self.retries:
+            endpoint.breaker.record_failure(endpoint.name)
+            metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="error")
+            raise error
+        delay = retry_delay(error, attempt, self.base_delay)
+        remaining = _remaining(deadline)
+        if remaining is not None and delay > remaining:
+            endpoint.breaker.record_failure(endpoint.name)
+            metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="deadline")
+            raise DeadlineExceeded(f"{endpoint.name} retry would pass the deadline") from error
+        metrics.increment("story_governor_retries_total", endpoint=endpoint.name, error=type(error).__name__)
+        return delay
+
+    def _governed(self, endpoint, call, tokens=0):
+        """Runs call(timeout) under the endpoint's limits, retrying transient errors."""
+        deadline = time.monotonic() + endpoint.deadline if endpoint.deadline else None
+        trial = self._open_call(endpoint)
+        attempt = 0
+        try:
+            while True:
+                self._admit(endpoint, tokens, deadline)
+                try:
+                    result = call(_call_timeout(deadline))
+                except retryable_errors() as e:
+                    delay = self._retry_delay(endpoint, e, attempt, deadline, tokens)
+                except Exception:
+                    # The endpoint answered (e.g. a rejected prompt), so it isn't down
+                    self._refund(endpoint, tokens)
+                    endpoint.breaker.record_success()
+                    metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="error")
+                    raise
+                else:
+                    endpoint.breaker.record_success()
+                    metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="ok")
+                    return result
+                finally:
+                    if endpoint.slots:
+                        endpoint.slots.release()
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            if trial:
+                endpoint.breaker.end_trial()
+
+    async def _agoverned(self, endpoint, call, tokens=0):
+        """_governed() for the event loop; call(timeout) returns an awaitable."""
+        deadline = time.monotonic() + endpoint.deadline if endpoint.deadline else None
+        trial = self._open_call(endpoint)
+        attempt = 0
+        try:
+            while True:
+                await self._aadmit(endpoint, tokens, deadline)
+                try:
+                    result = await call(_call_timeout(deadline))
+                except retryable_errors() as e:
+                    delay = self._retry_delay(endpoint, e, attempt, deadline, tokens)
+                except Exception:
+                    self._refund(endpoint, tokens)
+                    endpoint.breaker.record_success()
+                    metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="error")
+                    raise
+                else:
+                    endpoint.breaker.record_success()
+                    metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="ok")
+                    return result
+                finally:
+                    if endpoint.async_slots:
+                        endpoint.async_slots.release()
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            # A trial that waited past its deadline or was cancelled settled nothing
+            if trial:
+                endpoint.breaker.end_trial()
+
+    @staticmethod
+    def _call_key(endpoint_name, key_parts):
+        return hashlib.sha256(json.dumps([endpoint_name, key_parts], default=str).encode("utf-8")).hexdigest()
+
+    def _coalesced(self, endpoint_name, key_parts, call, tokens=0):
+        """Runs the call once for all identical concurrent callers."""
+        key = self._call_key(endpoint_name, key_parts)
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            metrics.increment("story_governor_calls_total", endpoint=endpoint_name, outcome="coalesced")
+            return future.result()
+        try:
+            result = self._governed(self._endpoint(endpoint_name), call, tokens)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def _acoalesced(self, endpoint_name, key_parts, call, tokens=0):
+        """_coalesced() for the event loop: identical concurrent calls await one task."""
+        key = self._call_key(endpoint_name, key_parts)
+        task = self._async_in_flight.get(key)
+        if task is not None:
+            metrics.increment("story_governor_calls_total", endpoint=endpoint_name, outcome="coalesced")
+            return await asyncio.shield(task)
+        task = self._async_in_flight[key] = asyncio.ensure_future(
+            self._agoverned(self._endpoint(endpoint_name), call, tokens))
+        task.add_done_callback(lambda _: self._async_in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def _chat_tokens(self, messages, max_tokens=None):
+        # About four characters per token for English text, plus the completion budget
+        return sum(len(message["content"]) for message in messages) // 4 + (max_tokens or CHAT_COMPLETION_ESTIMATE)
+
+    def _settle_tokens(self, estimate, usage):
+        endpoint = self._endpoint("chat")
+        if endpoint.tpm and usage.get("prompt_tokens") is not None:
+            endpoint.tpm.adjust(usage["prompt_tokens"] + usage.get("completion_tokens", 0) - estimate)
+
+    def chat(self, model, messages, temperature=0.7, usage=None, max_tokens=None):
+        estimate = self._chat_tokens(messages, max_tokens)
+
+        def call(timeout):
+            call_usage = {}
+            text = self.backend.chat(model, messages, temperature=temperature, usage=call_usage,
+                                     max_tokens=max_tokens, timeout=timeout)
+            self._settle_tokens(estimate, call_usage)
+            return text, call_usage
+
+        text, call_usage = self._coalesced("chat", [model, messages, temperature, max_tokens], call, estimate)
+        if usage is not None:
+            usage.update(call_usage)
+        return text
+
+    def chat_stream(self, model, messages, temperature=0.7, usage=None, max_tokens=None):
+        """Streams a chat completion. Failures are only retried before the first piece arrives."""
+        endpoint = self._endpoint("chat")
+        estimate = self._chat_tokens(messages, max_tokens)
+        deadline = time.monotonic() + endpoint.deadline if endpoint.deadline else None
+        trial = self._open_call(endpoint)
+        attempt = 0
+        try:
+            while True:
+                self._admit(endpoint, estimate, deadline)
+                call_usage = {}
+                started = False
+                try:
+                    for piece in self.backend.chat_stream(model, messages, temperature=temperature, usage=call_usage,
+                                                          max_tokens=max_tokens, timeout=_call_timeout(deadline)):
+                        started = True
+                        yield piece
+                except retryable_errors() as e:
+                    if started:
+                        endpoint.breaker.record_failure(endpoint.name)
+                        metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="error")
+                        raise
+                    delay = self._retry_delay(endpoint, e, attempt, deadline, estimate)
+                except Exception:
+                    if not started:
+                        self._refund(endpoint, estimate)
+                    endpoint.breaker.record_success()
+                    metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="error")
+                    raise
+                else:
+                    endpoint.breaker.record_success()
+                    metrics.increment("story_governor_calls_total", endpoint=endpoint.name, outcome="ok")
+                    self._settle_tokens(estimate, call_usage)
+                    if usage is not None:
+                        usage.update(call_usage)
+                    return
+                finally:
+                    if endpoint.slots:
+                        endpoint.slots.release()
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            # Also reached when the consumer stops reading early (GeneratorExit)
+            if trial:
+                endpoint.breaker.end_trial()
+
+    def generate_image(self, model, prompt, size="1024x1024"):
+        return self._coalesced(
+            "image", [model, prompt, size],
+            lambda timeout: self.backend.generate_image(model, prompt, size, timeout=timeout),
+        )
+
+    def speech(self, model, voice, text):
+        return self._coalesced(
+            "speech", [model, voice, text],
+            lambda timeout: self.backend.speech(model, voice, text, timeout=timeout),
+        )
+
+    def fetch(self, url, timeout=30):
+        return self._coalesced(
+            "fetch", [url],
+            lambda remaining: self.backend.fetch(url, timeout=min(timeout, remaining or timeout)),
+        )
+
+    async def achat(self, model, messages, temperature=0.7, usage=None, max_tokens=None):
+        estimate = self._chat_tokens(messages, max_tokens)
+
+        async def call(timeout):
+            call_usage = {}
+            text = await self.backend.achat(model, messages, temperature=temperature, usage=call_usage,
+                                            max_tokens=max_tokens, timeout=timeout)
+            self._settle_tokens(estimate, call_usage)
+            return text, call_usage
+
+        text, call_usage = await self._acoalesced("chat", [model, messages, temperature, max_tokens], call, estimate)
+        if usage is not None:
+            usage.update(call_usage)
+        return text
+
+    async def agenerate_image(self, model, prompt, size="1024x1024"):
+        return await self._acoalesced(
+            "image", [model, prompt, size],
+            lambda timeout: self.backend.agenerate_image(model, prompt, size, timeout=timeout),
+        )
+
+    async def aspeech(self, model, voice, text):
+        return await self._acoalesced(
+            "speech", [model, voice, text],
+            lambda timeout: self.backend.aspeech(model, voice, text, timeout=timeout),
+        )
+
+    def stats(self):
+        """Breaker state per endpoint, for status pages."""
+        return {name: endpoint.breaker.state for name, endpoint in self.endpoints.items()}
+
+
+def govern(backend, limits=None):
+    """Wraps backend in a GovernedBackend (unless it already is one)."""
+    if isinstance(backend, GovernedBackend):
+        return backend
+    return GovernedBackend(backend, limits)
@@ -0,0 +1,248 @@
+"""
+Process-wide job queue for story generation.
+
+Streamlit runs the whole script on every interaction, so generating inline pins a script
+thread for the full 30+ seconds of a story. Instead the UI submits a job, gets a job id back
+immediately, and polls get_job() on later reruns to show per-stage progress and the story
+text as it streams in.
+
+Identical requests already queued or running are deduplicated onto the same job, and
+submit() raises QueueFull once `max_pending` jobs are waiting so overload is pushed back to
+the user instead of piling up threads.
+
+AsyncJobQueue is the same queue for the HTTP service: jobs run as tasks on the event loop
+(at most `max_running` at once) instead of on worker threads. Both share _BaseJobQueue,
+which does the deduplication, bookkeeping and pruning; they differ only in how a job runs.
+"""
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import story_generator
+from artifact_store import get_artifact_store, hold_result
+from story_cache import make_cache_key
+
+JOB_WORKERS = int(os.getenv("STORY_JOB_WORKERS", "4"))
+JOB_MAX_PENDING = int(os.getenv("STORY_JOB_MAX_PENDING", "32"))
+JOB_RETENTION_SECONDS = int(os.getenv("STORY_JOB_RETENTION", str(30 * 60)))  # keep finished jobs 30 min
+ASYNC_JOB_MAX_RUNNING = int(os.getenv("STORY_ASYNC_JOB_MAX_RUNNING", "256"))
+ASYNC_JOB_MAX_PENDING = int(os.getenv("STORY_ASYNC_JOB_MAX_PENDING", "1024"))
+
+
+class QueueFull(Exception):
+    """Raised by submit() when too many jobs are already waiting."""
+
+
+class Job:
+    """One story request and its progress. Read it from any thread; only the worker writes it."""
+
+    def __init__(self, key, story_topic, story_length, child_name, ticket=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.story_topic = story_topic
+        self.story_length = story_length
+        self.child_name = child_name
+        self.ticket = ticket  # Quota admission of the request that created the job
+        self.status = "queued"  # queued -> running -> done | failed
+        self.stages = {stage: "pending" for stage in story_generator.StoryStream.STAGES}
+        self.story_text = ""  # Grows while the story streams in
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def progress(self):
+        """Fraction of stages that are no longer pending or running."""
+        settled = sum(1 for status in self.stages.values() if status not in ("pending", "running"))
+        return settled / len(self.stages)
+
+
+class _BaseJobQueue:
+    """Tracks story jobs, with in-flight deduplication. Subclasses run them in _start()."""
+
+    def __init__(self, max_pending, retention):
+        self.max_pending = max_pending
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._in_flight = {}  # request key -> job id
+        self._pending = 0
+
+    def submit(self, story_topic, story_length="short", child_name="", ticket=None):
+        """
+        Queues a story request and returns its Job (an existing one for identical requests).
+        A new job keeps ticket, so a caller can tell whether it joined (job.ticket differs).
+        """
+        key = make_cache_key(story_topic, story_generator.STORY_MODEL, story_length, child_name)
+        with self._lock:
+            self._prune()
+            job_id = self._in_flight.get(key)
+            if job_id is not None:
+                metrics.increment("story_jobs_total", outcome="deduplicated")
+                return self._jobs[job_id]
+            if self._pending >= self.max_pending:
+                metrics.increment("story_jobs_total", outcome="rejected")
+                raise QueueFull(f"{self._pending} story jobs already waiting")
+            job = Job(key, story_topic, story_length, child_name, ticket)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job.id
+            self._pending += 1
+        metrics.increment("story_jobs_total", outcome="accepted")
+        self._start(job)
+        return job
+
+    def _start(self, job):
+        raise NotImplementedError
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+            return {"pending": self._pending, "running": running, "tracked": len(self._jobs)}
+
+    def _begin(self, job):
+        with self._lock:
+            self._pending -= 1
+        job.status = "running"
+        job.started_at = time.time()
+        metrics.observe("story_job_queue_seconds", job.started_at - job.submitted_at)
+
+    def _succeed(self, job, result):
+        job.result = result
+        # Keep the narration file around for as long as the job can be looked up
+        hold_result(job.result, f"job:{job.id}", lease=self.retention)
+        job.finished_at = time.time()  # Before the status, which is what _prune looks at
+        job.status = "done"
+
+    def _fail(self, job, error):
+        job.error = str(error)
+        job.finished_at = time.time()
+        job.status = "failed"
+        metrics.increment("story_jobs_total", outcome="failed")
+
+    def _end(self, job):
+        with self._lock:
+            if self._in_flight.get(job.key) == job.id:
+                del self._in_flight[job.key]
+
+    def _prune(self):
+        # Caller holds the lock
+        cutoff = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+            get_artifact_store().release_owner(f"job:{job_id}")
+
+
+class JobQueue(_BaseJobQueue):
+    """Bounded worker pool running story jobs, with in-flight deduplication."""
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, retention=JOB_RETENTION_SECONDS):
+        super().__init__(max_pending, retention)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="story-job")
+
+    def _start(self, job):
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        self._begin(job)
+
+        def on_stage(stage, status):
+            job.stages[stage] = status
+
+        try:
+            stream = story_generator.stream_story_and_image(
+                job.story_topic, job.story_length, job.child_name, on_stage=on_stage
+            )
+            for piece in stream:
+                job.story_text += piece
+            self._succeed(job, stream.result)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            self._end(job)
+
+
+class AsyncJobQueue(_BaseJobQueue):
+    """
+    Job queue whose jobs run as tasks on the running event loop. submit() must be called from
+    that loop; get() and stats() work from anywhere.
+    """
+
+    def __init__(self, max_running=ASYNC_JOB_MAX_RUNNING, max_pending=ASYNC_JOB_MAX_PENDING,
+                 retention=JOB_RETENTION_SECONDS):
+        super().__init__(max_pending, retention)
+        self._slots = asyncio.Semaphore(max_running)
+        self._tasks = set()  # Strong references, so running tasks aren't garbage collected
+        self._done = {}  # job id -> Event set when the job finishes, while it is unfinished
+
+    def _start(self, job):
+        self._done[job.id] = asyncio.Event()
+        task = asyncio.get_running_loop().create_task(self._arun(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _arun(self, job):
+        async with self._slots:
+            self._begin(job)
+
+            def on_stage(stage, status):
+                job.stages[stage] = status
+
+            try:
+                result = await story_generator.agenerate_story_and_image(
+                    job.story_topic, job.story_length, job.child_name, on_stage=on_stage
+                )
+                job.story_text = result["story"]
+                # Holding may copy cached files into the artifact store; keep that off the loop
+                await asyncio.to_thread(self._succeed, job, result)
+            except Exception as e:
+                self._fail(job, e)
+            finally:
+                self._end(job)
+                self._done.pop(job.id).set()
+
+    async def wait(self, job, timeout=None):
+        """Waits until job is finished, or timeout seconds. Returns whether it finished."""
+        done = self._done.get(job.id)
+        if done is None:
+            return job.finished
+        try:
+            await asyncio.wait_for(done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job.finished
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Returns the process-wide JobQueue, creating it on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
+
+
+def submit_story(story_topic, story_length="short", child_name="", ticket=None):
+    return get_job_queue().submit(story_topic, story_length, child_name, ticket)
+
+
+def get_job(job_id):
+    return get_job_queue().get(job_id)
@@ -0,0 +1,185 @@
+"""
+Load test for the HTTP service (service.py) against the offline FakeBackend.
+
+Each virtual user creates a story with a unique topic, waits for its job and downloads the
+PDF, so every request runs the full pipeline. By default the ASGI app is driven in-process
+on one event loop (no sockets, so only our own overhead is measured); with --url the same
+traffic goes to a running server instead, whose backend must then be the fake one
+(STORY_BACKEND=fake).
+
+Usage:
+    python loadtest.py                                    # concurrency 16,64,256
+    python loadtest.py --concurrency 64,512 --latency chat=4,image=10,speech=2
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 64
+
+Reported per concurrency level: completed stories/s, p50/p95 end-to-end latency, CPU used
+per story and the share of one core in use. Concurrent stories per core is the
+concurrency divided by that share: how many generations one core could keep in flight at
+this latency before the CPU runs out.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import narration
+import screening
+import service
+import similarity
+import story_cache
+from artifact_store import ArtifactStore, set_artifact_store
+from backends import FakeBackend, _parse_latency, set_backend
+from benchmark import percentile
+from governor import govern
+from quota import QuotaService, set_quota_service
+
+DEFAULT_LATENCY = "chat=2,image=4,speech=1"
+
+
+async def call_app(method, path, body=b""):
+    """Sends one request to the in-process ASGI app. Returns (status, body)."""
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(),
+             "headers": [(b"content-type", b"application/json")], "client": ("127.0.0.1", 0)}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {"status": None, "body": b""}
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        else:
+            response["body"] += message.get("body", b"")
+
+    await service.app(scope, receive, send)
+    return response["status"], response["body"]
+
+
+def http_client(base_url):
+    """A minimal HTTP/1.1 client (one connection per request) for --url."""
+    parts = urlsplit(base_url)
+    host, port = parts.hostname, parts.port or 80
+
+    async def call(method, path, body=b""):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+        raw = await reader.read()
+        writer.close()
+        head, _, payload = raw.partition(b"\r\n\r\n")
+        return int(head.split(b" ", 2)[1]), payload
+
+    return call
+
+
+async def one_story(call, latencies, failures):
+    start = time.perf_counter()
+    body = json.dumps({"topic": "Space", "details": f"load test {uuid.uuid4().hex}", "length": "short"})
+    status, payload = await call("POST", "/stories", body.encode())
+    if status != 202:
+        failures.append(status)
+        return
+    job_id = json.loads(payload)["job_id"]
+    while True:
+        status, payload = await call("GET", f"/jobs/{job_id}?wait=60")
+        job = json.loads(payload)
+        if status != 200 or job["status"] in ("done", "failed"):
+            break
+    if job["status"] != "done" or not (job.get("artifacts") or {}).get("pdf"):
+        failures.append(job["status"])
+        return
+    status, pdf = await call("GET", job["artifacts"]["pdf"])
+    if status != 200 or not pdf.startswith(b"%PDF"):
+        failures.append(status)
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_level(call, concurrency, stories):
+    latencies, failures = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def user():
+        async with semaphore:
+            await one_story(call, latencies, failures)
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(user() for _ in range(stories)))
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    core_share = cpu / wall if wall else 0.0
+    return {
+        "concurrency": concurrency,
+        "stories": stories,
+        "completed": len(latencies),
+        "failed": len(failures),
+        "stories_per_sec": round(len(latencies) / wall, 2),
+        "latency_s": {"p50": round(percentile(latencies, 50) or 0, 2), "p95": round(percentile(latencies, 95) or 0, 2)},
+        "cpu_ms_per_story": round(cpu / max(len(latencies), 1) * 1000, 1),
+        "core_share": round(core_share, 3),
+        "concurrent_stories_per_core": round(concurrency / core_share) if core_share else None,
+    }
+
+
+async def run(levels, stories_per_level, url):
+    call = http_client(url) if url else call_app
+    results = []
+    for concurrency in levels:
+        # Enough stories to keep every slot busy for a few rounds
+        results.append(await run_level(call, concurrency, stories_per_level or concurrency * 3))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="16,64,256", help="Comma-separated concurrent users")
+    parser.add_argument("--stories", type=int, default=0, help="Stories per level (default: 3x the concurrency)")
+    parser.add_argument("--latency", default=DEFAULT_LATENCY, help="Injected backend latency (in-process only)")
+    parser.add_argument("--url", help="Base URL of a running service instead of the in-process app")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    work_dir = tempfile.mkdtemp(prefix="story_loadtest_")
+    try:
+        if not args.url:
+            # Fresh caches, and the governor without rate limits or concurrency caps, so the
+            # pipeline itself is what's measured
+            set_backend(govern(FakeBackend(latency=_parse_latency(args.latency), seed=0), limits={}), governed=False)
+            story_cache.set_cache(story_cache.StoryCache(os.path.join(work_dir, "cache")))
+            set_artifact_store(ArtifactStore(os.path.join(work_dir, "artifacts")))
+            narration.set_chunk_cache(story_cache.StoryCache(os.path.join(work_dir, "tts")))
+            similarity.set_similarity_index(similarity.SimilarityIndex(os.path.join(work_dir, "similarity.sqlite3")))
+            screening.set_refusal_cache(screening.RefusalCache(os.path.join(work_dir, "refusals.sqlite3")))
+            set_quota_service(QuotaService(os.path.join(work_dir, "quota.sqlite3"), user_limit=10 ** 9,
+                                           budget=float("inf")))
+            service._queue = service.AsyncJobQueue(max_running=max(levels), max_pending=10 ** 6)
+        results = asyncio.run(run(levels, args.stories, args.url))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("=" * 100)
+    print(f"{'concurrency':>11} {'done':>6} {'failed':>6} {'stories/s':>10} {'p50 s':>7} {'p95 s':>7} "
+          f"{'CPU ms/story':>13} {'core %':>7} {'per core':>9}")
+    print("=" * 100)
+    for entry in results:
+        print(f"{entry['concurrency']:>11} {entry['completed']:>6} {entry['failed']:>6} {entry['stories_per_sec']:>10} "
+              f"{entry['latency_s']['p50']:>7} {entry['latency_s']['p95']:>7} {entry['cpu_ms_per_story']:>13} "
+              f"{entry['core_share']:>7.0%} {entry['concurrent_stories_per_core'] or '-':>9}")
+    print("=" * 100)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"latency": args.latency, "url": args.url, "levels": results}, f, indent=2)
+    return 1 if any(entry["failed"] for entry in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Media optimization for illustrations and narration.
+
+Illustrations come back from DALL·E as 1024x1024 PNGs (1-3 MB), but the story page shows
+them in a column and the PDF in a 250 pt slot. image_rendition() makes resized WebP or JPEG
+copies at a few fixed widths (RENDITION_WIDTHS, so a size request snaps to one of them).
+Each copy is cached by the source's content hash in a separate StoryCache under
+CACHE_DIR/renditions, so each one is encoded only once across workers.
+
+Narration is encoded as STORY_AUDIO_FORMAT ("mp3" or "opus") at STORY_AUDIO_BITRATE when
+chunks are joined (see narration.join_audio). That needs ffmpeg; without it the MP3 from
+the TTS API is served as is. Speech needs far less than the API's bitrate: 64 kbps MP3 or
+32 kbps Opus is enough for one voice.
+
+Smaller files are what the page gains: st.audio() reads the whole file into Streamlit's
+in-memory media storage before serving it. Only service.py's artifact endpoint streams
+narration from disk and answers HTTP range requests.
+"""
+import hashlib
+import io
+import os
+import threading
+
+import metrics
+from story_cache import CACHE_DIR, StoryCache, make_cache_key
+
+RENDITION_WIDTHS = (256, 512, 768)
+DISPLAY_WIDTH = 512  # the story page's illustration column
+IMAGE_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+
+AUDIO_FORMAT = os.getenv("STORY_AUDIO_FORMAT", "mp3")
+AUDIO_BITRATE = os.getenv("STORY_AUDIO_BITRATE", "32k" if AUDIO_FORMAT == "opus" else "64k")
+# pydub export arguments, MIME type and file suffix per narration format
+AUDIO_FORMATS = {
+    "mp3": ({"format": "mp3"}, "audio/mpeg", ".mp3"),
+    "opus": ({"format": "ogg", "codec": "libopus"}, "audio/ogg", ".ogg"),
+}
+
+_rendition_cache = None
+_rendition_cache_lock = threading.Lock()
+
+
+def get_rendition_cache():
+    """Returns the process-wide cache of image renditions, creating it on first use."""
+    global _rendition_cache
+    if _rendition_cache is None:
+        with _rendition_cache_lock:
+            if _rendition_cache is None:
+                _rendition_cache = StoryCache(os.path.join(CACHE_DIR, "renditions"))
+    return _rendition_cache
+
+
+def set_rendition_cache(cache):
+    """Replaces the rendition cache (e.g. with a temporary one for benchmarks)."""
+    global _rendition_cache
+    _rendition_cache = cache
+
+
+def read_bytes(data):
+    """Returns data itself if it is bytes, else the contents of the file at that path."""
+    if isinstance(data, bytes):
+        return data
+    with open(data, "rb") as f:
+        return f.read()
+
+
+def snap_width(width):
+    """The smallest rendition width that is at least width (or the largest one)."""
+    for candidate in RENDITION_WIDTHS:
+        if candidate >= width:
+            return candidate
+    return RENDITION_WIDTHS[-1]
+
+
+def render_rendition(image_bytes, width, fmt="webp"):
+    """Encodes image_bytes at most width pixels wide (never upscaled) as fmt. Returns the bytes."""
+    from PIL import Image
+
+    pil_format, _, options = IMAGE_FORMATS[fmt]
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft("RGB", (width, width))  # Cheap JPEG downscale while decoding
+    img = img.convert("RGB")
+    img.thumbnail((width, width), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+def image_rendition(image, width=DISPLAY_WIDTH, fmt="webp"):
+    """
+    Returns the bytes of a resized copy of image (bytes or a path) in fmt ("webp" or
+    "jpeg"), from the rendition cache when it has been made before.
+    """
+    source = read_bytes(image)
+    width = snap_width(width)
+    digest = hashlib.sha256(source).hexdigest()
+    key = make_cache_key(digest, fmt, str(width), "", tier="rendition")
+    cache = get_rendition_cache()
+    cached = cache.get(key)
+    if cached and cached["image"]:
+        metrics.increment("story_renditions_total", format=fmt, source="cache")
+        return read_bytes(cached["image"])
+
+    with metrics.span("rendition", format=fmt, width=width) as span:
+        data = render_rendition(source, width, fmt)
+        span.set(bytes=len(data), source_bytes=len(source))
+    metrics.increment("story_renditions_total", format=fmt, source="render")
+    try:
+        cache.put(key, {"story": "", "timings": {}}, image_bytes=data)
+    except Exception as e:
+        print(f"Error caching image rendition: {e}")
+    return data
+
+
+def audio_settings(fmt=None):
+    """(pydub export arguments, MIME type, file suffix) for a narration format."""
+    return AUDIO_FORMATS.get(fmt or AUDIO_FORMAT, AUDIO_FORMATS["mp3"])
+
+
+def audio_mime(audio):
+    """MIME type of narration given as bytes or a path, judged by its content."""
+    head = audio[:4] if isinstance(audio, bytes) else read_head(audio, 4)
+    return "audio/ogg" if head == b"OggS" else "audio/mpeg"
+
+
+def audio_suffix(audio_bytes):
+    """File suffix for narration bytes, judged by their content."""
+    return ".ogg" if audio_bytes[:4] == b"OggS" else ".mp3"
+
+
+def read_head(path, size):
+    with open(path, "rb") as f:
+        return f.read(size)
+
+
+def byte_size(data):
+    """Size of data given as bytes or a path (0 for None)."""
+    if not data:
+        return 0
+    return len(data) if isinstance(data, bytes) else os.path.getsize(data)
+
+
+def record_served(result, image_bytes_served):
+    """
+    Counts the bytes a story page sends as story_media_bytes_total{kind, variant}: for the
+    illustration, the original next to the rendition actually sent; for narration, the file
+    sent (the encode's savings are on the audio_join span, and in benchmark.py's media scenario).
+    """
+    metrics.increment("story_media_bytes_total", byte_size(result.get("image")), kind="image", variant="original")
+    metrics.increment("story_media_bytes_total", image_bytes_served, kind="image", variant="served")
+    metrics.increment("story_media_bytes_total", byte_size(result.get("audio")), kind="audio", variant="served")
@@ -0,0 +1,297 @@
+"""
+Lightweight instrumentation for the story pipeline.
+
+Stages are timed with monotonic, high-resolution spans:
+
+    with metrics.span("chat", model="gpt-4o") as s:
+        text = ...
+        s.set(completion_tokens=412)
+
+Every span feeds a latency histogram per stage (plus histograms for any numeric attributes
+such as token counts and byte sizes) and, when STORY_METRICS_JSONL is set, is appended to
+that file as one JSON line. Failures are counted with metrics.increment().
+
+Histograms, counters and gauges can be exported in Prometheus text format with export_prometheus(),
+served over HTTP with start_http_server() (or by setting STORY_METRICS_PORT), or written to a
+file for the node_exporter textfile collector with write_prometheus().
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+JSONL_PATH = os.getenv("STORY_METRICS_JSONL")
+
+# Histogram buckets: seconds for latencies, counts for tokens and bytes
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+SIZE_BUCKETS = [2 ** exponent for exponent in range(4, 27, 2)]  # 16 .. 64M
+
+# Span attributes that get their own histogram, and the metric they feed
+_ATTRIBUTE_METRICS = {
+    "prompt_tokens": "story_tokens",
+    "completion_tokens": "story_tokens",
+    "bytes": "story_stage_bytes",
+}
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense (bucket counts, sum and count)."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Thread-safe store for counters, gauges and histograms, keyed by metric name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Returns plain dictionaries of counters and histogram summaries."""
+        with self._lock:
+            counters = {_series(name, labels): value for (name, labels), value in self._counters.items()}
+            gauges = {_series(name, labels): value for (name, labels), value in self._gauges.items()}
+            histograms = {
+                _series(name, labels): {"count": h.count, "sum": round(h.total, 6)}
+                for (name, labels), h in self._histograms.items()
+            }
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def export_prometheus(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            seen = set()
+            for (name, labels), value in counters:
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{_series(name, labels)} {value}")
+            for (name, labels), value in gauges:
+                if name not in seen:
+                    lines.append(f"# TYPE {name} gauge")
+                    seen.add(name)
+                lines.append(f"{_series(name, labels)} {value}")
+            for (name, labels), h in histograms:
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(h.buckets + [float("inf")], h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{_series(name + '_bucket', labels + (('le', le),))} {cumulative}")
+                lines.append(f"{_series(name + '_sum', labels)} {h.total}")
+                lines.append(f"{_series(name + '_count', labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_value(value):
+    # The text format requires backslashes, double quotes and newlines to be escaped
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    rendered = ",".join(f'{key}="{_label_value(value)}"' for key, value in labels)
+    return f"{name}{{{rendered}}}"
+
+
+registry = Registry()
+_jsonl_lock = threading.Lock()
+
+
+def increment(name, value=1, **labels):
+    """Adds to a counter, e.g. increment("story_stage_errors_total", stage="image")."""
+    registry.increment(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge to its current value, e.g. set_gauge("story_artifact_bytes", 1024)."""
+    registry.set_gauge(name, value, **labels)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    registry.observe(name, value, buckets, **labels)
+
+
+def write_event(event):
+    """Appends one event to the JSONL sink, if one is configured."""
+    if not JSONL_PATH:
+        return
+    line = json.dumps(event, default=str)
+    with _jsonl_lock:
+        with open(JSONL_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class Span:
+    """A timed pipeline stage. Use set() to attach token counts, byte sizes and other details."""
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = dict(attributes)
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Times the enclosed block as one pipeline stage and records it."""
+    current = Span(stage, attributes)
+    current.start = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _record(current)
+
+
+def record_span(stage, start, end, **attributes):
+    """Records a stage timed elsewhere (start and end from time.perf_counter())."""
+    current = Span(stage, attributes)
+    current.start, current.end = start, end
+    _record(current)
+
+
+def _record(current):
+    status = "error" if current.error else "ok"
+    observe("story_stage_seconds", current.duration, stage=current.stage, status=status)
+    if current.error:
+        increment("story_stage_errors_total", stage=current.stage, error=current.error)
+    for attribute, metric in _ATTRIBUTE_METRICS.items():
+        value = current.attributes.get(attribute)
+        if isinstance(value, (int, float)):
+            labels = {"stage": current.stage}
+            if metric == "story_tokens":
+                labels["kind"] = attribute.replace("_tokens", "")
+            observe(metric, value, SIZE_BUCKETS, **labels)
+    write_event({
+        "type": "span",
+        "stage": current.stage,
+        "duration_s": round(current.duration, 6),
+        "status": status,
+        "error": current.error,
+        "ts": time.time(),
+        **current.attributes,
+    })
+
+
+def record_request(timings, **details):
+    """Records the outcome of one story request (served from cache or freshly generated)."""
+    source = "cache" if timings.get("from_cache") else "fresh"
+    increment("story_requests_total", source=source)
+    if "total_time" in timings:
+        observe("story_request_seconds", timings["total_time"], source=source)
+    write_event({"type": "request", "source": source, "ts": time.time(), "timings": timings, **details})
+    logger.info(
+        "story request served (%s) in %ss: %s",
+        source, timings.get("total_time", "N/A"),
+        ", ".join(f"{key}={value}" for key, value in timings.items() if key != "total_time"),
+    )
+
+
+def export_prometheus():
+    return registry.export_prometheus()
+
+
+def write_prometheus(path):
+    """Writes the current metrics to path atomically (for the node_exporter textfile collector)."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(export_prometheus())
+    os.replace(temp_path, path)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serves /metrics in Prometheus format from a background thread (once per process)."""
+    global _server
+    # http.server is only imported when metrics are actually served
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = export_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the console
+
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="story-metrics", daemon=True).start()
+    return _server
+
+
+if os.getenv("STORY_METRICS_PORT"):
+    try:
+        start_http_server(int(os.getenv("STORY_METRICS_PORT")))
+    except OSError as e:
+        # Another Streamlit worker on this host already owns the port
+        logger.warning("Metrics server not started: %s", e)
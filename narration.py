@@ -0,0 +1,243 @@
+"""
+Chunked, parallel text-to-speech.
+
+Long narration is split on paragraph (then sentence) boundaries into chunks that are
+synthesized in parallel, with bounded concurrency, and stitched back into one file. Every
+chunk is cached by its text, voice and model in a separate StoryCache under CACHE_DIR/tts.
+When a story is re-personalized or edited, only the chunks whose text changed go back to
+the TTS API.
+
+asynthesize() does the same on an event loop, with the chunks' TTS calls made concurrently
+through the backend's async API.
+
+Chunks are joined with pydub when ffmpeg is available: each chunk is decoded, levelled to
+the same loudness and re-encoded as a single stream, so there are no encoder-padding gaps
+at the seams. That encode is also where narration is transcoded to the served format and
+bitrate (media.AUDIO_FORMAT, media.AUDIO_BITRATE), even for a single chunk. Without ffmpeg
+(or pydub), the MP3 frames are concatenated as-is, after dropping the ID3 tags of all but
+the first chunk.
+"""
+import asyncio
+import io
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import media
+import metrics
+from backends import get_backend
+from story_cache import CACHE_DIR, StoryCache, make_cache_key
+
+TTS_MODEL = "tts-1"
+TTS_VOICE = "alloy"
+TTS_CHUNK_CHARS = int(os.getenv("STORY_TTS_CHUNK_CHARS", "1200"))  # the API takes up to 4096
+TTS_CONCURRENCY = int(os.getenv("STORY_TTS_CONCURRENCY", "4"))
+TTS_TARGET_DBFS = float(os.getenv("STORY_TTS_TARGET_DBFS", "-16"))
+TTS_BITRATE = "128k"  # for intermediate MP3s that are joined again later
+
+# A sentence ends at . ! or ? (plus any closing quotes or brackets) and whitespace, except
+# after a title like "Mr." that is followed by a name
+ABBREVIATIONS = ("Mr", "Mrs", "Ms", "Dr", "St", "Mt", "Jr", "Sr", "Prof")
+SENTENCE_END = "".join(rf"(?<!\b{word}\.)" for word in ABBREVIATIONS) + r"(?<=[.!?])[\"')\]]*\s+"
+_SENTENCE_END = re.compile(SENTENCE_END)
+
+# Chunks get their own pool: narration itself runs on the pipeline pool, and waiting on
+# subtasks queued behind it in the same pool could deadlock.
+_executor = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY, thread_name_prefix="story-tts")
+
+_chunk_cache = None
+_chunk_cache_lock = threading.Lock()
+
+
+def get_chunk_cache():
+    """Returns the process-wide cache of synthesized chunks, creating it on first use."""
+    global _chunk_cache
+    if _chunk_cache is None:
+        with _chunk_cache_lock:
+            if _chunk_cache is None:
+                _chunk_cache = StoryCache(os.path.join(CACHE_DIR, "tts"))
+    return _chunk_cache
+
+
+def set_chunk_cache(cache):
+    """Replaces the chunk cache (e.g. with a temporary one for benchmarks)."""
+    global _chunk_cache
+    _chunk_cache = cache
+
+
+def _sentences(text):
+    # Cut after each sentence end, keeping its closing quotes or brackets with it
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        yield text[start:match.end()].strip()
+        start = match.end()
+    if text[start:].strip():
+        yield text[start:].strip()
+
+
+def _split_long(text, max_chars):
+    # A paragraph longer than a chunk is split between sentences (or, failing that, words)
+    pieces = []
+    current = ""
+    for sentence in _sentences(text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_narration(text, max_chars=TTS_CHUNK_CHARS):
+    """
+    Splits text into chunks of at most max_chars, packing whole paragraphs together where
+    they fit. Chunk boundaries depend only on the text nearby, so a local edit leaves the
+    other chunks (and their cache entries) unchanged.
+    """
+    chunks = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        for piece in ([paragraph] if len(paragraph) <= max_chars else _split_long(paragraph, max_chars)):
+            if current and len(current) + 2 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _cached_chunk(key):
+    cached = get_chunk_cache().get(key)
+    if not cached or not cached["audio"]:
+        return None
+    with open(cached["audio"], "rb") as f:
+        audio_bytes = f.read()
+    metrics.increment("story_tts_chunks_total", source="cache")
+    return audio_bytes
+
+
+def _cache_chunk(key, text, audio_bytes):
+    metrics.increment("story_tts_chunks_total", source="api")
+    try:
+        get_chunk_cache().put(key, {"story": text, "audio": audio_bytes, "timings": {}})
+    except Exception as e:
+        print(f"Error caching narration chunk: {e}")
+
+
+def synthesize_chunk(text, voice=TTS_VOICE, model=TTS_MODEL):
+    """Returns MP3 bytes for one chunk, from the chunk cache when it has been spoken before."""
+    key = make_cache_key(text, model, voice, "", tier="tts_chunk")
+    audio_bytes = _cached_chunk(key)
+    if audio_bytes is not None:
+        return audio_bytes
+
+    with metrics.span("tts", model=model, chars=len(text)) as span:
+        audio_bytes = get_backend().speech(model=model, voice=voice, text=text)
+        span.set(bytes=len(audio_bytes))
+    _cache_chunk(key, text, audio_bytes)
+    return audio_bytes
+
+
+async def asynthesize_chunk(text, voice=TTS_VOICE, model=TTS_MODEL):
+    """synthesize_chunk() for the event loop; cache reads and writes run on the chunk pool."""
+    loop = asyncio.get_running_loop()
+    key = make_cache_key(text, model, voice, "", tier="tts_chunk")
+    audio_bytes = await loop.run_in_executor(_executor, _cached_chunk, key)
+    if audio_bytes is not None:
+        return audio_bytes
+
+    with metrics.span("tts", model=model, chars=len(text)) as span:
+        audio_bytes = await get_backend().aspeech(model=model, voice=voice, text=text)
+        span.set(bytes=len(audio_bytes))
+    await loop.run_in_executor(_executor, _cache_chunk, key, text, audio_bytes)
+    return audio_bytes
+
+
+def _strip_id3(data):
+    # ID3v2 header: "ID3", version (2 bytes), flags, then a 4-byte synchsafe size
+    if data[:3] != b"ID3" or len(data) < 10:
+        return data
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return data[10 + size:]
+
+
+def _can_decode():
+    if shutil.which("ffmpeg") is None and shutil.which("avconv") is None:
+        return False
+    try:
+        import pydub  # noqa: F401  (imported late: it warns at import time when ffmpeg is missing)
+    except ImportError:
+        return False
+    return True
+
+
+def join_audio(chunks, encode=True):
+    """
+    Joins MP3 chunks into one narration file (see the module docstring). With encode=False
+    the result stays MP3 at the API's bitrate, for partial narration that is joined again
+    later. Returns the bytes.
+    """
+    decodable = _can_decode()
+    if len(chunks) == 1 and not (encode and decodable):
+        return chunks[0]
+    if encode:
+        export_args, _, _ = media.audio_settings()
+        bitrate = media.AUDIO_BITRATE
+    else:
+        export_args, bitrate = {"format": "mp3"}, TTS_BITRATE
+    with metrics.span("audio_join", chunks=len(chunks)) as span:
+        if decodable:
+            try:
+                from pydub import AudioSegment
+                joined = AudioSegment.empty()
+                for chunk in chunks:
+                    segment = AudioSegment.from_file(io.BytesIO(chunk), format="mp3")
+                    if segment.dBFS != float("-inf"):  # Leave silent chunks alone
+                        segment = segment.apply_gain(TTS_TARGET_DBFS - segment.dBFS)
+                    joined += segment
+                buffer = io.BytesIO()
+                joined.export(buffer, bitrate=bitrate, **export_args)
+                span.set(method="pydub", format=export_args["format"], bytes=buffer.tell(),
+                         source_bytes=sum(len(chunk) for chunk in chunks))
+                return buffer.getvalue()
+            except Exception as e:
+                print(f"Error joining narration with pydub, concatenating frames instead: {e}")
+        audio_bytes = chunks[0] + b"".join(_strip_id3(chunk) for chunk in chunks[1:])
+        span.set(method="concat", bytes=len(audio_bytes))
+        return audio_bytes
+
+
+def synthesize(text, voice=TTS_VOICE, model=TTS_MODEL, encode=True):
+    """Narrates text of any length and returns it as one audio file's bytes (see join_audio)."""
+    chunks = split_narration(text)
+    if not chunks:
+        raise ValueError("Nothing to narrate")
+    audio = list(_executor.map(lambda chunk: synthesize_chunk(chunk, voice, model), chunks))
+    return join_audio(audio, encode)
+
+
+async def asynthesize(text, voice=TTS_VOICE, model=TTS_MODEL):
+    """synthesize() for the event loop. Returns one audio file's bytes."""
+    chunks = split_narration(text)
+    if not chunks:
+        raise ValueError("Nothing to narrate")
+    audio = await asyncio.gather(*(asynthesize_chunk(chunk, voice, model) for chunk in chunks))
+    # Re-encoding with pydub is CPU work; keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(_executor, join_audio, audio)
@@ -0,0 +1,193 @@
+"""
+PDF rendering for stories and storybooks.
+
+Text is wrapped by measured font widths (not character counts), and wrapped layouts are
+cached per (text, font, size, width) so re-rendering the same story (e.g. a storybook that
+includes it, or a retry) skips the layout work. Each page's text is drawn as a single text
+object. Each distinct illustration is embedded once per document as a form XObject and
+referenced wherever it appears, as a JPEG rendition (media.image_rendition) that the PDF
+carries as-is instead of as raw pixels. Output goes to an in-memory buffer, so the bytes can go
+straight to st.download_button or the cache without touching a temp file.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import media
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+PAGE_WIDTH, PAGE_HEIGHT = letter
+MARGIN_X = 50
+TEXT_WIDTH = PAGE_WIDTH - 2 * MARGIN_X
+TITLE_FONT = ("Helvetica-Bold", 18)
+BODY_FONT = ("Helvetica", 12)
+LINE_HEIGHT = 18
+TITLE_LINE_HEIGHT = 24
+BOTTOM_MARGIN = 50
+
+# The illustration fills a 250x250 pt slot; 512 px keeps it sharp in print without
+# embedding (and decoding) the full 1024x1024 original in every PDF.
+IMAGE_SIZE = 250
+IMAGE_PIXELS = 512
+_THUMBNAIL_CACHE_SIZE = 32
+_thumbnails = OrderedDict()
+_thumbnails_lock = threading.Lock()
+
+
+def _wrap_paragraph(paragraph, font_name, font_size, max_width):
+    """Greedy word wrap using real glyph widths; overlong words are split by character."""
+    space_width = stringWidth(" ", font_name, font_size)
+    lines = []
+    current, current_width = [], 0.0
+    for word in paragraph.split():
+        word_width = stringWidth(word, font_name, font_size)
+        while word_width > max_width:
+            # Break a word that can't fit on a line of its own
+            if current:
+                lines.append(" ".join(current))
+                current, current_width = [], 0.0
+            cut = len(word)
+            while cut > 1 and stringWidth(word[:cut], font_name, font_size) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+            word_width = stringWidth(word, font_name, font_size)
+        added = word_width if not current else current_width + space_width + word_width
+        if current and added > max_width:
+            lines.append(" ".join(current))
+            current, current_width = [word], word_width
+        else:
+            current.append(word)
+            current_width = added
+    if current:
+        lines.append(" ".join(current))
+    return lines
+
+
+@lru_cache(maxsize=256)
+def layout_text(text, font_name, font_size, max_width):
+    """
+    Wraps text into lines that fit max_width points, keeping a blank line after each
+    paragraph (as the original renderer did). Returns a tuple of lines; results are cached.
+    """
+    lines = []
+    for paragraph in text.split("\n"):
+        lines.extend(_wrap_paragraph(paragraph, font_name, font_size, max_width))
+        lines.append("")
+    return tuple(lines)
+
+
+def pdf_thumbnail(image_bytes):
+    """
+    Returns (digest, JPEG bytes) of a downscaled copy of the illustration. Thumbnails are
+    memoized by content, so PDFs sharing an illustration (e.g. a template's) only look it up
+    once per process.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    with _thumbnails_lock:
+        if digest in _thumbnails:
+            _thumbnails.move_to_end(digest)
+            return digest, _thumbnails[digest]
+    jpeg = media.image_rendition(image_bytes, IMAGE_PIXELS, "jpeg")
+    with _thumbnails_lock:
+        _thumbnails[digest] = jpeg
+        if len(_thumbnails) > _THUMBNAIL_CACHE_SIZE:
+            _thumbnails.popitem(last=False)
+    return digest, jpeg
+
+
+class _Document:
+    """A canvas writing to memory that embeds each distinct illustration only once."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.canvas = canvas.Canvas(self.buffer, pagesize=letter, pageCompression=1)
+        self._forms = {}
+        self.pages = 0
+
+    def illustration_form(self, image_bytes):
+        """Returns the name of a form XObject holding the illustration, creating it once."""
+        digest, jpeg = pdf_thumbnail(image_bytes)
+        name = f"illustration-{digest[:16]}"
+        if name not in self._forms:
+            c = self.canvas
+            c.beginForm(name, lowerx=0, lowery=0, upperx=IMAGE_SIZE, uppery=IMAGE_SIZE)
+            c.drawImage(ImageReader(io.BytesIO(jpeg)), 0, 0, width=IMAGE_SIZE, height=IMAGE_SIZE)
+            c.endForm()
+            self._forms[name] = True
+        return name
+
+    def draw_story(self, title, story, image_bytes=None):
+        """Lays out one story starting on a fresh page."""
+        c = self.canvas
+        if self.pages:
+            c.showPage()
+        self.pages += 1
+
+        y = PAGE_HEIGHT - 80
+        title_lines = layout_text(f"Cozy Story Time - {title}", TITLE_FONT[0], TITLE_FONT[1], TEXT_WIDTH)
+        c.setFont(*TITLE_FONT)
+        for line in title_lines:
+            if line:
+                c.drawString(MARGIN_X, y, line)
+                y -= TITLE_LINE_HEIGHT
+
+        # The illustration sits centred under the title; text follows it (or the title)
+        text_top = y - 20
+        if image_bytes:
+            try:
+                form = self.illustration_form(image_bytes)
+                image_bottom = min(PAGE_HEIGHT - 350, y - IMAGE_SIZE)
+                c.saveState()
+                c.translate((PAGE_WIDTH - IMAGE_SIZE) / 2, image_bottom)
+                c.doForm(form)
+                c.restoreState()
+                text_top = image_bottom - 40
+            except Exception as e:
+                print("Error embedding image:", e)
+
+        # One text object per page instead of a drawString call per line
+        y = text_top
+        text = c.beginText(MARGIN_X, y)
+        text.setFont(*BODY_FONT)
+        text.setLeading(LINE_HEIGHT)
+        for line in layout_text(story, BODY_FONT[0], BODY_FONT[1], TEXT_WIDTH):
+            if y < BOTTOM_MARGIN:  # Start a new page if needed
+                c.drawText(text)
+                c.showPage()
+                self.pages += 1
+                y = PAGE_HEIGHT - 100
+                text = c.beginText(MARGIN_X, y)
+                text.setFont(*BODY_FONT)
+                text.setLeading(LINE_HEIGHT)
+            text.textLine(line)
+            y -= LINE_HEIGHT
+        c.drawText(text)
+
+    def finish(self):
+        self.canvas.save()
+        return self.buffer.getvalue()
+
+
+def render_story_pdf(title, story, image_bytes=None):
+    """Renders one story to PDF and returns the bytes."""
+    document = _Document()
+    document.draw_story(title, story, image_bytes)
+    return document.finish()
+
+
+def render_storybook(stories):
+    """
+    Renders many stories into a single storybook PDF and returns (pdf_bytes, page_count).
+    stories is an iterable of (title, story, image_bytes) tuples; illustrations shared
+    between stories are embedded once.
+    """
+    document = _Document()
+    for title, story, image_bytes in stories:
+        document.draw_story(title, story, image_bytes)
+    return document.finish(), document.pages
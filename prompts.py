@@ -0,0 +1,145 @@
+"""
+Story prompt construction and token budgeting.
+
+The instructions are the same for every story, so they are kept in one static system
+message, built once, and everything that varies (topic, length, name) goes in a short user
+message after it. Every request then starts with the same tokens, which lets the provider
+reuse its cached prefix (OpenAI caches prompt prefixes of 1024 tokens or more) and keeps
+indentation and repeated text out of the input.
+
+Tokens are counted locally with tiktoken when it is installed, and estimated at about four
+characters per token otherwise. Each story length has a completion budget (max_tokens), and
+over-long free-text topics are trimmed to MAX_TOPIC_TOKENS.
+"""
+import functools
+
+TOKENIZER_MODEL = "gpt-4o"
+NAME_PLACEHOLDER = "CHILD_NAME"  # stand-in for the child's name in shared story templates
+REFUSAL_MESSAGE = "Sorry, I cannot create a story on this topic."
+
+# Completion budget per story length: 2-3 minutes of narration is about 400 words, 5-7
+# minutes about 900, at roughly 3/4 of a word per token, plus headroom
+MAX_OUTPUT_TOKENS = {"short": 800, "medium": 1600}
+MAX_TOPIC_TOKENS = 150
+
+LENGTH_DETAILS = {
+    "short": ("2-3 minutes", "2-3"),
+    "medium": ("5-7 minutes", "3-4"),
+}
+
+STORY_INSTRUCTIONS = f"""You write gentle bedtime stories for children aged 3-5.
+
+**Safety rules:**
+- If the topic contains **violence**, **vulgarity**, **scary content**, **evil characters**, **battles**, or anything inappropriate for children aged 3-5, **DO NOT** create the story.
+- In such cases, respond only with: **"{REFUSAL_MESSAGE}"**
+- If the topic is unclear or potentially inappropriate, err on the side of caution and do not generate the story.
+
+**Story requirements:**
+- Transform the given topic into a calm, bedtime-appropriate narrative
+- Include no more than 2-3 main characters with simple, easy-to-pronounce names
+- Set the story in a peaceful environment (bedroom, garden, or under the stars)
+- Weave in familiar bedtime routines and comfort objects
+- Use simple words and short sentences (5-8 words)
+- Use the number of scenes given in the request
+- Add gentle repetitive phrases that children can predict and say along
+- Include 2-3 soft sound effects (like "whoosh" of wind or "twinkle" of stars)
+- Add 1-2 interactive moments where children can mimic actions (stretching, yawning, counting)
+- End with characters feeling sleepy and peaceful
+
+**Writing style:**
+- Use soothing descriptive words (soft, cozy, warm, snuggly)
+- Keep sentences simple and direct
+- Include gentle parent/caregiver figures
+- Avoid any scary elements or conflicts
+- Include mild, calming humor if appropriate
+- Use a rhythmic, peaceful tone throughout
+
+**Format:**
+- Clear beginning introducing the peaceful setting and characters
+- Middle focusing on gentle activities and bedtime routines
+- Calm ending with characters getting sleepy and going to bed
+- Simple questions or prompts in [brackets] for parent-child interaction
+
+The request follows."""
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception:  # Not installed, or the encoding couldn't be loaded
+        return None
+
+
+def count_tokens(text):
+    """Number of tokens in text for TOKENIZER_MODEL (estimated without tiktoken)."""
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """Cuts text down to at most max_tokens tokens."""
+    encoding = _encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text)
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+@functools.lru_cache(maxsize=1)
+def prefix_tokens():
+    """Tokens in the static instructions, i.e. the part of every prompt that can be cached."""
+    return count_tokens(STORY_INSTRUCTIONS)
+
+
+def max_output_tokens(story_length):
+    return MAX_OUTPUT_TOKENS.get(story_length, max(MAX_OUTPUT_TOKENS.values()))
+
+
+def story_request(story_topic, story_length="short", child_name=""):
+    """The variable part of the prompt: the request itself."""
+    minutes, scenes = LENGTH_DETAILS.get(story_length, LENGTH_DETAILS["medium"])
+    topic = " ".join(story_topic.split())
+    if count_tokens(topic) > MAX_TOPIC_TOKENS:
+        topic = truncate_tokens(topic, MAX_TOPIC_TOKENS)
+    lines = [
+        f"Create a gentle bedtime story for children aged 3-5 years old about {topic}.",
+        f"Story length: {story_length.upper()} ({minutes}), with {scenes} scenes.",
+    ]
+    if child_name.strip():
+        lines.append(f"Make {child_name.strip()} the main character of the story.")
+    if child_name == NAME_PLACEHOLDER:
+        lines.append(f"Always write the main character name exactly as {NAME_PLACEHOLDER}, "
+                     "it is replaced with the real name later.")
+    return "\n".join(lines)
+
+
+def story_messages(story_topic, story_length="short", child_name=""):
+    """Chat messages for a story: the static instructions, then the request."""
+    return [
+        {"role": "system", "content": STORY_INSTRUCTIONS},
+        {"role": "user", "content": story_request(story_topic, story_length, child_name)},
+    ]
+
+
+def usage_timings(usage, messages):
+    """
+    Token figures for a story's timings: prompt and completion tokens (as reported by the
+    backend, or counted locally), the size of the static prefix, and the share of the prompt
+    served from the provider's prefix cache.
+    """
+    prompt_tokens = usage.get("prompt_tokens")
+    if prompt_tokens is None:
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+    cached_tokens = usage.get("cached_tokens") or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": usage.get("completion_tokens"),
+        "prefix_tokens": prefix_tokens(),
+        "cached_tokens": cached_tokens,
+        "cached_prefix_share": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+    }
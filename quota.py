@@ -0,0 +1,218 @@
+"""
+Admission control for story generation.
+
+Two limits are enforced before a story is queued:
+
+- per user (an IP address, or a session when the IP is unknown): at most `user_limit`
+  stories in any sliding `user_window`.
+- globally: at most `budget` dollars of estimated API spend in any sliding `budget_window`
+  (a minute by default), so a burst of users can't run up the bill.
+
+Admissions are rows in a SQLite table shared by every worker process. An admission
+re-counts both windows and inserts its row in one BEGIN IMMEDIATE transaction, so
+concurrent workers can't both take the last slot. An in-memory hot tier mirrors the recent
+rows for up to `hot_ttl` seconds (1 s by default): a check() within that time of the last
+one for the same subject is served from memory, any other costs two indexed SQLite reads.
+Requests that are clearly over a limit are shed from the hot tier without a write. Subjects
+not looked at for longer than `hot_ttl` are dropped from it once a minute.
+
+A story that turns out to be served from the cache costs nothing, and neither does a
+failed one; refund() gives the slot back.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from story_cache import CACHE_DIR
+
+QUOTA_DB = os.getenv("STORY_QUOTA_DB", os.path.join(CACHE_DIR, "quota.sqlite3"))
+USER_LIMIT = int(os.getenv("STORY_QUOTA_USER_LIMIT", "4"))  # stories per user window
+USER_WINDOW_SECONDS = int(os.getenv("STORY_QUOTA_USER_WINDOW", str(8 * 60 * 60)))  # 8 hours
+BUDGET_PER_WINDOW = float(os.getenv("STORY_QUOTA_BUDGET", "3.0"))  # dollars per budget window
+BUDGET_WINDOW_SECONDS = int(os.getenv("STORY_QUOTA_BUDGET_WINDOW", "60"))
+HOT_TTL_SECONDS = float(os.getenv("STORY_QUOTA_HOT_TTL", "1.0"))
+
+# Rough API cost of one fresh story in dollars: chat completion, a DALL-E 3 image and TTS
+STORY_COSTS = {"short": 0.07, "medium": 0.09}
+
+Decision = namedtuple("Decision", "allowed reason retry_after ticket")
+
+
+def estimate_cost(story_length):
+    return STORY_COSTS.get(story_length, max(STORY_COSTS.values()))
+
+
+class QuotaService:
+    """Sliding-window limits per user and on global spend, persisted in SQLite."""
+
+    def __init__(self, path=QUOTA_DB, user_limit=USER_LIMIT, user_window=USER_WINDOW_SECONDS,
+                 budget=BUDGET_PER_WINDOW, budget_window=BUDGET_WINDOW_SECONDS, hot_ttl=HOT_TTL_SECONDS):
+        self.path = path
+        self.user_limit = user_limit
+        self.user_window = user_window
+        self.budget = budget
+        self.budget_window = budget_window
+        self.hot_ttl = hot_ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hot_users = {}  # subject -> (loaded_at, sorted admission times)
+        self._hot_spend = (0.0, [])  # (loaded_at, [(time, cost)])
+        self._last_prune = 0.0
+        self._last_hot_eviction = 0.0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS admissions (id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT, ts REAL, cost REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS admissions_subject ON admissions (subject, ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS admissions_ts ON admissions (ts)")
+
+    def _connect(self):
+        # One connection per thread, in autocommit mode so transactions are explicit
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load_user(self, conn, subject, now):
+        rows = conn.execute(
+            "SELECT ts FROM admissions WHERE subject = ? AND ts > ? ORDER BY ts",
+            (subject, now - self.user_window),
+        ).fetchall()
+        times = [ts for (ts,) in rows]
+        with self._lock:
+            self._hot_users[subject] = (now, times)
+        return times
+
+    def _load_spend(self, conn, now):
+        rows = conn.execute(
+            "SELECT ts, cost FROM admissions WHERE ts > ? ORDER BY ts", (now - self.budget_window,)
+        ).fetchall()
+        with self._lock:
+            self._hot_spend = (now, rows)
+        return rows
+
+    def _evict_hot(self, now):
+        # Stale entries would be reloaded before use anyway; dropping them keeps the tier
+        # from growing with every subject ever seen
+        if now - self._last_hot_eviction < 60:
+            return
+        with self._lock:
+            self._last_hot_eviction = now
+            for subject in [subject for subject, (loaded_at, _) in self._hot_users.items()
+                            if now - loaded_at > self.hot_ttl]:
+                del self._hot_users[subject]
+
+    def _hot(self, subject, now):
+        """Returns (user admission times, [(time, cost)] spend) from memory, reloading stale parts."""
+        self._evict_hot(now)
+        with self._lock:
+            user = self._hot_users.get(subject)
+            spend = self._hot_spend
+        if user is None or now - user[0] > self.hot_ttl:
+            times = self._load_user(self._connect(), subject, now)
+        else:
+            times = user[1]
+        if now - spend[0] > self.hot_ttl:
+            rows = self._load_spend(self._connect(), now)
+        else:
+            rows = spend[1]
+        return ([ts for ts in times if ts > now - self.user_window],
+                [(ts, cost) for ts, cost in rows if ts > now - self.budget_window])
+
+    def _decide(self, times, spend, cost, now):
+        if len(times) >= self.user_limit:
+            # A slot frees up when the oldest admission in the window expires
+            retry_after = times[len(times) - self.user_limit] + self.user_window - now
+            return Decision(False, "user_limit", max(retry_after, 0.0), None)
+        total = sum(row_cost for _, row_cost in spend)
+        if total + cost > self.budget:
+            retry_after = 0.0
+            for ts, row_cost in spend:
+                total -= row_cost
+                retry_after = ts + self.budget_window - now
+                if total + cost <= self.budget:
+                    break
+            return Decision(False, "global_budget", max(retry_after, 0.0), None)
+        return Decision(True, "ok", 0.0, None)
+
+    def check(self, subject, cost=0.0):
+        """Whether subject could start a story now, from the hot tier when it is fresh (never a write)."""
+        now = time.time()
+        times, spend = self._hot(subject, now)
+        return self._decide(times, spend, cost, now)
+
+    def admit(self, subject, cost):
+        """
+        Admits one story for subject, or sheds it. Returns a Decision whose ticket identifies
+        the admission for refund().
+        """
+        now = time.time()
+        decision = self.check(subject, cost)
+        if decision.allowed:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                times = self._load_user(conn, subject, now)
+                spend = self._load_spend(conn, now)
+                decision = self._decide(times, spend, cost, now)
+                if decision.allowed:
+                    ticket = conn.execute(
+                        "INSERT INTO admissions (subject, ts, cost) VALUES (?, ?, ?)", (subject, now, cost)
+                    ).lastrowid
+                    decision = decision._replace(ticket=ticket)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if decision.allowed:
+                with self._lock:
+                    self._hot_users[subject] = (now, times + [now])
+                    self._hot_spend = (now, spend + [(now, cost)])
+                    metrics.set_gauge("story_quota_spend", sum(c for _, c in self._hot_spend[1]))
+                self._prune(conn, now)
+        metrics.increment("story_quota_decisions_total", outcome="admitted" if decision.allowed else decision.reason)
+        return decision
+
+    def refund(self, ticket):
+        """Gives back an admission (the story came from the cache, or failed)."""
+        if ticket is None:
+            return
+        conn = self._connect()
+        row = conn.execute("SELECT subject FROM admissions WHERE id = ?", (ticket,)).fetchone()
+        conn.execute("DELETE FROM admissions WHERE id = ?", (ticket,))
+        with self._lock:
+            if row:
+                self._hot_users.pop(row[0], None)
+            self._hot_spend = (0.0, [])
+        metrics.increment("story_quota_refunds_total")
+
+    def _prune(self, conn, now):
+        # Rows older than both windows are never read again; drop them once a minute
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        conn.execute("DELETE FROM admissions WHERE ts < ?", (now - max(self.user_window, self.budget_window),))
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_quota_service():
+    """Returns the process-wide QuotaService, creating it on first use."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = QuotaService()
+    return _service
+
+
+def set_quota_service(service):
+    global _service
+    _service = service
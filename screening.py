@@ -0,0 +1,204 @@
+"""
+Local pre-screen for topics the model would refuse.
+
+Without it an inappropriate topic is only caught after a full GPT-4o round-trip, when the
+reply turns out to be the refusal message. screen() catches the obvious cases first:
+
+- a keyword matcher: an Aho-Corasick automaton over BLOCKED_TERMS (plus any terms in
+  STORY_BLOCKED_TERMS, comma-separated), matched against whole words of the topic in a
+  single pass;
+- a refusal cache: topics the model has refused before, keyed on the normalized topic, so a
+  refused topic is not sent again for another length or child's name. Refusals live in their
+  own SQLite file next to the story cache, so they don't count as story cache misses or
+  take up its space.
+
+The keyword list only holds terms that are never fine in a bedtime story. Words that are
+also innocent ("devil" in Tasmanian devil, "battle" in pillow battle, "blood" in blood
+orange) are left to the model, whose own check remains the authority.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+from story_cache import CACHE_DIR
+
+BLOCKED_TERMS = (
+    "murder", "murders", "murdered", "gore", "gory", "shot dead", "stabbing", "stabbed to death",
+    "knife fight", "torture", "tortured", "dead body", "dead bodies", "corpse", "corpses",
+    "suicide", "sexy", "porn", "shit", "fuck",
+)
+EXTRA_BLOCKED_TERMS = tuple(term.strip() for term in os.getenv("STORY_BLOCKED_TERMS", "").split(",") if term.strip())
+REFUSAL_DB = os.getenv("STORY_REFUSAL_DB", os.path.join(CACHE_DIR, "refusals.sqlite3"))
+REFUSAL_CACHE_ENTRIES = int(os.getenv("STORY_REFUSAL_CACHE_ENTRIES", "10000"))
+
+
+def normalize_topic(text):
+    """Lower-cased words of text separated by single spaces, without punctuation."""
+    return " ".join(re.findall(r"[a-z0-9']+", (text or "").lower()))
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton that finds whole-word (or whole-phrase) terms in one pass."""
+
+    def __init__(self, terms):
+        # Terms are padded with spaces and matched against padded, normalized text, so
+        # "war" matches "a war" but not "warm" or "award"
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        for term in terms:
+            term = normalize_topic(term)
+            if not term:
+                continue
+            state = 0
+            for char in f" {term} ":
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state] = term
+        # Breadth-first pass for the failure links (the root's children fall back to the root);
+        # each state inherits the output of its fallback
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+
+    def search(self, text):
+        """Returns the first blocked term found in text, or None."""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in f" {normalize_topic(text)} ":
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class RefusalCache:
+    """
+    Topics the model has refused. Held in a bounded in-memory LRU for lookups in
+    microseconds, and written through to a shared SQLite table so other workers (and
+    restarts) learn them too. Both keep at most max_entries topics.
+    """
+
+    def __init__(self, path=REFUSAL_DB, max_entries=REFUSAL_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS refusals (topic TEXT PRIMARY KEY, created REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS refusals_created ON refusals (created)")
+
+    def _connect(self):
+        # SQLite connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember_locally(self, topic):
+        with self._lock:
+            self._entries[topic] = True
+            self._entries.move_to_end(topic)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, story_topic):
+        topic = normalize_topic(story_topic)
+        with self._lock:
+            if topic in self._entries:
+                self._entries.move_to_end(topic)
+                return True
+        # Another worker may have seen the refusal
+        try:
+            row = self._connect().execute("SELECT 1 FROM refusals WHERE topic = ?", (topic,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading refused topics: {e}")
+            return False
+        if row is None:
+            return False
+        self._remember_locally(topic)
+        return True
+
+    def add(self, story_topic):
+        topic = normalize_topic(story_topic)
+        self._remember_locally(topic)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO refusals (topic, created) VALUES (?, ?)", (topic, time.time()))
+                conn.execute(
+                    "DELETE FROM refusals WHERE topic IN "
+                    "(SELECT topic FROM refusals ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+        except sqlite3.Error as e:
+            print(f"Error caching refused topic: {e}")
+
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM refusals").fetchone()[0]
+
+
+_matcher = KeywordMatcher(BLOCKED_TERMS + EXTRA_BLOCKED_TERMS)
+_refusals = None
+_refusals_lock = threading.Lock()
+
+
+def get_refusal_cache():
+    """Returns the process-wide RefusalCache, creating it on first use."""
+    global _refusals
+    if _refusals is None:
+        with _refusals_lock:
+            if _refusals is None:
+                _refusals = RefusalCache()
+    return _refusals
+
+
+def set_refusal_cache(cache):
+    global _refusals
+    _refusals = cache
+
+
+def screen(story_topic, use_cache=True):
+    """
+    Returns why story_topic is refused without asking the model ("keyword" or
+    "refusal_cache"), or None if it has to go to the model.
+    """
+    if _matcher.search(story_topic) is not None:
+        reason = "keyword"
+    elif use_cache and story_topic in get_refusal_cache():
+        reason = "refusal_cache"
+    else:
+        metrics.increment("story_prescreen_total", outcome="passed")
+        return None
+    metrics.increment("story_prescreen_total", outcome=reason)
+    # Each refusal caught here is a chat completion that didn't have to be made
+    metrics.increment("story_upstream_calls_saved_total", reason=reason)
+    return reason
+
+
+def remember_refusal(story_topic):
+    """Records that the model refused story_topic."""
+    get_refusal_cache().add(story_topic)
+    metrics.increment("story_model_refusals_total")
@@ -0,0 +1,330 @@
+"""
+HTTP service for story generation, outside Streamlit.
+
+A plain ASGI application (no framework): run it with any ASGI server, e.g.
+
+    uvicorn service:app
+
+One process serves many generations at once on one event loop (see
+story_generator.agenerate_story_and_image and jobs.AsyncJobQueue). Jobs live in that
+process's memory, so GET /jobs/<id> must reach the process that took the POST, and
+identical requests are only joined within one process. Run a single worker per host, or
+put several behind routing that sends a client to the same worker every time. The story
+cache, quota and similarity index are shared through SQLite either way.
+
+Endpoints:
+
+    POST /stories               {"topic", "tone", "details", "length", "child_name"}
+                                -> 202 {"job_id", "status_url"}; 429 over quota; 503 queue full
+    GET  /jobs/<id>[?wait=s]    job status, stages and, once done, story, timings and
+                                artifact URLs; with wait, holds the request until the job
+                                finishes (at most MAX_WAIT_SECONDS)
+    GET  /jobs/<id>/<artifact>  the job's image, audio or pdf; files answer Range requests
+                                and are streamed in chunks. image takes ?width= and
+                                ?format=webp|jpeg for a resized rendition (see media.py)
+    GET  /healthz               liveness and queue stats
+    GET  /metrics               Prometheus metrics
+
+Requests are admitted by the quota service, per client IP (taken from X-Forwarded-For when
+STORY_TRUST_FORWARDED_FOR=1); admissions for stories that cost nothing are refunded.
+Blocking SQLite and file I/O runs on thread pools, never on the event loop: quota checks
+and artifact reads here, and the generator's pre-screen, cache and template lookups, cache
+writes, artifact writes and PDF layout (see story_generator._in_pool).
+"""
+import asyncio
+import json
+import os
+import re
+from urllib.parse import parse_qs
+
+import media
+import metrics
+import story_generator
+from jobs import AsyncJobQueue, QueueFull
+from quota import estimate_cost, get_quota_service
+
+MAX_BODY_BYTES = 64 * 1024
+MAX_WAIT_SECONDS = 60
+TRUST_FORWARDED_FOR = os.getenv("STORY_TRUST_FORWARDED_FOR", "0") == "1"  # only behind a proxy that sets it
+FIELD_LIMITS = {"topic": 100, "tone": 100, "details": 500, "child_name": 50}
+
+ARTIFACT_TYPES = {"image": "image/png", "audio": "audio/mpeg", "pdf": "application/pdf"}
+STREAM_CHUNK_BYTES = 64 * 1024
+
+_queue = None
+_settling = set()  # Strong references to the settle tasks
+
+
+def get_queue():
+    """Returns this process's AsyncJobQueue, creating it on the running loop."""
+    global _queue
+    if _queue is None:
+        _queue = AsyncJobQueue()
+    return _queue
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or []
+
+
+async def _send(send, status, body, content_type, headers=None):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+        + [(name.encode(), value.encode()) for name, value in headers or []],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, status, payload, headers=None):
+    await _send(send, status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+        if not message.get("more_body"):
+            return body
+
+
+def client_subject(scope):
+    """Quota subject for a request: the client's IP address."""
+    headers = dict(scope.get("headers") or [])
+    forwarded = headers.get(b"x-forwarded-for")
+    if TRUST_FORWARDED_FOR and forwarded:
+        return f"ip:{forwarded.decode('latin-1').split(',')[0].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "ip:unknown"
+
+
+def _parse_request(body):
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "Body must be JSON") from None
+    if not isinstance(payload, dict):
+        raise HTTPError(400, "Body must be a JSON object")
+    fields = {}
+    for name, limit in FIELD_LIMITS.items():
+        value = payload.get(name) or ""
+        if not isinstance(value, str) or len(value) > limit:
+            raise HTTPError(400, f"{name} must be a string of at most {limit} characters")
+        fields[name] = value.strip()
+    if not fields["topic"]:
+        raise HTTPError(400, "topic is required")
+    length = str(payload.get("length") or "short").lower()
+    if length not in story_generator.STORY_LENGTHS:
+        raise HTTPError(400, f"length must be one of {', '.join(story_generator.STORY_LENGTHS)}")
+    story_topic = story_generator.build_story_topic(
+        fields["topic"], fields["tone"] or story_generator.STORY_TONES[0], fields["details"])
+    return story_topic, length, fields["child_name"]
+
+
+async def _settle(job):
+    """Records the finished request and refunds its admission if the story cost nothing."""
+    await get_queue().wait(job)
+    timings = job.result["timings"] if job.result else {}
+    metrics.record_request(timings, topic=job.story_topic, length=job.story_length)
+    if job.status == "failed" or timings.get("from_cache") or timings.get("prescreened"):
+        await _blocking(get_quota_service().refund, job.ticket)
+
+
+async def create_story(scope, receive, send):
+    story_topic, length, child_name = _parse_request(await _read_body(receive))
+    quota = get_quota_service()
+    decision = await _blocking(quota.admit, client_subject(scope), estimate_cost(length))
+    if not decision.allowed:
+        raise HTTPError(429, decision.reason, [("retry-after", str(int(decision.retry_after) + 1))])
+    try:
+        job = get_queue().submit(story_topic, length, child_name, decision.ticket)
+    except QueueFull:
+        await _blocking(quota.refund, decision.ticket)
+        raise HTTPError(503, "Too many stories are being written right now", [("retry-after", "5")]) from None
+    if job.ticket != decision.ticket:
+        await _blocking(quota.refund, decision.ticket)  # Joined an identical request that is already paid for
+    else:
+        task = asyncio.get_running_loop().create_task(_settle(job))
+        _settling.add(task)
+        task.add_done_callback(_settling.discard)
+    await _send_json(send, 202, {"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"},
+                     [("location", f"/jobs/{job.id}")])
+
+
+def _job_payload(job):
+    payload = {
+        "id": job.id,
+        "status": job.status,
+        "stages": job.stages,
+        "progress": round(job.progress(), 2),
+        "story": job.story_text,
+        "error": job.error,
+    }
+    if job.result is not None:
+        payload["timings"] = job.result["timings"]
+        payload["artifacts"] = {kind: f"/jobs/{job.id}/{kind}" if job.result.get(kind) else None
+                                for kind in ARTIFACT_TYPES}
+    return payload
+
+
+def _find_job(job_id):
+    job = get_queue().get(job_id)
+    if job is None:
+        raise HTTPError(404, "No such job")
+    return job
+
+
+async def job_status(scope, send, job_id):
+    job = _find_job(job_id)
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    try:
+        wait = min(float(query.get("wait", ["0"])[0]), MAX_WAIT_SECONDS)
+    except ValueError:
+        raise HTTPError(400, "wait must be a number of seconds") from None
+    if wait > 0 and not job.finished:
+        await get_queue().wait(job, wait)
+    await _send_json(send, 200, _job_payload(job))
+
+
+def _blocking(func, *args):
+    return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+def _read_chunk(path, offset, size):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def _byte_range(header, total):
+    """Parses a single "bytes=start-end" Range header. Returns (start, end) inclusive, or None."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None  # Multipart ranges aren't worth supporting; send the whole file
+    match = re.fullmatch(r"(\d*)-(\d*)", spec.strip())
+    if match is None or not any(match.groups()):
+        return None  # Malformed, so ignored as the RFC says
+    first, last = match.groups()
+    if not first:
+        start, end = max(total - int(last), 0), total - 1  # The last N bytes
+    else:
+        start, end = int(first), min(int(last), total - 1) if last else total - 1
+    if start > end or start >= total:
+        raise HTTPError(416, "Range not satisfiable", [("content-range", f"bytes */{total}")])
+    return start, end
+
+
+async def _send_file(scope, send, path, content_type, headers):
+    """Streams a file in chunks, honouring a Range request header. Raises FileNotFoundError."""
+    total = await _blocking(os.path.getsize, path)
+    range_header = dict(scope.get("headers") or []).get(b"range")
+    byte_range = _byte_range(range_header.decode("latin-1"), total) if range_header and total else None
+    start, end = byte_range or (0, total - 1)
+    headers = headers + [("accept-ranges", "bytes")]
+    if byte_range:
+        headers.append(("content-range", f"bytes {start}-{end}/{total}"))
+    await send({
+        "type": "http.response.start",
+        "status": 206 if byte_range else 200,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(end - start + 1).encode())]
+        + [(name.encode(), value.encode()) for name, value in headers],
+    })
+    offset, body = start, b""
+    while offset <= end:
+        try:
+            body = await _blocking(_read_chunk, path, offset, min(STREAM_CHUNK_BYTES, end - offset + 1))
+        except FileNotFoundError:
+            body = b""
+        if not body:
+            break  # Evicted mid-stream; the client sees a short body
+        offset += len(body)
+        if offset <= end:
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            body = b""
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_rendition(scope, send, image):
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    fmt = query.get("format", ["webp"])[0]
+    if fmt not in media.IMAGE_FORMATS:
+        raise HTTPError(400, f"format must be one of {', '.join(media.IMAGE_FORMATS)}")
+    try:
+        width = int(query.get("width", [media.DISPLAY_WIDTH])[0])
+    except ValueError:
+        raise HTTPError(400, "width must be a number of pixels") from None
+    try:
+        data = await _blocking(media.image_rendition, image, width, fmt)
+    except FileNotFoundError:
+        raise HTTPError(410, "The image has expired") from None
+    await _send(send, 200, data, media.IMAGE_FORMATS[fmt][1], [("cache-control", "private, max-age=3600")])
+
+
+async def job_artifact(scope, send, job_id, kind):
+    job = _find_job(job_id)
+    if kind not in ARTIFACT_TYPES:
+        raise HTTPError(404, "No such artifact")
+    artifact = job.result.get(kind) if job.result else None
+    if not artifact:
+        raise HTTPError(404, f"The job has no {kind}")
+    if kind == "image" and scope.get("query_string"):
+        return await _send_rendition(scope, send, artifact)
+    content_type = ARTIFACT_TYPES[kind]
+    headers = [("content-disposition", 'attachment; filename="bedtime_story.pdf"')] if kind == "pdf" else []
+    if not isinstance(artifact, str):
+        if kind == "audio":
+            content_type = media.audio_mime(artifact)
+        return await _send(send, 200, artifact, content_type, headers)
+    try:
+        if kind == "audio":
+            content_type = await _blocking(media.audio_mime, artifact)
+        await _send_file(scope, send, artifact, content_type, headers)
+    except FileNotFoundError:
+        raise HTTPError(410, f"The {kind} has expired") from None
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            story_generator.warm_up()
+            get_queue()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    method = scope["method"]
+    parts = [part for part in scope["path"].split("/") if part]
+    try:
+        if parts == ["stories"] and method == "POST":
+            await create_story(scope, receive, send)
+        elif len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+            await job_status(scope, send, parts[1])
+        elif len(parts) == 3 and parts[0] == "jobs" and method == "GET":
+            await job_artifact(scope, send, parts[1], parts[2])
+        elif parts == ["healthz"] and method == "GET":
+            await _send_json(send, 200, {"status": "ok", "jobs": get_queue().stats()})
+        elif parts == ["metrics"] and method == "GET":
+            await _send(send, 200, metrics.export_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            raise HTTPError(404, "Not found")
+    except HTTPError as e:
+        await _send_json(send, e.status, {"error": str(e)}, e.headers)
+    except Exception as e:
+        print(f"Error handling {method} {scope['path']}: {e}")
+        await _send_json(send, 500, {"error": "Internal error"})
@@ -0,0 +1,231 @@
+"""
+Near-duplicate lookup for story requests.
+
+The exact cache key misses requests that differ only in wording, e.g. "Space - a bunny on
+the moon" and "space - bunny on moon". Every cached request is also indexed here by a
+MinHash signature of its normalized words and word pairs (lower-cased, punctuation and
+stop words dropped, plurals folded). A lookup compares the query's signature with every
+indexed one in a single vectorized NumPy operation and returns the closest entry when its
+estimated Jaccard similarity reaches the threshold.
+
+Only requests that could share a story are compared. They must have the same tier, story
+length and child's name, and the same topic and tone: for app requests the fuzzy part is
+the free-text details after " - ". Signatures are kept in SQLite next to the story cache, so
+all workers share them; each process holds a NumPy copy and picks up new rows as it goes.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from story_cache import CACHE_DIR, normalize_text
+
+SIMILARITY_DB = os.getenv("STORY_SIMILARITY_DB", os.path.join(CACHE_DIR, "similarity.sqlite3"))
+SIMILARITY_THRESHOLD = float(os.getenv("STORY_SIMILARITY_THRESHOLD", "0.8"))  # above 1 disables it
+SYNC_INTERVAL_SECONDS = 1.0  # how often a process looks for rows other workers added
+
+NUM_HASHES = 64
+_PRIME = 4294967311  # smallest prime above 2**32
+_rng = np.random.default_rng(20240601)  # fixed, so every process computes the same signatures
+_HASH_A = _rng.integers(1, 2 ** 32, NUM_HASHES, dtype=np.uint64)
+_HASH_B = _rng.integers(0, 2 ** 32, NUM_HASHES, dtype=np.uint64)
+
+STOP_WORDS = frozenset(
+    "a an the and or of on in at to for with about into from by is are was be it its his her "
+    "their my our your this that these those some very story".split()
+)
+
+
+def normalize_tokens(text):
+    """Lower-cased words without punctuation or stop words, with simple plurals folded."""
+    tokens = []
+    for word in re.findall(r"[a-z0-9']+", normalize_text(text)):
+        word = word.strip("'")
+        if not word or word in STOP_WORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def _features(text):
+    tokens = normalize_tokens(text)
+    return set(tokens) | {f"{first} {second}" for first, second in zip(tokens, tokens[1:])}
+
+
+def signature(text):
+    """MinHash signature (NUM_HASHES uint32 values) of text, or None if it has no words left."""
+    features = _features(text)
+    if not features:
+        return None
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=4).digest(), "little") for f in features],
+        dtype=np.uint64,
+    )
+    permuted = (_HASH_A[:, None] * hashes[None, :] + _HASH_B[:, None]) % _PRIME
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def split_request(story_topic):
+    """Splits an app request into its exact part (topic and tone) and its free-text details."""
+    base, separator, details = story_topic.partition(" - ")
+    if not separator:
+        return "", story_topic
+    return normalize_text(base), details
+
+
+class _Partition:
+    """Signatures that may be compared with each other, in a growable NumPy array."""
+
+    def __init__(self):
+        self.signatures = np.empty((16, NUM_HASHES), dtype=np.uint32)
+        self.keys = []
+
+    def add(self, key, sig):
+        if len(self.keys) == len(self.signatures):
+            grown = np.empty((2 * len(self.signatures), NUM_HASHES), dtype=np.uint32)
+            grown[:len(self.keys)] = self.signatures
+            self.signatures = grown
+        self.signatures[len(self.keys)] = sig
+        self.keys.append(key)
+
+    def remove(self, key):
+        """Drops key's row, moving the last row into its place. Returns whether it was there."""
+        try:
+            i = self.keys.index(key)
+        except ValueError:
+            return False
+        last = len(self.keys) - 1
+        self.signatures[i] = self.signatures[last]
+        self.keys[i] = self.keys[last]
+        self.keys.pop()
+        return True
+
+    def nearest(self, sig):
+        if not self.keys:
+            return None, 0.0
+        matches = np.count_nonzero(self.signatures[:len(self.keys)] == sig, axis=1)
+        best = int(matches.argmax())
+        return self.keys[best], matches[best] / NUM_HASHES
+
+
+class SimilarityIndex:
+    """Shared MinHash index of cached requests, keyed by cache key."""
+
+    def __init__(self, path=SIMILARITY_DB, threshold=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._partitions = {}
+        self._last_id = 0
+        self._last_sync = 0.0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS signatures (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "partition TEXT, key TEXT, signature BLOB, UNIQUE (partition, key))"
+            )
+
+    def _connect(self):
+        # SQLite connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _sync(self, force=False):
+        """Loads rows added since the last sync (by this or another process)."""
+        now = time.monotonic()
+        if not force and now - self._last_sync < SYNC_INTERVAL_SECONDS:
+            return
+        rows = self._connect().execute(
+            "SELECT id, partition, key, signature FROM signatures WHERE id > ? ORDER BY id", (self._last_id,)
+        ).fetchall()
+        with self._lock:
+            for row_id, partition, key, blob in rows:
+                if row_id <= self._last_id:
+                    continue  # Loaded by a concurrent sync
+                self._partitions.setdefault(partition, _Partition()).add(key, np.frombuffer(blob, dtype=np.uint32))
+                self._last_id = row_id
+            self._last_sync = now
+
+    @staticmethod
+    def partition(tier, story_topic, story_length, child_name):
+        base, _ = split_request(story_topic)
+        return json.dumps([tier, normalize_text(story_length), normalize_text(child_name), base])
+
+    def add(self, key, tier, story_topic, story_length, child_name):
+        """Indexes a cached request under its cache key."""
+        _, details = split_request(story_topic)
+        sig = signature(details)
+        if sig is None:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO signatures (partition, key, signature) VALUES (?, ?, ?)",
+                (self.partition(tier, story_topic, story_length, child_name), key, sig.tobytes()),
+            )
+        self._sync(force=True)
+
+    def nearest(self, tier, story_topic, story_length, child_name):
+        """Returns (cache key, similarity) of the closest indexed request, or (None, score)."""
+        with metrics.span("similarity_lookup", tier=tier) as span:
+            _, details = split_request(story_topic)
+            sig = signature(details)
+            if sig is None:
+                return None, 0.0
+            self._sync()
+            with self._lock:
+                part = self._partitions.get(self.partition(tier, story_topic, story_length, child_name))
+                key, score = part.nearest(sig) if part else (None, 0.0)
+            span.set(entries=len(part.keys) if part else 0, score=round(float(score), 3))
+        hit = key is not None and score >= self.threshold
+        metrics.increment("story_similarity_lookups_total", tier=tier, outcome="hit" if hit else "miss")
+        return (key if hit else None), float(score)
+
+    def remove(self, key):
+        """Forgets a key whose cache entry is gone (expired or evicted)."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM signatures WHERE key = ?", (key,))
+        with self._lock:
+            for part in self._partitions.values():
+                while part.remove(key):
+                    pass
+        metrics.increment("story_similarity_stale_total")
+
+    def size(self):
+        with self._lock:
+            return sum(len(part.keys) for part in self._partitions.values())
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index():
+    """Returns the process-wide SimilarityIndex, creating it on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SimilarityIndex()
+    return _index
+
+
+def set_similarity_index(index):
+    """Replaces the process-wide SimilarityIndex (e.g. with a temporary one for benchmarks)."""
+    global _index
+    _index = index
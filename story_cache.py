@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Cache location and limits (overridable through environment variables)
+CACHE_DIR = os.getenv("STORY_CACHE_DIR", os.path.join(os.getcwd(), ".story_cache"))
+CACHE_MAX_BYTES = int(os.getenv("STORY_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))  # 500 MB
+CACHE_TTL_SECONDS = int(os.getenv("STORY_CACHE_TTL", str(7 * 24 * 60 * 60)))  # 7 days
+
+# Files stored for each cached story, keyed by the field they fill in the result dictionary.
+# audio.mp3 holds Ogg Opus when STORY_AUDIO_FORMAT=opus; readers sniff it (media.audio_mime).
+ARTIFACT_FILES = {"image": "image.png", "audio": "audio.mp3", "pdf": "story.pdf"}
+
+
+def normalize_text(text):
+    """Lower-cases and collapses whitespace so trivially different inputs share a key."""
+    return " ".join((text or "").lower().split())
+
+
+def make_cache_key(prompt, model, story_length, child_name, tier="story"):
+    """
+    Returns a content hash for a story request. The tier separates finished stories from
+    shared building blocks such as name-free templates.
+    """
+    payload = json.dumps(
+        [tier, normalize_text(prompt), model, normalize_text(story_length), normalize_text(child_name)]
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StoryCache:
+    """
+    Persistent, process-wide cache for generated stories and their media.
+
+    Story text and metadata live in a SQLite index, media files live next to it on disk,
+    one directory per entry. SQLite handles locking between Streamlit threads and separate
+    processes, and entry directories are written under a temporary name and renamed into
+    place so readers never see half-written files. Entries expire after `ttl` seconds and
+    the least recently used ones are evicted once the total size passes `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.join(cache_dir, "entries"), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, story TEXT, meta TEXT, size INTEGER, "
+                "created REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def _connect(self):
+        # SQLite connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite3"), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, "entries", key)
+
+    def _bump(self, conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def get(self, key):
+        """Returns the cached result dictionary for key, or None on a miss."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT story, meta, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[2] > self.ttl:
+                self._delete(conn, key)
+                self._bump(conn, "evictions")
+                row = None
+            if row is None:
+                self._bump(conn, "misses")
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self._bump(conn, "hits")
+
+        story, meta, _ = row
+        meta = json.loads(meta)
+        result = {"story": story, "image": None, "audio": None, "pdf": None}
+        entry_dir = self._entry_dir(key)
+        for field, filename in ARTIFACT_FILES.items():
+            path = os.path.join(entry_dir, filename)
+            if field in meta.get("artifacts", []) and os.path.exists(path):
+                result[field] = path
+        result["timings"] = dict(meta.get("timings", {}))
+        return result
+
+    def put(self, key, result, image_bytes=None):
+        """
+        Stores a generated result. Audio and PDF are taken from result as bytes or copied
+        from their paths; image_bytes holds the downloaded illustration, since image URLs expire.
+        """
+        entry_dir = self._entry_dir(key)
+        staging_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(staging_dir, exist_ok=True)
+
+        artifacts = []
+        size = len((result.get("story") or "").encode("utf-8"))
+        for field, filename in ARTIFACT_FILES.items():
+            target = os.path.join(staging_dir, filename)
+            if field == "image":
+                if not image_bytes:
+                    continue
+                with open(target, "wb") as f:
+                    f.write(image_bytes)
+            else:
+                source = result.get(field)
+                if isinstance(source, bytes):
+                    with open(target, "wb") as f:
+                        f.write(source)
+                elif source and os.path.exists(source):
+                    shutil.copyfile(source, target)
+                else:
+                    continue
+            artifacts.append(field)
+            size += os.path.getsize(target)
+
+        # Swap the new entry into place; another process may have stored the same key already
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.replace(staging_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        meta = {"artifacts": artifacts, "timings": result.get("timings", {})}
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, story, meta, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, result.get("story"), json.dumps(meta), size, now, now),
+            )
+            self._bump(conn, "stores")
+        self.evict()
+
+    def _delete(self, conn, key):
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def evict(self):
+        """Drops expired entries, then least recently used ones until under the size budget."""
+        now = time.time()
+        evicted = 0
+        with self._connect() as conn:
+            expired = conn.execute(
+                "SELECT key FROM entries WHERE created < ?", (now - self.ttl,)
+            ).fetchall()
+            for (key,) in expired:
+                self._delete(conn, key)
+                evicted += 1
+
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in conn.execute(
+                    "SELECT key, size FROM entries ORDER BY last_access ASC"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._delete(conn, key)
+                    total -= size
+                    evicted += 1
+            if evicted:
+                self._bump(conn, "evictions", evicted)
+        return evicted
+
+    def clear(self):
+        """Removes every entry (counters are kept)."""
+        with self._connect() as conn:
+            for (key,) in conn.execute("SELECT key FROM entries").fetchall():
+                self._delete(conn, key)
+
+    def stats(self):
+        """Returns hit/miss/eviction counters along with the current entry count and size."""
+        with self._connect() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        stats = {name: stats.get(name, 0) for name in ("hits", "misses", "evictions", "stores")}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["entries"] = entries
+        stats["bytes"] = size
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the process-wide StoryCache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = StoryCache()
+    return _cache
+
+
+def set_cache(cache):
+    """Replaces the process-wide StoryCache (e.g. with a temporary one for benchmarks)."""
+    global _cache
+    _cache = cache
@@ -1,215 +1,900 @@
-import openai
+import asyncio
 import os
-import tempfile
-import requests
+import re
+import threading
 import time
-from PIL import Image
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from textwrap import wrap
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import media
+import metrics
+import narration
+import prompts
+import screening
+from artifact_store import get_artifact_store
+from backends import get_backend
+from story_cache import get_cache, make_cache_key
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize OpenAI client
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Model calls go through the pluggable backend (OpenAI by default, see backends.py);
+# it is created on first use from the STORY_BACKEND environment variable. The OpenAI client,
+# PIL and reportlab are only imported once a story is generated (or by warm_up()), which
+# keeps importing this module cheap for the app's home page.
 
-def generate_story_and_image(story_topic, story_length="short", child_name=""):
+# Shared worker pool for the media stages (image, narration, PDF).
+# Created once per process so concurrent requests don't each spin up threads.
+PIPELINE_WORKERS = int(os.getenv("STORY_PIPELINE_WORKERS", "8"))
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="story-pipeline")
+
+REFUSAL_MESSAGE = prompts.REFUSAL_MESSAGE
+STORY_MODEL = "gpt-4o"
+
+# Options offered on the home page; batch pre-warming enumerates the same matrix
+STORY_TOPICS = [
+    "Animals", "Dinosaurs", "Superheroes", "Sports",
+    "Space", "Robots", "Ocean", "Music",
+    "Magic", "Fairies", "Forest"
+]
+STORY_TONES = ["Calm & Peaceful", "Silly & Funny", "Adventurous & Exciting"]
+STORY_LENGTHS = ["short", "medium"]
+
+# Stand-in for the child's name in shared, name-free story templates
+NAME_PLACEHOLDER = prompts.NAME_PLACEHOLDER
+
+def _timed(func, *args):
+    """Runs func(*args) and returns (result, start, end) on the monotonic perf_counter clock."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, start, time.perf_counter()
+
+def _new_writer():
+    """A fresh artifact store owner for the files one generation writes (see hold_result)."""
+    return f"write:{uuid.uuid4().hex}"
+
+def build_story_topic(topic, tone, details=""):
+    """Combines the selected topic, tone and optional custom details into the story idea."""
+    story_base = f"A {tone.lower()} story about {topic.lower()}"
+    return f"{story_base} - {details}" if details else story_base
+
+def _story_key(story_topic, story_length, child_name):
+    return make_cache_key(story_topic, STORY_MODEL, story_length, child_name)
+
+def _template_key(story_topic, story_length):
+    return make_cache_key(story_topic, STORY_MODEL, story_length, NAME_PLACEHOLDER, tier="template")
+
+def _similar_entry(tier, story_topic, story_length, child_name):
+    """
+    Finds a cached near-duplicate of the request (same topic and tone, reworded details; see
+    similarity.py). Returns (result, similarity), with None as the result on a miss.
+    """
+    import similarity  # NumPy is only loaded once the cache is consulted
+
+    index = similarity.get_similarity_index()
+    if index.threshold > 1:
+        return None, 0.0
+    try:
+        key, score = index.nearest(tier, story_topic, story_length, child_name)
+    except Exception as e:
+        print(f"Error looking up similar stories: {e}")
+        return None, 0.0
+    if key is None:
+        return None, score
+    result = get_cache().get(key)
+    if result is None:
+        index.remove(key)  # The entry expired or was evicted
+    return result, score
+
+def _index_similar(key, tier, story_topic, story_length, child_name):
+    try:
+        import similarity
+
+        similarity.get_similarity_index().add(key, tier, story_topic, story_length, child_name)
+    except Exception as e:
+        print(f"Error indexing story for similarity lookups: {e}")
+
+def get_cached_story(story_topic, story_length="short", child_name=""):
+    """
+    Looks up a previously generated story in the shared cache, falling back to a
+    near-duplicate request. Returns None on a miss.
+    """
+    lookup_start_time = time.perf_counter()
+    result = get_cache().get(_story_key(story_topic, story_length, child_name))
+    if result is None:
+        result, score = _similar_entry("story", story_topic, story_length, child_name)
+        if result is not None:
+            result["timings"]["similar_match"] = round(score, 3)
+    if result is not None:
+        # The stored timings are the original generation's; this request took only the lookup
+        lookup_time = round(time.perf_counter() - lookup_start_time, 4)
+        result["timings"]["from_cache"] = True
+        result["timings"]["cache_lookup"] = lookup_time
+        result["timings"]["total_time"] = lookup_time
+    return result
+
+def get_story_template(story_topic, story_length="short"):
+    """
+    Looks up the name-free tier of the cache: a story written around NAME_PLACEHOLDER and an
+    illustration without the child's name. Returns a dictionary with "story" and "image", or None.
+    """
+    template = get_cache().get(_template_key(story_topic, story_length))
+    if template is None:
+        template, _ = _similar_entry("template", story_topic, story_length, NAME_PLACEHOLDER)
+    return template
+
+def personalize_story(template_text, child_name):
+    """Fills the child's name into a story template."""
+    return template_text.replace(NAME_PLACEHOLDER, child_name.strip())
+
+def _download_image(url):
+    with metrics.span("image_download") as span:
+        image_bytes = get_backend().fetch(url)
+        span.set(bytes=len(image_bytes))
+    return image_bytes
+
+def _read_image_bytes(image):
+    """
+    Returns the bytes of an image given the bytes themselves (fresh from the image stage),
+    a local cache path, or a (short-lived) URL.
+    """
+    if isinstance(image, bytes):
+        return image
+    if os.path.exists(image):
+        with open(image, "rb") as image_file:
+            return image_file.read()
+    return _download_image(image)
+
+def _cache_put(key, result):
+    """Saves a result to the shared cache, keeping the image bytes since its URL expires."""
+    try:
+        image_bytes = _read_image_bytes(result["image"]) if result.get("image") else None
+        get_cache().put(key, result, image_bytes=image_bytes)
+    except Exception as e:
+        print(f"Error caching story: {e}")
+
+def _store_in_cache(story_topic, story_length, child_name, result):
+    """Caches a finished story unless one of its stages failed."""
+    # A stage that failed (e.g. rate limited) shouldn't be pinned in the cache; refusals are fine
+    if REFUSAL_MESSAGE not in result["story"] and not all(result.get(field) for field in ("image", "audio", "pdf")):
+        return
+    key = _story_key(story_topic, story_length, child_name)
+    _cache_put(key, result)
+    _index_similar(key, "story", story_topic, story_length, child_name)
+
+def _store_template(story_topic, story_length, template_text, image):
+    key = _template_key(story_topic, story_length)
+    _cache_put(key, {"story": template_text, "image": image})
+    _index_similar(key, "template", story_topic, story_length, NAME_PLACEHOLDER)
+
+def _prescreen(story_topic, use_cache=True):
+    """
+    Refuses topics the local pre-screen catches (see screening.py) without calling the model.
+    Returns the refusal result, or None if the request has to go to the model.
+    """
+    start_time = time.perf_counter()
+    reason = screening.screen(story_topic, use_cache)
+    if reason is None:
+        return None
+    timings = {'prescreened': reason, 'total_time': round(time.perf_counter() - start_time, 6)}
+    return {"story": REFUSAL_MESSAGE, "image": None, "audio": None, "pdf": None, "timings": timings}
+
+def _story_from_template(template, story_topic, story_length, child_name, use_cache=True):
+    """
+    Serves a personalized request from a cached template: the name is filled in locally,
+    the shared illustration is reused, and only narration and the PDF are generated.
+    """
+    timings = {'from_template': True}
+    total_start_time = time.perf_counter()
+    story_text = personalize_story(template["story"], child_name)
+
+    if REFUSAL_MESSAGE in story_text:
+        result = {"story": story_text, "image": None, "audio": None, "pdf": None, "timings": timings}
+    else:
+        image = template["image"]
+        writer = _new_writer()
+        audio_future = _executor.submit(_timed, generate_voice_narration, story_text, True, writer)
+        pdf_bytes, pdf_start_time, pdf_end_time = _timed(generate_pdf, story_topic, story_text, image)
+        audio_file_path, audio_start_time, audio_end_time = audio_future.result()
+        timings['audio_generation'] = round(audio_end_time - audio_start_time, 2)
+        timings['pdf_generation'] = round(pdf_end_time - pdf_start_time, 2)
+        result = {"story": story_text, "image": image, "audio": audio_file_path, "pdf": pdf_bytes,
+                  "timings": timings, "artifact_owner": writer}
+
+    timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+    if use_cache:
+        _store_in_cache(story_topic, story_length, child_name, result)
+    return result
+
+def generate_story_template(story_topic, story_length="short"):
+    """
+    Fills the name-free template tier for a request (for pre-warming; see batch.py): the
+    story written around NAME_PLACEHOLDER and an illustration without a name. Returns a
+    dictionary with "story", "image" and "timings"; the image is None for a refusal, and
+    for a template that didn't use the placeholder, which isn't stored.
+    """
+    refused = _prescreen(story_topic)
+    if refused is not None:
+        return refused
+    template = get_story_template(story_topic, story_length)
+    if template is not None:
+        return {"story": template["story"], "image": template["image"], "timings": {"from_cache": True}}
+
+    timings = {}
+    total_start_time = time.perf_counter()
+    messages = prompts.story_messages(story_topic, story_length, NAME_PLACEHOLDER)
+    story_start_time = time.perf_counter()
+    with metrics.span("chat", model=STORY_MODEL, streaming=False) as span:
+        usage = {}
+        story_text = get_backend().chat(
+            model=STORY_MODEL,
+            messages=messages,
+            temperature=0.7,
+            usage=usage,
+            max_tokens=prompts.max_output_tokens(story_length)
+        ).strip()
+        span.set(**usage)
+    story_end_time = time.perf_counter()
+    timings['story_generation'] = round(story_end_time - story_start_time, 2)
+    timings.update(prompts.usage_timings(usage, messages))
+
+    image = None
+    if REFUSAL_MESSAGE in story_text:
+        _store_template(story_topic, story_length, story_text, None)
+        screening.remember_refusal(story_topic)
+    elif not _unpersonalizable(story_text):
+        image, image_start_time, image_end_time = _timed(generate_image, story_topic, "")
+        timings['image_generation'] = round(image_end_time - image_start_time, 2)
+        if image:
+            _store_template(story_topic, story_length, story_text, image)
+    timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+    return {"story": story_text, "image": image, "timings": timings}
+
+def generate_story_and_image(story_topic, story_length="short", child_name="", concurrent=True, use_cache=True,
+                             use_template=True):
     """
     Generates a bedtime story along with a relevant image.
+    When concurrent is True, image and narration start together as soon as the story text
+    arrives, and the PDF starts as soon as the image is ready.
+    When use_cache is True, results are served from and saved to the shared story cache.
+    Personalized requests go through the name-free template tier, so the story and the
+    illustration are shared between children and only narration and the PDF are per-name
+    (use_template=False writes the story with the name instead).
     Returns:
-    - Dictionary with story text, image URL, audio file path, PDF file path, and timing information.
+    - Dictionary with story text, image (PNG bytes, or a path in the story cache), audio file path,
+      PDF (bytes, or a path in the story cache), and timing information. A fresh narration file
+      is leased to result["artifact_owner"] until the caller takes it over with hold_result.
     """
-    
+    refused = _prescreen(story_topic, use_cache)
+    if refused is not None:
+        return refused
+    if use_cache:
+        cached = get_cached_story(story_topic, story_length, child_name)
+        if cached is not None:
+            return cached
+
+    templated = use_cache and use_template and bool(child_name.strip())
+    if templated:
+        template = get_story_template(story_topic, story_length)
+        if template is not None:
+            return _story_from_template(template, story_topic, story_length, child_name)
+
     # Initialize timing dictionary
     timings = {}
-    total_start_time = time.time()
-
-    # Prepare the main character based on whether a child's name was provided
-    main_character = f"{child_name}" if child_name.strip() else "the main character"
-    
-    story_prompt = f"""
-    **IMPORTANT INSTRUCTIONS FOR AI:**
-    - If the topic contains **violence**, **vulgarity**, **scary content**, **evil characters**, **battles**, or anything inappropriate for children aged 3-5, **DO NOT** create the story. 
-    - In such cases, respond with: **"Sorry, I cannot create a story on this topic."**
-    - If the topic is unclear or potentially inappropriate, err on the side of caution and do not generate the story.
-
-    Now, create a gentle bedtime story for children aged 3-5 years old about {story_topic}.
-    Story length: {story_length.upper()} ({"2-3 minutes" if story_length == "short" else "5-7 minutes"})
-    {'Make ' + main_character + ' the main character of the story.' if child_name.strip() else ''}
-
-    **Story Requirements:**
-    - Transform the given topic into a calm, bedtime-appropriate narrative
-    - Include no more than 2-3 main characters with simple, easy-to-pronounce names
-    - Set the story in a peaceful environment (bedroom, garden, or under the stars)
-    - Weave in familiar bedtime routines and comfort objects
-    - Use simple words and short sentences (5-8 words)
-    - Include {'2-3' if story_length == 'short' else '3-4'} scenes
-    - Add gentle repetitive phrases that children can predict and say along
-    - Include 2-3 soft sound effects (like "whoosh" of wind or "twinkle" of stars)
-    - Add 1-2 interactive moments where children can mimic actions (stretching, yawning, counting)
-    - End with characters feeling sleepy and peaceful
-
-    **Strict Guidelines:**
-    - **No violence, battles, scary content, evil characters, or complex conflicts.**
-    - **No inappropriate themes or language.**
-    - If the topic doesn't fit these guidelines, reply: **"Sorry, I cannot create a story on this topic."**
-
-    **Writing Style:**
-    - Use soothing descriptive words (soft, cozy, warm, snuggly)
-    - Keep sentences simple and direct
-    - Include gentle parent/caregiver figures
-    - Avoid any scary elements or conflicts
-    - Include mild, calming humor if appropriate
-    - Use a rhythmic, peaceful tone throughout
-
-    **Format Structure:**
-    - Clear beginning introducing the peaceful setting and characters
-    - Middle focusing on gentle activities and bedtime routines
-    - Calm ending with characters getting sleepy and going to bed
-    - Simple questions or prompts in [brackets] for parent-child interaction
-    """
+    total_start_time = time.perf_counter()
+
+    # Templated requests write the story around a placeholder and draw an unnamed illustration
+    prompt_name = NAME_PLACEHOLDER if templated else child_name
+    image_name = "" if templated else child_name
+    with metrics.span("prompt_build") as span:
+        messages = prompts.story_messages(story_topic, story_length, prompt_name)
+        span.set(chars=len(messages[-1]["content"]))
 
     # Generate story with timing
-    story_start_time = time.time()
-    story_response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "user", "content": story_prompt}],
-        temperature=0.7
-    )
-    story_end_time = time.time()
+    story_start_time = time.perf_counter()
+    with metrics.span("chat", model=STORY_MODEL, streaming=False) as span:
+        usage = {}
+        story_text = get_backend().chat(
+            model=STORY_MODEL,
+            messages=messages,
+            temperature=0.7,
+            usage=usage,
+            max_tokens=prompts.max_output_tokens(story_length)
+        ).strip()
+        span.set(**usage)
+    story_end_time = time.perf_counter()
     timings['story_generation'] = round(story_end_time - story_start_time, 2)
+    timings.update(prompts.usage_timings(usage, messages))
 
-    story_text = story_response.choices[0].message.content.strip()
+    template_text = None
+    if templated:
+        if _unpersonalizable(story_text):
+            return generate_story_and_image(story_topic, story_length, child_name, concurrent, use_cache,
+                                            use_template=False)
+        template_text = story_text
+        story_text = personalize_story(template_text, child_name)
 
     # If AI refuses to create the story, skip further generation
-    if "Sorry, I cannot create a story on this topic." in story_text:
-        timings['total_time'] = round(time.time() - total_start_time, 2)
-        return {
+    if REFUSAL_MESSAGE in story_text:
+        timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+        result = {
             "story": story_text, 
             "image": None, 
             "audio": None, 
             "pdf": None,
             "timings": timings
         }
+        if use_cache:
+            if template_text is not None:
+                _store_template(story_topic, story_length, template_text, None)
+            _store_in_cache(story_topic, story_length, child_name, result)
+            screening.remember_refusal(story_topic)
+        return result
 
-    # Generate image with timing
-    image_start_time = time.time()
-    image_url = generate_image(story_topic, child_name)
-    image_end_time = time.time()
-    timings['image_generation'] = round(image_end_time - image_start_time, 2)
+    writer = _new_writer()
+    if concurrent:
+        # Image and audio only need the story text and topic, so start them together
+        image_future = _executor.submit(_timed, generate_image, story_topic, image_name)
+        audio_future = _executor.submit(_timed, generate_voice_narration, story_text, True, writer)
 
-    # Generate audio with timing
-    audio_start_time = time.time()
-    audio_file_path = generate_voice_narration(story_text)
-    audio_end_time = time.time()
-    timings['audio_generation'] = round(audio_end_time - audio_start_time, 2)
+        # The PDF stage waits only on the image, not on the narration
+        image, image_start_time, image_end_time = image_future.result()
+        pdf_future = _executor.submit(_timed, generate_pdf, story_topic, story_text, image)
+
+        audio_file_path, audio_start_time, audio_end_time = audio_future.result()
+        pdf_bytes, pdf_start_time, pdf_end_time = pdf_future.result()
+    else:
+        image, image_start_time, image_end_time = _timed(generate_image, story_topic, image_name)
+        audio_file_path, audio_start_time, audio_end_time = _timed(generate_voice_narration, story_text, True, writer)
+        pdf_bytes, pdf_start_time, pdf_end_time = _timed(generate_pdf, story_topic, story_text, image)
 
-    # Generate PDF with timing
-    pdf_start_time = time.time()
-    pdf_file_path = generate_pdf(story_topic, story_text, image_url)
-    pdf_end_time = time.time()
+    timings['image_generation'] = round(image_end_time - image_start_time, 2)
+    timings['audio_generation'] = round(audio_end_time - audio_start_time, 2)
     timings['pdf_generation'] = round(pdf_end_time - pdf_start_time, 2)
 
+    # Sum of all stages (what a purely sequential run would cost) vs. the longest dependency chain
+    stage_total = (story_end_time - story_start_time) + (image_end_time - image_start_time) \
+        + (audio_end_time - audio_start_time) + (pdf_end_time - pdf_start_time)
+    critical_path = (story_end_time - story_start_time) + max(
+        (image_end_time - image_start_time) + (pdf_end_time - pdf_start_time),
+        audio_end_time - audio_start_time,
+    )
+    timings['stage_total'] = round(stage_total, 2)
+    timings['critical_path'] = round(critical_path, 2)
+    timings['concurrent'] = concurrent
+
     # Calculate total time
-    total_end_time = time.time()
+    total_end_time = time.perf_counter()
     timings['total_time'] = round(total_end_time - total_start_time, 2)
+    timings['time_saved'] = round(max(stage_total - (total_end_time - total_start_time), 0), 2)
 
-    return {
+    result = {
         "story": story_text,
-        "image": image_url,
+        "image": image,
         "audio": audio_file_path,
-        "pdf": pdf_file_path,
-        "timings": timings
+        "pdf": pdf_bytes,
+        "timings": timings,
+        "artifact_owner": writer
     }
+    if use_cache:
+        # Only keep the template if the model actually used the placeholder
+        if template_text is not None and NAME_PLACEHOLDER in template_text and image:
+            _store_template(story_topic, story_length, template_text, image)
+        _store_in_cache(story_topic, story_length, child_name, result)
+    return result
+
+# Streaming narration: the first chunk is kept short so audio starts quickly,
+# later chunks are larger to keep the number of TTS calls down.
+FIRST_AUDIO_CHUNK_CHARS = 200
+AUDIO_CHUNK_CHARS = 800
+_SENTENCE_END = re.compile(narration.SENTENCE_END + r"|\n\s*\n")
+
+def _split_ready_chunk(buffer, min_chars):
+    """
+    Cuts the buffer at the first sentence or paragraph boundary at or after min_chars.
+    Returns (chunk, rest), or (None, buffer) if no boundary is available yet.
+    """
+    if len(buffer) < min_chars:
+        return None, buffer
+    cut = None
+    for match in _SENTENCE_END.finditer(buffer):
+        if match.end() >= min_chars:
+            cut = match.end()
+            break
+    if cut is None:
+        return None, buffer
+    return buffer[:cut].strip(), buffer[cut:]
+
+def _concat_audio_files(paths, owner):
+    """
+    Joins MP3 chunk files (leased to owner) into the final narration file, leased to owner
+    too (see narration.join_audio).
+    """
+    paths = [path for path in paths if path]
+    if not paths:
+        return None
+    chunks = []
+    for path in paths:
+        with open(path, "rb") as chunk_file:
+            chunks.append(chunk_file.read())
+    store = get_artifact_store()
+    audio_bytes = narration.join_audio(chunks)
+    joined_path = store.put(audio_bytes, media.audio_suffix(audio_bytes), owner)
+    for path in set(paths) - {joined_path}:
+        # The chunks are only needed until they are joined; a chunk another writer also
+        # holds stays
+        store.discard(path, owner)
+    return joined_path
+
+def _unpersonalizable(template_text):
+    """
+    Whether a story written for the template tier never used the placeholder, so it can't
+    carry the child's name (a refusal doesn't need to).
+    """
+    if NAME_PLACEHOLDER in template_text or REFUSAL_MESSAGE in template_text:
+        return False
+    metrics.increment("story_template_unused_total")
+    return True
+
+def _release_personalized(pending, child_name):
+    """
+    Splits streamed template text into the part that is safe to show (with the name filled
+    in) and a tail that might be the start of a placeholder split across stream events.
+    Returns (text_to_show, held_back).
+    """
+    hold = 0
+    for size in range(min(len(NAME_PLACEHOLDER) - 1, len(pending)), 0, -1):
+        if NAME_PLACEHOLDER.startswith(pending[-size:]):
+            hold = size
+            break
+    ready = pending[:len(pending) - hold]
+    return personalize_story(ready, child_name), pending[len(pending) - hold:]
+
+class StoryStream:
+    """
+    Streams a bedtime story as it is generated.
+
+    Iterating yields story text pieces as they arrive from the model, so the UI can render
+    them immediately. Completed sentences/paragraphs are sent to narration early, the image
+    starts once the story is known not to be a refusal, and the PDF starts once both the full
+    text and the image are ready. After iteration finishes, `result` holds the same dictionary
+    that generate_story_and_image returns, with time_to_first_word and time_to_first_audio
+    added to the timings. Cached stories are yielded in one piece. Like generate_story_and_image,
+    personalized requests use the name-free template tier; a fresh template is streamed with
+    the child's name filled in on the fly.
+
+    on_stage, if given, is called as on_stage(stage, status) whenever one of the STAGES moves
+    to "running", "done", "failed" or "skipped", so callers can report progress.
+    """
+
+    STAGES = ("story", "image", "audio", "pdf")
+
+    def __init__(self, story_topic, story_length="short", child_name="", use_cache=True, on_stage=None):
+        self.story_topic = story_topic
+        self.story_length = story_length
+        self.child_name = child_name
+        self.use_cache = use_cache
+        self.on_stage = on_stage
+        self.result = None
+
+    def _stage(self, stage, status):
+        if self.on_stage is not None:
+            self.on_stage(stage, status)
+
+    def _finished(self, result):
+        """Reports the final status of every stage from a finished result."""
+        refused = REFUSAL_MESSAGE in result["story"]
+        self._stage("story", "done")
+        for stage in ("image", "audio", "pdf"):
+            self._stage(stage, "skipped" if refused else "done" if result.get(stage) else "failed")
+
+    def __iter__(self):
+        self._stage("story", "running")
+        prescreened = _prescreen(self.story_topic, self.use_cache)
+        if prescreened is not None:
+            self.result = prescreened
+            self._finished(prescreened)
+            yield prescreened["story"]
+            return
+        if self.use_cache:
+            cached = get_cached_story(self.story_topic, self.story_length, self.child_name)
+            if cached is not None:
+                self.result = cached
+                self._finished(cached)
+                yield cached["story"]
+                return
+
+        templated = self.use_cache and bool(self.child_name.strip())
+        if templated:
+            template = get_story_template(self.story_topic, self.story_length)
+            if template is not None:
+                self._stage("story", "done")
+                self._stage("audio", "running")
+                self._stage("pdf", "running")
+                self.result = _story_from_template(template, self.story_topic, self.story_length, self.child_name)
+                self._finished(self.result)
+                yield self.result["story"]
+                return
+
+        timings = {}
+        total_start_time = time.perf_counter()
+        prompt_name = NAME_PLACEHOLDER if templated else self.child_name
+        image_name = "" if templated else self.child_name
+        with metrics.span("prompt_build") as span:
+            messages = prompts.story_messages(self.story_topic, self.story_length, prompt_name)
+            span.set(chars=len(messages[-1]["content"]))
+
+        story_start_time = time.perf_counter()
+        usage = {}
+        response = get_backend().chat_stream(
+            model=STORY_MODEL,
+            messages=messages,
+            temperature=0.7,
+            usage=usage,
+            max_tokens=prompts.max_output_tokens(self.story_length)
+        )
+
+        story_parts = []
+        template_parts = []
+        pending = ""  # Template text held back while it may end in a partial placeholder
+        buffer = ""
+        refused = None  # Unknown until enough text has arrived to rule out a refusal
+        image_future = None
+        audio_futures = []
+        first_audio_time = []
+
+        writer = _new_writer()
+
+        def narrate(chunk):
+            path = generate_voice_narration(chunk, False, writer)  # Encoded once, when joined
+            if path and not first_audio_time:
+                first_audio_time.append(time.perf_counter())
+            return path
+
+        for piece in response:
+            if templated:
+                template_parts.append(piece)
+                pending += piece
+                piece, pending = _release_personalized(pending, self.child_name)
+                if not piece:
+                    continue
+            if 'time_to_first_word' not in timings:
+                timings['time_to_first_word'] = round(time.perf_counter() - total_start_time, 2)
+            story_parts.append(piece)
+            yield piece
+
+            buffer += piece
+            if refused is None:
+                # Hold back side work until the opening can no longer be the refusal message
+                so_far = "".join(story_parts).lstrip(" \n*\"'")
+                if len(so_far) < len(REFUSAL_MESSAGE) and REFUSAL_MESSAGE.startswith(so_far):
+                    continue
+                refused = so_far.startswith(REFUSAL_MESSAGE)
+                if not refused:
+                    image_future = _executor.submit(_timed, generate_image, self.story_topic, image_name)
+                    self._stage("image", "running")
+
+            if refused:
+                continue
+            min_chars = FIRST_AUDIO_CHUNK_CHARS if not audio_futures else AUDIO_CHUNK_CHARS
+            chunk, buffer = _split_ready_chunk(buffer, min_chars)
+            if chunk:
+                if not audio_futures:
+                    self._stage("audio", "running")
+                audio_futures.append(_executor.submit(narrate, chunk))
+
+        if pending:
+            piece = personalize_story(pending, self.child_name)
+            story_parts.append(piece)
+            buffer += piece
+            yield piece
+
+        story_end_time = time.perf_counter()
+        metrics.record_span("chat", story_start_time, story_end_time, model=STORY_MODEL, streaming=True,
+                            time_to_first_word=timings.get('time_to_first_word'), **usage)
+        timings['story_generation'] = round(story_end_time - story_start_time, 2)
+        timings.update(prompts.usage_timings(usage, messages))
+        story_text = "".join(story_parts).strip()
+        template_text = "".join(template_parts).strip() if templated else None
+
+        # The model may also refuse later in the text; drop any early work in that case
+        if refused or REFUSAL_MESSAGE in story_text:
+            for future in audio_futures + ([image_future] if image_future else []):
+                future.cancel()
+            get_artifact_store().release_owner(writer)  # Narration already written is not needed
+            timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+            self.result = {
+                "story": story_text,
+                "image": None,
+                "audio": None,
+                "pdf": None,
+                "timings": timings
+            }
+            if self.use_cache:
+                if template_text is not None:
+                    _store_template(self.story_topic, self.story_length, template_text, None)
+                _store_in_cache(self.story_topic, self.story_length, self.child_name, self.result)
+                screening.remember_refusal(self.story_topic)
+            self._finished(self.result)
+            return
+
+        self._stage("story", "done")
+
+        if image_future is None:
+            image_future = _executor.submit(_timed, generate_image, self.story_topic, image_name)
+        if buffer.strip():
+            audio_futures.append(_executor.submit(narrate, buffer.strip()))
+
+        self._stage("image", "running")
+        self._stage("audio", "running")
+        image, image_start_time, image_end_time = image_future.result()
+        self._stage("image", "done" if image else "failed")
+        self._stage("pdf", "running")
+        pdf_bytes, pdf_start_time, pdf_end_time = _timed(generate_pdf, self.story_topic, story_text, image)
+        self._stage("pdf", "done" if pdf_bytes else "failed")
+
+        audio_paths = [future.result() for future in audio_futures]
+        audio_end_time = time.perf_counter()
+        # A missing chunk would leave a gap in the narration, so treat it as a failed stage
+        audio_file_path = _concat_audio_files(audio_paths, writer) if all(audio_paths) else None
+        if audio_file_path is None:
+            get_artifact_store().release_owner(writer)
+        self._stage("audio", "done" if audio_file_path else "failed")
+
+        timings['image_generation'] = round(image_end_time - image_start_time, 2)
+        timings['audio_generation'] = round(audio_end_time - story_start_time, 2)
+        timings['pdf_generation'] = round(pdf_end_time - pdf_start_time, 2)
+        timings['audio_chunks'] = len(audio_paths)
+        if first_audio_time and audio_file_path:
+            timings['time_to_first_audio'] = round(first_audio_time[0] - total_start_time, 2)
+        timings['streaming'] = True
+        timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+
+        self.result = {
+            "story": story_text,
+            "image": image,
+            "audio": audio_file_path,
+            "pdf": pdf_bytes,
+            "timings": timings,
+            "artifact_owner": writer
+        }
+        # A template that never used the placeholder was shown without the name; it isn't
+        # the story this request's key promises, so it isn't cached under it
+        if self.use_cache and not (template_text is not None and _unpersonalizable(template_text)):
+            if template_text is not None and image:
+                _store_template(self.story_topic, self.story_length, template_text, image)
+            _store_in_cache(self.story_topic, self.story_length, self.child_name, self.result)
+
+def stream_story_and_image(story_topic, story_length="short", child_name="", use_cache=True, on_stage=None):
+    """Returns a StoryStream; iterate it for story text, then read `.result`."""
+    return StoryStream(story_topic, story_length, child_name, use_cache, on_stage)
+
+def _image_prompt(story_topic, child_name=""):
+    # Prepare the image prompt based on whether a child's name was provided
+    if child_name.strip():
+        return f"Illustration for a children's bedtime story about {story_topic} with a child named {child_name} as the main character. The scene should be warm and cozy. Do not show text or names in the image."
+    return f"Illustration for a children's bedtime story about {story_topic}. The scene should be warm and cozy."
 
 def generate_image(story_topic, child_name=""):
-    """Generates an image using DALL·E."""
+    """
+    Generates an image using DALL·E and returns its PNG bytes. The image is fetched once here
+    and the same bytes are shared with the PDF stage, the cache and the UI.
+    """
     try:
-        # Prepare the image prompt based on whether a child's name was provided
-        if child_name.strip():
-            image_prompt = f"Illustration for a children's bedtime story about {story_topic} with a child named {child_name} as the main character. The scene should be warm and cozy. Do not show text or names in the image."
-        else:
-            image_prompt = f"Illustration for a children's bedtime story about {story_topic}. The scene should be warm and cozy."
-            
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=image_prompt,
-            size="1024x1024",
-            n=1
-        )
-        return response.data[0].url
+        with metrics.span("image", model="dall-e-3") as span:
+            image_bytes = get_backend().generate_image(
+                model="dall-e-3",
+                prompt=_image_prompt(story_topic, child_name),
+                size="1024x1024"
+            )
+            span.set(bytes=len(image_bytes))
+        return image_bytes
     except Exception as e:
+        # Counted as story_stage_errors_total{stage="image"} by the span
         print(f"Error generating image: {e}")
         return None
 
-def generate_voice_narration(text):
-    """Converts text into speech using OpenAI's TTS API."""
+def generate_voice_narration(text, encode=True, owner=None):
+    """
+    Converts text into speech using OpenAI's TTS API. Long text is narrated in chunks, in
+    parallel, and joined into one file in the served audio format (see narration.py and
+    media.py); encode=False keeps the API's MP3. Returns the file's path, leased to owner
+    in the artifact store.
+    """
     try:
-        response = client.audio.speech.create(
-            model="tts-1",
-            voice="alloy",
-            input=text
-        )
-        temp_audio = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        temp_audio.write(response.content)
-        temp_audio.close()
-        return temp_audio.name
+        with metrics.span("narration", chars=len(text)) as span:
+            audio_bytes = narration.synthesize(text, encode=encode)
+            span.set(bytes=len(audio_bytes))
+        with metrics.span("artifact_write", kind="audio", bytes=len(audio_bytes)):
+            return get_artifact_store().put(audio_bytes, media.audio_suffix(audio_bytes), owner)
     except Exception as e:
+        # Counted as story_stage_errors_total{stage="narration"} by the span
         print(f"Error generating audio: {e}")
         return None
 
-def generate_pdf(title, story, image_url):
-    """Generates a well-formatted PDF with the story and illustration."""
-    temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    c = canvas.Canvas(temp_pdf.name, pagesize=letter)
-    page_width, page_height = letter
-
-    c.setFont("Helvetica-Bold", 18)
-    c.drawString(50, page_height - 80, f"Cozy Story Time - {title}")
-
-    img_y = page_height - 350  # Default Y-position for text if no image
-
-    # Add image if available
-    if image_url:
-        try:
-            response = requests.get(image_url, stream=True)
-            if response.status_code == 200:
-                img = Image.open(response.raw)
-                img_reader = ImageReader(img)
-                c.drawImage(img_reader, 150, page_height - 350, width=250, height=250)
-                img_y -= 250  # Adjust for image height
-        except Exception as e:
-            print("Error fetching image:", e)
-
-    # Add story text below the image with proper line wrapping
-    text_start_y = img_y - 50  # Leave space below the image
-    c.setFont("Helvetica", 12)
-
-    # Define max text width to wrap lines properly
-    text_margin_x = 50
-    max_text_width = page_width - 100  # Leave margins
-
-    # Split the text into properly wrapped lines
-    wrapped_lines = []
-    for paragraph in story.split("\n"):  # Split paragraphs
-        wrapped_lines.extend(wrap(paragraph, width=90))  # Adjust width for wrapping
-        wrapped_lines.append("")  # Add blank line after each paragraph
-
-    # Add the wrapped text to the PDF
-    text_y_position = text_start_y
-    for line in wrapped_lines:
-        if text_y_position < 50:  # Start a new page if needed
-            c.showPage()
-            text_y_position = page_height - 100  # Reset text position for new page
-            c.setFont("Helvetica", 12)
-
-        c.drawString(text_margin_x, text_y_position, line)
-        text_y_position -= 18  # Move cursor down for next line
-
-    # Save the PDF
-    c.save()
-
-    return temp_pdf.name
\ No newline at end of file
+def generate_pdf(title, story, image):
+    """
+    Generates a well-formatted PDF with the story and illustration and returns its bytes.
+    image may be PNG bytes, a local path or a URL.
+    """
+    with metrics.span("pdf_layout", chars=len(story), image=bool(image)) as span:
+        image_bytes = None
+        if image:
+            try:
+                image_bytes = _read_image_bytes(image)
+            except Exception as e:
+                print("Error fetching image:", e)
+        import pdf_renderer  # reportlab is heavy to import; load it on first use
+
+        pdf_bytes = pdf_renderer.render_story_pdf(title, story, image_bytes)
+        span.set(bytes=len(pdf_bytes))
+    return pdf_bytes
+
+# Async pipeline: the same stages as generate_story_and_image, with model calls made through
+# the backend's async API so one event loop can serve many requests at once (see service.py).
+# CPU and disk work (PDF layout, artifact writes) runs on the shared pipeline pool.
+
+async def _atimed(awaitable):
+    start = time.perf_counter()
+    result = await awaitable
+    return result, start, time.perf_counter()
+
+def _in_pool(func, *args):
+    return asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+async def agenerate_image(story_topic, child_name=""):
+    """Async generate_image(). Returns PNG bytes, or None on failure."""
+    try:
+        with metrics.span("image", model="dall-e-3") as span:
+            image_bytes = await get_backend().agenerate_image(
+                model="dall-e-3",
+                prompt=_image_prompt(story_topic, child_name),
+                size="1024x1024"
+            )
+            span.set(bytes=len(image_bytes))
+        return image_bytes
+    except Exception as e:
+        print(f"Error generating image: {e}")
+        return None
+
+async def agenerate_voice_narration(text, owner=None):
+    """Async generate_voice_narration(). Returns the audio file's path, or None on failure."""
+    try:
+        with metrics.span("narration", chars=len(text)) as span:
+            audio_bytes = await narration.asynthesize(text)
+            span.set(bytes=len(audio_bytes))
+        with metrics.span("artifact_write", kind="audio", bytes=len(audio_bytes)):
+            return await _in_pool(get_artifact_store().put, audio_bytes, media.audio_suffix(audio_bytes), owner)
+    except Exception as e:
+        print(f"Error generating audio: {e}")
+        return None
+
+async def agenerate_story_and_image(story_topic, story_length="short", child_name="", use_cache=True, on_stage=None,
+                                    use_template=True):
+    """
+    Async counterpart of generate_story_and_image, returning the same dictionary. The local
+    pre-screen, the cache and the template tier work the same way. on_stage, if given, is
+    called as on_stage(stage, status) like StoryStream's.
+    """
+    def stage(name, status):
+        if on_stage is not None:
+            on_stage(name, status)
+
+    stage("story", "running")
+    # The lookups are SQLite reads (and a refusal-cache write), so they run off the event loop
+    result = await _in_pool(_prescreen, story_topic, use_cache)
+    if result is None and use_cache:
+        result = await _in_pool(get_cached_story, story_topic, story_length, child_name)
+    templated = use_cache and use_template and bool(child_name.strip())
+    template = None
+    if result is None and templated:
+        template = await _in_pool(get_story_template, story_topic, story_length)
+
+    timings = {}
+    total_start_time = time.perf_counter()
+    template_text = None
+    image = None
+    if result is None and template is not None:
+        timings['from_template'] = True
+        story_text = personalize_story(template["story"], child_name)
+        image = template["image"]
+    elif result is None:
+        prompt_name = NAME_PLACEHOLDER if templated else child_name
+        with metrics.span("prompt_build") as span:
+            messages = prompts.story_messages(story_topic, story_length, prompt_name)
+            span.set(chars=len(messages[-1]["content"]))
+        usage = {}
+        with metrics.span("chat", model=STORY_MODEL, streaming=False) as span:
+            story_text, story_start_time, story_end_time = await _atimed(get_backend().achat(
+                model=STORY_MODEL,
+                messages=messages,
+                temperature=0.7,
+                usage=usage,
+                max_tokens=prompts.max_output_tokens(story_length)
+            ))
+            span.set(**usage)
+        story_text = story_text.strip()
+        timings['story_generation'] = round(story_end_time - story_start_time, 2)
+        timings.update(prompts.usage_timings(usage, messages))
+        if templated:
+            if _unpersonalizable(story_text):
+                return await agenerate_story_and_image(story_topic, story_length, child_name, use_cache, on_stage,
+                                                       use_template=False)
+            template_text = story_text
+            story_text = personalize_story(template_text, child_name)
+
+    if result is None and REFUSAL_MESSAGE in story_text:
+        timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+        result = {"story": story_text, "image": None, "audio": None, "pdf": None, "timings": timings}
+        if use_cache:
+            if template_text is not None:
+                await _in_pool(_store_template, story_topic, story_length, template_text, None)
+            await _in_pool(_store_in_cache, story_topic, story_length, child_name, result)
+            await _in_pool(screening.remember_refusal, story_topic)
+    if result is not None:
+        refused = REFUSAL_MESSAGE in result["story"]
+        stage("story", "done")
+        for name in ("image", "audio", "pdf"):
+            stage(name, "skipped" if refused else "done" if result.get(name) else "failed")
+        return result
+    stage("story", "done")
+
+    # Image and narration together; the PDF as soon as the image is ready
+    stage("audio", "running")
+    writer = _new_writer()
+    audio_task = asyncio.ensure_future(_atimed(agenerate_voice_narration(story_text, writer)))
+    if image is None:
+        stage("image", "running")
+        image, image_start_time, image_end_time = await _atimed(agenerate_image(story_topic, "" if templated else child_name))
+        timings['image_generation'] = round(image_end_time - image_start_time, 2)
+    stage("image", "done" if image else "failed")
+    stage("pdf", "running")
+    pdf_bytes, pdf_start_time, pdf_end_time = await _atimed(_in_pool(generate_pdf, story_topic, story_text, image))
+    stage("pdf", "done" if pdf_bytes else "failed")
+    audio_file_path, audio_start_time, audio_end_time = await audio_task
+    stage("audio", "done" if audio_file_path else "failed")
+
+    timings['audio_generation'] = round(audio_end_time - audio_start_time, 2)
+    timings['pdf_generation'] = round(pdf_end_time - pdf_start_time, 2)
+    timings['total_time'] = round(time.perf_counter() - total_start_time, 2)
+    result = {"story": story_text, "image": image, "audio": audio_file_path, "pdf": pdf_bytes, "timings": timings,
+              "artifact_owner": writer}
+    if use_cache:
+        if template_text is not None and NAME_PLACEHOLDER in template_text and image:
+            await _in_pool(_store_template, story_topic, story_length, template_text, image)
+        await _in_pool(_store_in_cache, story_topic, story_length, child_name, result)
+    return result
+
+_warmed_up = False
+_warm_up_lock = threading.Lock()
+
+def _warm_up():
+    with metrics.span("warm_up"):
+        import pdf_renderer  # noqa: F401
+        get_backend()
+        get_cache()
+        import similarity
+        similarity.get_similarity_index()
+        narration.get_chunk_cache()
+        get_artifact_store()
+
+def warm_up(background=True):
+    """
+    Loads the heavy dependencies and builds the model backend and caches ahead of the first
+    story, so that request doesn't pay for them. Only the first call in a process does
+    anything, so it is safe to call on every Streamlit rerun.
+    """
+    global _warmed_up
+    with _warm_up_lock:
+        if _warmed_up:
+            return
+        _warmed_up = True
+    if background:
+        threading.Thread(target=_warm_up, name="story-warm-up", daemon=True).start()
+    else:
+        _warm_up()
+
+if __name__ == "__main__":
+    import sys
+    from batch import main
+    sys.exit(main(sys.argv[1:]))
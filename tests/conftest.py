@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Settings are read at import time, so point everything at a scratch directory and the
+# offline backend before any project module is imported
+os.environ.setdefault("STORY_CACHE_DIR", tempfile.mkdtemp(prefix="story_tests_"))
+os.environ.setdefault("STORY_BACKEND", "fake")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """Fresh caches, artifact store and fake backend for one test; the old ones come back after."""
+    import artifact_store
+    import backends
+    import media
+    import narration
+    import screening
+    import similarity
+    import story_cache
+    from governor import govern
+
+    monkeypatch.setattr(story_cache, "_cache", story_cache.StoryCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(artifact_store, "_store", artifact_store.ArtifactStore(str(tmp_path / "artifacts")))
+    monkeypatch.setattr(narration, "_chunk_cache", story_cache.StoryCache(str(tmp_path / "tts")))
+    monkeypatch.setattr(screening, "_refusals", screening.RefusalCache(str(tmp_path / "refusals.sqlite3")))
+    monkeypatch.setattr(similarity, "_index", similarity.SimilarityIndex(str(tmp_path / "similarity.sqlite3")))
+    monkeypatch.setattr(media, "_rendition_cache", story_cache.StoryCache(str(tmp_path / "renditions")))
+    monkeypatch.setattr(backends, "_backend", govern(backends.FakeBackend(seed=0), limits={}))
+    return tmp_path
@@ -0,0 +1,105 @@
+import os
+import threading
+
+import artifact_store
+import story_cache
+from artifact_store import ArtifactStore, hold_result
+
+
+def make_store(tmp_path, **kwargs):
+    return ArtifactStore(str(tmp_path / "artifacts"), **kwargs)
+
+
+def test_put_leases_the_file_against_quota_eviction(tmp_path):
+    store = make_store(tmp_path, max_bytes=10, grace=0)
+    path = store.put(b"narration bytes", ".mp3", "write:a")  # Over quota as soon as it's written
+    assert os.path.exists(path)
+    assert store.evict() == 0
+    store.release(path, "write:a")
+    assert store.evict() == 1
+    assert not os.path.exists(path)
+
+
+def test_put_without_owner_still_survives_until_its_lease_runs_out(tmp_path):
+    store = make_store(tmp_path, max_bytes=10, grace=0)
+    path = store.put(b"narration bytes", ".mp3")
+    assert store.evict() == 0
+    assert os.path.exists(path)
+
+
+def test_discard_keeps_a_blob_another_writer_holds(tmp_path):
+    store = make_store(tmp_path)
+    first = store.put(b"same chunk", ".mp3", "write:a")
+    second = store.put(b"same chunk", ".mp3", "write:b")
+    assert first == second
+    assert not store.discard(first, "write:a")
+    assert os.path.exists(first)
+    assert store.discard(second, "write:b")
+    assert not os.path.exists(second)
+
+
+def test_concurrent_identical_writes_and_discards(tmp_path):
+    store = make_store(tmp_path)
+    read_back = []
+
+    def writer(i):
+        owner = f"write:{i}"
+        path = store.put(b"identical narration chunk", ".mp3", owner)
+        with open(path, "rb") as f:  # What _concat_audio_files does before discarding
+            read_back.append(f.read())
+        store.discard(path, owner)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert read_back == [b"identical narration chunk"] * 16
+    assert store.stats()["files"] == 0
+
+
+def test_hold_result_hands_over_the_writer_lease(tmp_path, monkeypatch):
+    store = make_store(tmp_path, max_bytes=10, grace=0)
+    monkeypatch.setattr(artifact_store, "_store", store)
+    path = store.put(b"narration bytes", ".mp3", "write:a")
+    result = {"story": "", "image": None, "audio": path, "pdf": b"%PDF", "artifact_owner": "write:a"}
+    hold_result(result, "job:1")
+    assert "artifact_owner" not in result
+    assert store.evict() == 0
+    store.release_owner("job:1")
+    assert store.evict() == 1
+
+
+def test_hold_result_copies_files_out_of_the_story_cache(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    monkeypatch.setattr(artifact_store, "_store", store)
+    cache = story_cache.StoryCache(str(tmp_path / "cache"))
+    cache.put("key", {"story": "Once", "audio": b"cached narration", "timings": {}}, image_bytes=b"png")
+    result = cache.get("key")
+    hold_result(result, "session:1")
+    cache.clear()  # LRU/TTL eviction of the entry
+    with open(result["audio"], "rb") as f:
+        assert f.read() == b"cached narration"
+    with open(result["image"], "rb") as f:
+        assert f.read() == b"png"
+    assert result["audio"].startswith(store.directory)
+
+
+def test_sweep_orphans_leaves_other_hosts_alone(tmp_path):
+    store = make_store(tmp_path)
+    dead_pid = 2 ** 22 + 1  # above any Linux pid_max
+    ours = tmp_path / "artifacts" / f"{artifact_store.HOSTNAME}-{dead_pid}"
+    theirs = tmp_path / "artifacts" / f"other-host-{dead_pid}"
+    for directory in (ours, theirs):
+        directory.mkdir()
+        (directory / "narration.mp3").write_bytes(b"x")
+    assert store.sweep_orphans() == 1
+    assert not ours.exists() and theirs.exists() and os.path.isdir(store.directory)
+
+
+def test_hold_result_clears_files_that_are_gone(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    monkeypatch.setattr(artifact_store, "_store", store)
+    result = {"story": "Once", "image": None, "audio": str(tmp_path / "evicted.mp3"), "pdf": b"%PDF"}
+    hold_result(result, "session:1")
+    assert result["audio"] is None and result["pdf"] == b"%PDF"
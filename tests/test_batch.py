@@ -0,0 +1,23 @@
+import batch
+import story_generator
+
+
+def test_matrix_warms_the_template_tier(stores):
+    requests = [request for request in batch.matrix_requests() if request["length"] == "short"][:2]
+    assert [request["template"] for request in requests] == [False, True]
+    report = batch.run_batch(requests, concurrency=1, progress_file=str(stores / "progress.jsonl"))
+    assert report["completed"] == 2
+    template = story_generator.get_story_template(requests[0]["topic"], "short")
+    assert template is not None and story_generator.NAME_PLACEHOLDER in template["story"]
+
+
+def test_storybook_reads_only_from_the_cache(stores, monkeypatch):
+    requests = [{"topic": "Space - owls", "length": "short", "child_name": "", "template": False},
+                {"topic": "Space - foxes", "length": "short", "child_name": "", "template": False}]
+    batch.run_batch(requests[:1], concurrency=1, progress_file=str(stores / "progress.jsonl"))
+
+    def no_generation(*args, **kwargs):
+        raise AssertionError("the storybook generated a story")
+
+    monkeypatch.setattr(story_generator, "generate_story_and_image", no_generation)
+    assert batch.write_storybook(requests, str(stores / "book.pdf")) > 0
@@ -0,0 +1,126 @@
+import time
+
+import pytest
+
+from backends import BackendRateLimited
+from governor import CircuitBreaker, CircuitOpen, DeadlineExceeded, GovernedBackend
+
+
+class FlakyBackend:
+    """Fails the next `failures` calls with a rate limit error, then answers."""
+
+    name = "flaky"
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+
+    def chat(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise BackendRateLimited("rate limited")
+        usage.update(prompt_tokens=10, completion_tokens=10)
+        return "ok"
+
+    def chat_stream(self, model, messages, temperature=0.7, usage=None, max_tokens=None, timeout=None):
+        self.calls += 1
+        yield from ("o", "k")
+
+
+def make_governed(backend, retries=4, failures=2, cooldown=60.0, limits=None):
+    limits = limits or {"chat": {"tpm": 100000}}
+    governed = GovernedBackend(backend, limits, retries=retries, base_delay=0)
+    governed.endpoints["chat"].breaker = CircuitBreaker(failures=failures, cooldown=cooldown)
+    return governed
+
+
+def chat(governed, text="hello"):
+    return governed.chat("model", [{"role": "user", "content": text}])
+
+
+def test_retries_of_one_call_count_as_one_failure():
+    backend = FlakyBackend(failures=3)
+    governed = make_governed(backend)
+    assert chat(governed) == "ok"
+    assert backend.calls == 4
+    assert governed.endpoints["chat"].breaker.state == "closed"
+
+
+def test_breaker_opens_after_failed_calls():
+    backend = FlakyBackend(failures=100)
+    governed = make_governed(backend, retries=2)
+    for _ in range(2):
+        with pytest.raises(BackendRateLimited):
+            chat(governed)
+    assert backend.calls == 6  # two calls of three attempts each
+    assert governed.endpoints["chat"].breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        chat(governed)
+    assert backend.calls == 6
+
+
+def test_half_open_trial_recovers_or_reopens():
+    backend = FlakyBackend(failures=100)
+    governed = make_governed(backend, retries=1, failures=1, cooldown=0.05)
+    breaker = governed.endpoints["chat"].breaker
+    with pytest.raises(BackendRateLimited):
+        chat(governed)
+    assert breaker.state == "open"
+
+    # A failed trial (retries included) opens the circuit again
+    time.sleep(0.06)
+    with pytest.raises(BackendRateLimited):
+        chat(governed)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        chat(governed)
+
+    # A trial that succeeds after a retry closes it
+    backend.failures = 1
+    time.sleep(0.06)
+    assert chat(governed) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_failed_attempts_give_back_their_tokens():
+    governed = make_governed(FlakyBackend(failures=100), retries=3, failures=100)
+    tpm = governed.endpoints["chat"].tpm
+    with pytest.raises(BackendRateLimited):
+        chat(governed, "x" * 4000)
+    assert tpm.tokens == tpm.capacity
+
+
+def open_circuit(governed):
+    # As if the last call failed long enough ago that the next one is the half-open trial
+    breaker = governed.endpoints["chat"].breaker
+    breaker.opened_at = time.monotonic() - breaker.cooldown - 1
+    return breaker
+
+
+def test_trial_that_times_out_waiting_for_a_slot_does_not_wedge_the_circuit():
+    limits = {"chat": {"rpm": 1000, "tpm": 100000, "concurrency": 1, "deadline": 0.05}}
+    governed = make_governed(FlakyBackend(), limits=limits)
+    endpoint = governed.endpoints["chat"]
+    breaker = open_circuit(governed)
+    endpoint.slots.acquire()  # Someone else holds the only slot
+    with pytest.raises(DeadlineExceeded):
+        chat(governed)
+    assert breaker.state == "open"
+    # The call never ran, so its rate budget is back
+    assert endpoint.rpm.tokens == endpoint.rpm.capacity and endpoint.tpm.tokens == endpoint.tpm.capacity
+
+    endpoint.slots.release()
+    assert chat(governed) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_trial_stream_closed_early_does_not_wedge_the_circuit():
+    governed = make_governed(FlakyBackend())
+    breaker = open_circuit(governed)
+    stream = governed.chat_stream("model", [{"role": "user", "content": "hello"}])
+    assert next(stream) == "o"
+    stream.close()
+    assert breaker.state == "open"
+    assert chat(governed) == "ok"
+    assert breaker.state == "closed"
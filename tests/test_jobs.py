@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+import jobs
+import story_generator
+
+
+def test_identical_request_joins_the_paid_job(monkeypatch):
+    release = threading.Event()
+
+    def slow_stream(*args, **kwargs):
+        release.wait(5)
+        return iter([])
+
+    queue = jobs.JobQueue(workers=1)
+    monkeypatch.setattr(story_generator, "stream_story_and_image", slow_stream)
+    first = queue.submit("A calm story about Space - owls", "short", "", ticket=1)
+    joined = queue.submit("A calm story about Space - owls", "short", "", ticket=2)
+    release.set()
+    assert joined is first
+    assert joined.ticket == 1  # So the second caller knows to refund ticket 2
+
+
+def test_async_queue_joins_and_waits(monkeypatch):
+    async def fake_generate(story_topic, story_length, child_name, on_stage=None):
+        await asyncio.sleep(0.01)
+        return {"story": "Once upon a time", "image": None, "audio": None, "pdf": None}
+
+    monkeypatch.setattr(story_generator, "agenerate_story_and_image", fake_generate)
+
+    async def run():
+        queue = jobs.AsyncJobQueue(max_running=1)
+        first = queue.submit("A calm story about Space - owls", "short", "", ticket=1)
+        joined = queue.submit("A calm story about Space - owls", "short", "", ticket=2)
+        assert joined is first
+        assert await queue.wait(first, timeout=5)
+        assert await queue.wait(first, timeout=0)  # Already finished: no event left to wait on
+        return first
+
+    job = asyncio.run(run())
+    assert job.status == "done" and job.story_text == "Once upon a time"
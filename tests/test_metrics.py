@@ -0,0 +1,18 @@
+import metrics
+import story_generator
+from metrics import Registry
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.increment("story_requests_total", topic='a "quoted" \\ topic\nnext line')
+    assert 'topic="a \\"quoted\\" \\\\ topic\\nnext line"' in registry.export_prometheus()
+
+
+def test_cache_hits_record_the_lookup_time(stores, monkeypatch):
+    story_generator.generate_story_and_image("Space - owls", "short")
+    observed = []
+    monkeypatch.setattr(metrics, "observe", lambda name, value, **labels: observed.append((name, value, labels)))
+    cached = story_generator.get_cached_story("Space - owls", "short")
+    metrics.record_request(cached["timings"])
+    assert observed == [("story_request_seconds", cached["timings"]["cache_lookup"], {"source": "cache"})]
@@ -0,0 +1,34 @@
+from narration import split_narration
+
+
+def test_short_text_is_one_chunk():
+    assert split_narration("  Once upon a time.\n\nThe end.  ", max_chars=100) == ["Once upon a time.\n\nThe end."]
+
+
+def test_paragraphs_are_packed_up_to_the_limit():
+    text = "First paragraph here.\n\nSecond one.\n\nA third paragraph."
+    assert split_narration(text, max_chars=40) == ["First paragraph here.\n\nSecond one.", "A third paragraph."]
+
+
+def test_long_paragraph_splits_between_sentences():
+    text = "The owl woke up. She stretched her wings! Was it night yet? It was."
+    assert split_narration(text, max_chars=45) == [
+        "The owl woke up. She stretched her wings!", "Was it night yet? It was."]
+
+
+def test_closing_quotes_stay_with_their_sentence():
+    text = '"Good night," said the owl. "Sleep well." Then the moon rose high.'
+    assert split_narration(text, max_chars=45) == [
+        '"Good night," said the owl. "Sleep well."', "Then the moon rose high."]
+
+
+def test_titles_are_not_sentence_ends():
+    text = "Mr. Owl and Dr. Fox met at the old oak tree. They talked all night long."
+    assert split_narration(text, max_chars=50) == [
+        "Mr. Owl and Dr. Fox met at the old oak tree.", "They talked all night long."]
+
+
+def test_sentence_longer_than_a_chunk_splits_between_words():
+    chunks = split_narration("word " * 30, max_chars=40)
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    assert " ".join(chunks).split() == ["word"] * 30
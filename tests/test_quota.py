@@ -0,0 +1,56 @@
+import threading
+
+from quota import QuotaService
+
+
+def make_service(tmp_path, **kwargs):
+    kwargs.setdefault("user_limit", 2)
+    kwargs.setdefault("budget", 100.0)
+    return QuotaService(str(tmp_path / "quota.sqlite3"), **kwargs)
+
+
+def test_user_limit_and_refund(tmp_path):
+    quota = make_service(tmp_path)
+    first = quota.admit("ip:1", 0.07)
+    assert first.allowed and quota.admit("ip:1", 0.07).allowed
+    denied = quota.admit("ip:1", 0.07)
+    assert not denied.allowed and denied.reason == "user_limit" and denied.retry_after > 0
+    quota.refund(first.ticket)
+    assert quota.admit("ip:1", 0.07).allowed
+
+
+def test_global_budget(tmp_path):
+    quota = make_service(tmp_path, user_limit=100, budget=0.1)
+    assert quota.admit("ip:1", 0.07).allowed
+    denied = quota.admit("ip:2", 0.07)
+    assert not denied.allowed and denied.reason == "global_budget"
+
+
+def test_racing_workers_cannot_both_take_the_last_slot(tmp_path):
+    # One QuotaService per thread stands in for separate worker processes sharing the file
+    services = [make_service(tmp_path, user_limit=1, hot_ttl=0) for _ in range(8)]
+    barrier = threading.Barrier(len(services))
+    decisions = []
+
+    def admit(service):
+        barrier.wait()
+        decisions.append(service.admit("ip:1", 0.07))
+
+    threads = [threading.Thread(target=admit, args=(service,)) for service in services]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(decision.allowed for decision in decisions) == 1
+
+
+def test_hot_tier_forgets_idle_subjects(tmp_path, monkeypatch):
+    quota = make_service(tmp_path, hot_ttl=1.0)
+    clock = [1000.0]
+    monkeypatch.setattr("quota.time.time", lambda: clock[0])
+    for i in range(50):
+        quota.check(f"ip:{i}")
+    assert len(quota._hot_users) == 50
+    clock[0] += 120
+    quota.check("ip:new")
+    assert list(quota._hot_users) == ["ip:new"]
@@ -0,0 +1,48 @@
+import pytest
+
+import screening
+import story_cache
+from screening import KeywordMatcher, RefusalCache
+
+
+@pytest.mark.parametrize("topic", [
+    "A funny story about a Tasmanian devil", "star wars toys", "a pillow battle", "a blood orange tree",
+    "the warm sun", "a hot air balloon shot into the sky", "shooting stars",
+])
+def test_innocent_topics_pass(topic):
+    assert screening._matcher.search(topic) is None
+
+
+@pytest.mark.parametrize("topic", ["A murder mystery", "a knife fight at school", "GORY monsters!"])
+def test_unsafe_topics_are_caught(topic):
+    assert screening._matcher.search(topic) is not None
+
+
+def test_matcher_matches_whole_words_and_phrases():
+    matcher = KeywordMatcher(["war", "knife fight"])
+    assert matcher.search("A war story") == "war"
+    assert matcher.search("a warm award") is None
+    assert matcher.search("the knife, fight!") == "knife fight"
+    assert matcher.search("knife fighting") is None
+
+
+def test_refusals_are_shared_and_bounded(tmp_path):
+    path = str(tmp_path / "refusals.sqlite3")
+    cache = RefusalCache(path, max_entries=2)
+    cache.add("Space - A monster party")
+    assert "space  a monster PARTY" in cache
+    assert "Space - A monster party" in RefusalCache(path)  # Another worker
+    cache.add("topic two")
+    cache.add("topic three")
+    assert cache.size() == 2
+    assert "Space - A monster party" not in RefusalCache(path)
+
+
+def test_refusal_lookups_leave_the_story_cache_alone(tmp_path, monkeypatch):
+    stories = story_cache.StoryCache(str(tmp_path / "cache"))
+    monkeypatch.setattr(story_cache, "_cache", stories)
+    cache = RefusalCache(str(tmp_path / "refusals.sqlite3"))
+    assert "a bunny" not in cache
+    cache.add("a monster party")
+    stats = stories.stats()
+    assert (stats["hits"], stats["misses"], stats["stores"]) == (0, 0, 0)
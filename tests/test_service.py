@@ -0,0 +1,30 @@
+import pytest
+
+from service import HTTPError, _byte_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),  # Open-ended
+    ("bytes=-100", (900, 999)),  # The last 100 bytes
+    ("bytes=-5000", (0, 999)),  # A suffix longer than the file is the whole file
+    ("bytes=900-5000", (900, 999)),  # The end is clamped to the file
+    (" bytes = 10-19 ", (10, 19)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert _byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1000-1100", "bytes=50-10", "bytes=-0"])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(HTTPError) as error:
+        _byte_range(header, 1000)
+    assert error.value.status == 416
+    assert ("content-range", "bytes */1000") in error.value.headers
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=", "bytes=-", "bytes=abc-", "bytes=1-2-3", "bytes=+5-10", "items=0-10", "bytes=0-1,5-6", "0-10",
+])
+def test_malformed_ranges_are_ignored(header):
+    assert _byte_range(header, 1000) is None
@@ -0,0 +1,47 @@
+from similarity import SimilarityIndex
+
+TOPIC = "A calm story about Space - a bunny on the moon"
+
+
+def make_index(tmp_path):
+    return SimilarityIndex(str(tmp_path / "similarity.sqlite3"), threshold=0.8)
+
+
+def test_reworded_request_matches(tmp_path):
+    index = make_index(tmp_path)
+    index.add("ka", "story", TOPIC, "short", "")
+    assert index.nearest("story", "A calm story about Space - bunnies on moon!", "short", "")[0] == "ka"
+
+
+def test_other_partition_does_not_match(tmp_path):
+    index = make_index(tmp_path)
+    index.add("ka", "story", TOPIC, "short", "")
+    assert index.nearest("story", TOPIC, "medium", "")[0] is None
+    assert index.nearest("story", TOPIC, "short", "Mia")[0] is None
+
+
+def test_remove_then_nearest_finds_live_match(tmp_path):
+    index = make_index(tmp_path)
+    index.add("ka", "story", TOPIC, "short", "")
+    index.add("kb", "story", TOPIC, "short", "")
+    index.remove("ka")
+    assert index.nearest("story", TOPIC, "short", "") == ("kb", 1.0)
+    assert index.size() == 1
+
+
+def test_remove_last_entry(tmp_path):
+    index = make_index(tmp_path)
+    index.add("ka", "story", TOPIC, "short", "")
+    index.remove("ka")
+    assert index.nearest("story", TOPIC, "short", "")[0] is None
+    assert index.size() == 0
+
+
+def test_removed_key_stays_gone_after_sync(tmp_path):
+    index = make_index(tmp_path)
+    index.add("ka", "story", TOPIC, "short", "")
+    index.remove("ka")
+    index.add("kc", "story", "A calm story about Space - a dragon castle", "short", "")
+    other = make_index(tmp_path)  # Another process loading the shared rows
+    assert other.nearest("story", TOPIC, "short", "")[0] is None
+    assert other.size() == 1
@@ -0,0 +1,70 @@
+import asyncio
+
+import backends
+import story_generator
+
+
+def ignore_placeholder(monkeypatch):
+    """Makes the fake model ignore the name placeholder (as a real one sometimes does)."""
+    prompts = []
+
+    def story_text(self, messages, max_tokens=None):
+        prompts.append(messages[-1]["content"])
+        if "Mia" in messages[-1]["content"]:
+            return "Once upon a time, Mia found a quiet owl."
+        return "Once upon a time, a child found a quiet owl."
+
+    monkeypatch.setattr(backends.FakeBackend, "_story_text", story_text)
+    return prompts
+
+
+def test_template_tier_personalizes_and_shares(stores):
+    first = story_generator.generate_story_and_image("Space - owls", "short", "Mia")
+    assert "Mia" in first["story"]
+    second = story_generator.generate_story_and_image("Space - owls", "short", "Leo")
+    assert "Leo" in second["story"] and second["timings"].get("from_template")
+
+
+def test_unused_placeholder_falls_back_to_a_named_story(stores, monkeypatch):
+    prompts = ignore_placeholder(monkeypatch)
+    result = story_generator.generate_story_and_image("Space - owls", "short", "Mia")
+    assert "Mia" in result["story"] and len(prompts) == 2
+    assert story_generator.get_story_template("Space - owls", "short") is None
+    assert "Mia" in story_generator.get_cached_story("Space - owls", "short", "Mia")["story"]
+
+
+def test_async_unused_placeholder_falls_back_to_a_named_story(stores, monkeypatch):
+    ignore_placeholder(monkeypatch)
+    result = asyncio.run(story_generator.agenerate_story_and_image("Space - owls", "short", "Mia"))
+    assert "Mia" in result["story"]
+
+
+def test_streamed_story_without_the_name_is_not_cached_for_the_name(stores, monkeypatch):
+    ignore_placeholder(monkeypatch)
+    stream = story_generator.stream_story_and_image("Space - owls", "short", "Mia")
+    story = "".join(stream)
+    assert "Mia" not in story and stream.result["story"] == story.strip()
+    assert story_generator.get_cached_story("Space - owls", "short", "Mia") is None
+
+
+def test_ready_chunk_waits_for_enough_text():
+    assert story_generator._split_ready_chunk("Short. ", 20) == (None, "Short. ")
+
+
+def test_ready_chunk_cuts_at_the_first_boundary_past_the_minimum():
+    chunk, rest = story_generator._split_ready_chunk("One. Two is here. Three", 8)
+    assert (chunk, rest) == ("One. Two is here.", "Three")
+
+
+def test_ready_chunk_holds_back_a_trailing_fragment():
+    assert story_generator._split_ready_chunk("The owl said good", 5) == (None, "The owl said good")
+
+
+def test_ready_chunk_keeps_quotes_and_skips_titles():
+    chunk, rest = story_generator._split_ready_chunk('Mr. Owl said, "Hello there." And ', 10)
+    assert (chunk, rest) == ('Mr. Owl said, "Hello there."', "And ")
+
+
+def test_ready_chunk_cuts_at_a_paragraph_break():
+    chunk, rest = story_generator._split_ready_chunk("A title without a stop\n\nThen more", 5)
+    assert (chunk, rest) == ("A title without a stop", "Then more")